@@ -0,0 +1,299 @@
+#!/usr/bin/env python
+"""
+Benchmarks for ``towel.api``
+
+Creates synthetic data in an in-memory database and requests list, detail
+and set resources of the test application's API using the Django test
+client. Prints the results as JSON, suitable for comparing releases::
+
+    python benchmark.py --persons=2000 --requests=200 > before.json
+
+For every scenario, the following numbers are reported:
+
+- ``rps``: Requests per second
+- ``p50_ms`` and ``p99_ms``: Latency percentiles in milliseconds
+- ``queries``: Database queries per request
+- ``peak_memory_kb``: Memory used by the scenario alone. Measured using
+  ``tracemalloc`` during the warm-up request so that tracing does not slow
+  down the measured requests. Without ``tracemalloc`` (Python < 3.4) every
+  scenario runs in a forked process instead and the growth of its peak
+  resident memory is reported (``null`` if neither is possible, f.e. on
+  Windows)
+"""
+
+from __future__ import absolute_import, print_function, unicode_literals
+
+from os.path import abspath, dirname
+from optparse import OptionParser
+import gc
+import json
+import os
+import platform
+import random
+import sys
+import time
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+try:
+    import tracemalloc
+except ImportError:  # Python < 3.4
+    tracemalloc = None
+
+
+def create_data(options):
+    from testapp.models import EmailAddress, Group, Message, Person
+
+    rng = random.Random(options.seed)
+
+    Group.objects.bulk_create([
+        Group(name='Group %s' % i) for i in range(options.groups)])
+    Person.objects.bulk_create([
+        Person(given_name='Given %s' % i, family_name='Family %s' % i)
+        for i in range(options.persons)])
+
+    groups = list(Group.objects.values_list('pk', flat=True))
+    persons = list(Person.objects.values_list('pk', flat=True))
+
+    Membership = Person.groups.through
+    Membership.objects.bulk_create([
+        Membership(person_id=person, group_id=group)
+        for person in persons
+        for group in rng.sample(groups, min(options.fanout, len(groups)))])
+
+    EmailAddress.objects.bulk_create([
+        EmailAddress(person_id=person, email='%s-%s@example.com' % (
+            person, i))
+        for person in persons
+        for i in range(options.emails)])
+
+    emails = list(EmailAddress.objects.values_list('pk', flat=True))
+    Message.objects.bulk_create([
+        Message(sent_to_id=email, message='Message %s' % i)
+        for email in emails
+        for i in range(options.messages)])
+
+    return {
+        'person': persons,
+        'emailaddress': emails,
+        'message': list(Message.objects.values_list('pk', flat=True)),
+    }
+
+
+def scenarios(pks, options):
+    rng = random.Random(options.seed)
+
+    for limit in (20, 100, 1000):
+        for model in ('person', 'emailaddress'):
+            yield '%s list limit=%s' % (model, limit), [
+                '/api/v1/%s/?limit=%s&offset=%s' % (
+                    model,
+                    limit,
+                    rng.randint(0, max(0, len(pks[model]) - limit)))
+                for i in range(options.requests)]
+
+    for model in ('person', 'emailaddress', 'message'):
+        for full in (0, 1):
+            yield '%s detail full=%s' % (model, full), [
+                '/api/v1/%s/%s/?full=%s' % (
+                    model, rng.choice(pks[model]), full)
+                for i in range(options.requests)]
+
+    for size in (10, 100):
+        for model in ('person', 'emailaddress'):
+            yield '%s set size=%s' % (model, size), [
+                '/api/v1/%s/%s/' % (model, ';'.join(
+                    str(pk) for pk in rng.sample(
+                        pks[model], min(size, len(pks[model])))))
+                for i in range(options.requests)]
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def peak_memory_kb(func, *args):
+    """
+    Calls ``func`` and returns the peak memory allocated while it runs
+    """
+    if tracemalloc is None:
+        func(*args)
+        return None
+    # Stopping discards all traces, every measurement starts from zero
+    tracemalloc.start()
+    try:
+        func(*args)
+        return tracemalloc.get_traced_memory()[1] // 1024
+    finally:
+        tracemalloc.stop()
+
+
+def max_rss_kb():
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Reported in bytes on macOS, in kilobytes elsewhere
+    if platform.system() == 'Darwin':
+        return maxrss // 1024
+    return maxrss
+
+
+def run(name, uris, client):
+    from django.db import connection
+
+    def get(uri):
+        response = client.get(uri, HTTP_ACCEPT='application/json')
+        if response.status_code != 200:
+            raise ValueError('%s returned %s' % (uri, response.status_code))
+        return response
+
+    # Count queries and measure memory using a warm-up request; recording
+    # queries and tracing allocations all the time would slow down the
+    # measured requests. The list of queries is reset when a request
+    # starts.
+    gc.collect()
+    connection.use_debug_cursor = True
+    memory = peak_memory_kb(get, uris[0])
+    queries = len(connection.queries)
+    connection.use_debug_cursor = None
+
+    gc.collect()
+    durations = []
+    started = time.time()
+    for uri in uris:
+        request_started = time.time()
+        get(uri)
+        durations.append(time.time() - request_started)
+    total = time.time() - started
+
+    return {
+        'name': name,
+        'requests': len(uris),
+        'rps': round(len(uris) / total, 1),
+        'p50_ms': round(percentile(durations, 0.5) * 1000, 2),
+        'p99_ms': round(percentile(durations, 0.99) * 1000, 2),
+        'queries': queries,
+        'peak_memory_kb': memory,
+    }
+
+
+def run_forked(name, uris, client):
+    """
+    Runs the scenario in a forked process so that the peak resident memory
+    is not shared with other scenarios
+    """
+    read, write = os.pipe()
+    pid = os.fork()
+    if not pid:
+        os.close(read)
+        try:
+            before = max_rss_kb()
+            result = run(name, uris, client)
+            result['peak_memory_kb'] = max_rss_kb() - before
+            os.write(write, json.dumps(result).encode('utf-8'))
+        finally:
+            os._exit(0)
+
+    os.close(write)
+    chunks = []
+    while True:
+        chunk = os.read(read, 65536)
+        if not chunk:
+            break
+        chunks.append(chunk)
+    os.close(read)
+    os.waitpid(pid, 0)
+    if not chunks:
+        raise RuntimeError('Scenario %s failed' % name)
+    return json.loads(b''.join(chunks).decode('utf-8'))
+
+
+def main():
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option(
+        '--persons', type='int', default=1000,
+        help='Count of persons (default: %default)')
+    parser.add_option(
+        '--groups', type='int', default=50,
+        help='Count of groups (default: %default)')
+    parser.add_option(
+        '--fanout', type='int', default=3,
+        help='Groups per person (default: %default)')
+    parser.add_option(
+        '--emails', type='int', default=2,
+        help='Email addresses per person (default: %default)')
+    parser.add_option(
+        '--messages', type='int', default=1,
+        help='Messages per email address (default: %default)')
+    parser.add_option(
+        '--requests', type='int', default=100,
+        help='Requests per scenario (default: %default)')
+    parser.add_option(
+        '--filter', default='',
+        help='Only run scenarios whose name contains this string')
+    parser.add_option(
+        '--seed', type='int', default=42,
+        help='Random seed (default: %default)')
+    parser.add_option(
+        '--output', default='-',
+        help='Output file (default: stdout)')
+    options, args = parser.parse_args()
+
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'testapp.settings')
+    sys.path.insert(0, dirname(dirname(abspath(__file__))))
+    sys.path.insert(0, dirname(abspath(__file__)))
+
+    import django
+    if hasattr(django, 'setup'):
+        django.setup()
+
+    from django.db import connection
+    from django.test.client import Client
+    from django.test.utils import setup_test_environment
+
+    import towel
+
+    setup_test_environment()
+    connection.creation.create_test_db(verbosity=0)
+
+    started = time.time()
+    pks = create_data(options)
+    setup_duration = time.time() - started
+
+    forked = (
+        tracemalloc is None and resource is not None and hasattr(os, 'fork'))
+
+    client = Client()
+    results = []
+    for name, uris in scenarios(pks, options):
+        if options.filter in name:
+            results.append(
+                (run_forked if forked else run)(name, uris, client))
+            print(
+                '%(name)s: %(rps)s req/s, p50 %(p50_ms)sms' % results[-1],
+                file=sys.stderr)
+
+    report = {
+        'python': platform.python_version(),
+        'django': django.get_version(),
+        'towel': towel.__version__,
+        'options': dict(
+            (key, value) for key, value in vars(options).items()
+            if key != 'output'),
+        'setup_seconds': round(setup_duration, 2),
+        'results': results,
+    }
+
+    output = json.dumps(
+        report, indent=2, sort_keys=True, separators=(',', ': '))
+    if options.output == '-':
+        print(output)
+    else:
+        with open(options.output, 'w') as handle:
+            handle.write(output + '\n')
+
+
+if __name__ == '__main__':
+    main()
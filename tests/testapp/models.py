@@ -99,3 +99,14 @@ class Resource(models.Model):
 
     def __str__(self):
         return self.name
+
+
+class Token(models.Model):
+    user = models.ForeignKey('auth.User')
+    key = models.CharField(max_length=40, unique=True)
+
+
+class Tombstone(models.Model):
+    model = models.CharField(max_length=100, db_index=True)
+    object_pk = models.CharField(max_length=40)
+    discriminator = models.CharField(max_length=40, blank=True)
@@ -30,6 +30,8 @@ STATIC_ROOT = os.path.join(BASEDIR, 'static/')
 SECRET_KEY = 'supersikret'
 
 ROOT_URLCONF = 'testapp.urls'
+TOWEL_API_TOKEN_MODEL = 'testapp.Token'
+TOWEL_API_TOMBSTONE_MODEL = 'testapp.Tombstone'
 LANGUAGES = (('en', 'English'), ('de', 'German'))
 TEMPLATE_CONTEXT_PROCESSORS = (
     'django.contrib.auth.context_processors.auth',
@@ -1,13 +1,48 @@
 from __future__ import absolute_import, print_function, unicode_literals
 
+import base64
+from datetime import date, datetime, time, timedelta
+from decimal import Decimal
+from functools import partial
 import json
+import os
+import timeit
+import zlib
 
-from django.core.urlresolvers import NoReverseMatch
-from django.test import TestCase
+from django.contrib.auth.models import AnonymousUser, User
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.conf.urls import include, url
+from django.conf.urls.i18n import i18n_patterns
+from django.core.urlresolvers import (
+    NoReverseMatch, clear_url_caches, get_script_prefix, set_script_prefix,
+    set_urlconf)
+from django.db import connection, transaction
+from django.db.models.signals import post_save
+from django.http import HttpResponse, QueryDict, StreamingHttpResponse
+from django.test import RequestFactory, TestCase
+from django.utils import six, translation, unittest
+from django.utils.translation import ugettext_lazy
 
-from towel.api import api_reverse
+from towel.api import (
+    API, BulkResource, Resource, api_reverse, base, serialize_model_instance)
+from towel.api import (
+    changes, compression, decorators, formats, serializers)
+from towel.api import batch as batch_module
+from towel.api.batch import batch
+from towel.api.compression import compress_response
+from towel.api.decorators import http_basic_auth, token_auth
+from towel.api.json_backends import (
+    BACKENDS, JSONBackend, JSONEncoder, get_json_backend)
+from towel.api.plans import SerializationPlan, serialization_plan
+from towel.api.profiling import profiling_token, request_profiled
+from towel.api.serializers import Serializer, negotiate
+from towel.api.throttling import rate_limit
+from towel.api.utils import encode_cursor
+from towel.mt import api as mt_api
 
-from testapp.models import Group, Person, Message
+from testapp.api import api_v1
+from testapp.models import EmailAddress, Group, Person, Message, Token
 
 
 class APITest(TestCase):
@@ -31,6 +66,39 @@ class APITest(TestCase):
         except ValueError:
             print(uri, response.status_code, response.content)
 
+    def request_view(self, uri, request_type='list', view=None,
+                     view_kwargs=None, headers=None, **kwargs):
+        """
+        Requests ``uri`` from ``view`` or from a ``Resource`` initialized with
+        ``kwargs`` (``api_v1`` and ``Person`` by default) and returns the
+        response. ``view_kwargs`` are passed to the view, e.g.
+        ``{'pks': '1;2'}``, ``headers`` to the request, e.g.
+        ``{'HTTP_IF_NONE_MATCH': etag}``.
+        """
+        if view is None:
+            kwargs.setdefault('api', api_v1)
+            kwargs.setdefault('model', Person)
+            view = Resource.as_view(**kwargs)
+        request = RequestFactory().get(uri, **dict(
+            {'HTTP_ACCEPT': 'application/json'}, **(headers or {})))
+        return view(request, request_type=request_type, **(view_kwargs or {}))
+
+    def get_view_json(self, uri, request_type='list', status_code=200,
+                      **kwargs):
+        """
+        Like ``request_view``, but checks the status code and returns the
+        decoded JSON, streamed or not
+        """
+        response = self.request_view(uri, request_type, **kwargs)
+        self.assertEqual(response.status_code, status_code)
+        if kwargs.get('streaming'):
+            self.assertTrue(response.streaming)
+        if response.streaming:
+            content = b''.join(response.streaming_content)
+        else:
+            content = response.content
+        return json.loads(content.decode('utf-8'))
+
     def test_info(self):
         self.assertEqual(self.client.get('/api/v1/').status_code, 406)
         response = self.client.get(
@@ -58,6 +126,41 @@ class APITest(TestCase):
 
         self.assertEqual(len(data['views']), 1)
 
+    def test_root_document_cache(self):
+        self.assertIs(api_v1.urls, api_v1.urls)
+
+        # Reversing uses the URLconf, only the name of the API matters
+        api = API('v1')
+        api.register(Group)
+        urls = api.urls
+
+        def get(**kwargs):
+            return api.root_document(
+                RequestFactory().get('/api/v1/', **kwargs))
+
+        document = get()
+        self.assertIs(get(), document)
+        self.assertEqual(
+            document['group']['__uri__'], 'http://testserver/api/v1/group/')
+
+        # Documents are cached per host and scheme
+        other = get(HTTP_HOST='example.com', **{'wsgi.url_scheme': 'https'})
+        self.assertEqual(
+            other['group']['__uri__'], 'https://example.com/api/v1/group/')
+
+        api.register(Person)
+        self.assertIsNot(api.urls, urls)
+        self.assertEqual(len(get()['resources']), 2)
+
+        api.add_view(lambda request, api: None, prefix=r'^hello/')
+        self.assertEqual(
+            get()['views'][0]['__uri__'], 'http://testserver/api/v1/hello/')
+
+        api.max_root_documents = 2
+        for idx in range(5):
+            get(HTTP_HOST='host%s.example.com' % idx)
+        self.assertLessEqual(len(api._root_documents), 2)
+
     def test_list_detail(self):
         person_uri = self.api['person']['__uri__']
         data = self.get_json(person_uri)
@@ -135,6 +238,119 @@ class APITest(TestCase):
             {'error': 'No Person matches the given query.'},
         )
 
+    def test_cursor_pagination(self):
+        get = partial(
+            self.get_view_json, cursor_ordering=('-family_name', 'pk'))
+
+        expected = list(Person.objects.order_by(
+            '-family_name', 'pk').values_list('pk', flat=True))
+
+        seen, pages = [], []
+        uri = '/api/v1/person/?limit=30'
+        while uri:
+            data = get(uri)
+            self.assertEqual(data['meta']['total'], None)
+            self.assertFalse('offset' in data['meta'])
+            seen.extend(obj['__pk__'] for obj in data['objects'])
+            pages.append(data)
+            uri = data['meta']['next']
+
+        self.assertEqual(seen, expected)
+        self.assertEqual([len(page['objects']) for page in pages], [
+            30, 30, 30, 10])
+        self.assertEqual(pages[0]['meta']['previous'], None)
+
+        data = get(pages[2]['meta']['previous'])
+        self.assertEqual(data['objects'], pages[1]['objects'])
+        self.assertEqual(data['meta']['next'], pages[1]['meta']['next'])
+        self.assertEqual(
+            data['meta']['previous'], pages[1]['meta']['previous'])
+
+        data = get(pages[1]['meta']['previous'])
+        self.assertEqual(data['objects'], pages[0]['objects'])
+        self.assertEqual(data['meta']['previous'], None)
+
+        # Offset clients are still supported
+        data = get('/api/v1/person/?offset=10&limit=10')
+        self.assertEqual(data['meta']['offset'], 10)
+        self.assertEqual(data['meta']['total'], 100)
+
+        for cursor in ('blabla', encode_cursor(['Family 1']),
+                       encode_cursor(['Family 1', 'abc']),
+                       encode_cursor(['Family 1', [1]])):
+            data = get('/api/v1/person/?after=%s' % cursor, status_code=400)
+            self.assertEqual(data['error'], 'Invalid cursor')
+
+    def test_total_policies(self):
+        def get(uri, **kwargs):
+            return self.get_view_json(uri, **kwargs)['meta']
+
+        data = get('/api/v1/person/?limit=30&offset=60', total_policy='none')
+        self.assertEqual(data['total'], None)
+        self.assertEqual(
+            data['next'],
+            'http://testserver/api/v1/person/?limit=30&offset=90')
+        data = get('/api/v1/person/?limit=30&offset=70', total_policy='none')
+        self.assertEqual(data['next'], None)
+
+        with self.assertNumQueries(2):
+            data = get('/api/v1/person/', total_policy='estimate')
+        self.assertEqual(data['total'], 100)
+
+        cache.clear()
+        with self.assertNumQueries(2):
+            data = get('/api/v1/person/', total_policy='cached')
+        self.assertEqual(data['total'], 100)
+
+        Person.objects.create()
+        with self.assertNumQueries(1):
+            data = get('/api/v1/person/?offset=20', total_policy='cached')
+        self.assertEqual(data['total'], 100)
+        self.assertEqual(get('/api/v1/person/')['total'], 101)
+
+        # Different filters do not share counts
+        with self.assertNumQueries(2):
+            data = get(
+                '/api/v1/person/', total_policy='cached',
+                queryset=Person.objects.filter(given_name='Given 5'))
+        self.assertEqual(data['total'], 1)
+
+    def test_streaming(self):
+        get = partial(self.get_view_json, streaming=True)
+
+        expected = self.get_json('/api/v1/person/?limit=50&offset=30')
+        self.assertEqual(get('/api/v1/person/?limit=50&offset=30'), expected)
+
+        for meta_first in (True, False):
+            data = get(
+                '/api/v1/person/?limit=30&offset=60',
+                stream_meta_first=meta_first,
+                total_policy='none')
+            self.assertEqual(len(data['objects']), 30)
+            self.assertEqual(
+                data['meta']['next'],
+                'http://testserver/api/v1/person/?limit=30&offset=90')
+
+            data = get(
+                '/api/v1/person/?limit=30&offset=70',
+                stream_meta_first=meta_first,
+                total_policy='none')
+            self.assertEqual(len(data['objects']), 30)
+            self.assertEqual(data['meta']['next'], None)
+
+        api_v1.serializers[EmailAddress] = partial(
+            serialize_model_instance, inline_depth=1)
+        try:
+            with self.assertNumQueries(1 + 2 * 8):
+                data = get(
+                    '/api/v1/emailaddress/?limit=50', model=EmailAddress,
+                    stream_chunk_size=7)
+            self.assertEqual(len(data['objects']), 50)
+            self.assertEqual(
+                data['objects'][0]['person']['family_name'], 'Family 0')
+        finally:
+            del api_v1.serializers[EmailAddress]
+
     def test_http_methods(self):
         response = self.client.options('/api/v1/')
         self.assertEqual(response.status_code, 200)
@@ -268,6 +484,115 @@ class APITest(TestCase):
             NoReverseMatch,
             api_reverse, Person, 'sets', api_name='v1', pks='2;')
 
+    def test_set_order(self):
+        pks = list(Person.objects.order_by('-pk').values_list('pk', flat=True))
+
+        def get(pks, **kwargs):
+            return self.get_view_json(
+                '/', 'set', view_kwargs={
+                    'pks': ';'.join(str(pk) for pk in pks)},
+                **kwargs)
+
+        data = get([pks[3], pks[1], pks[2], pks[1]])
+        self.assertEqual(
+            [obj['__pk__'] for obj in data['objects']],
+            [pks[3], pks[1], pks[2]])
+        self.assertFalse('missing' in data)
+
+        get([pks[3], 0, pks[1]], status_code=404)
+
+        data = get([pks[3], 0, pks[1]], set_report_missing=True)
+        self.assertEqual(
+            [obj['__pk__'] for obj in data['objects']], [pks[3], pks[1]])
+        self.assertEqual(data['missing'], [0])
+
+        # Large sets are fetched in chunks
+        with self.assertNumQueries(4):
+            data = get(pks, set_chunk_size=30)
+        self.assertEqual([obj['__pk__'] for obj in data['objects']], pks)
+
+        # Versions for conditional requests are aggregated per chunk, too
+        get = partial(
+            self.request_view, '/', 'set',
+            view=Resource.as_view(
+                api=api_v1, model=Person, set_chunk_size=30,
+                version_field='created'),
+            view_kwargs={'pks': ';'.join(str(pk) for pk in pks)})
+        with self.assertNumQueries(8):
+            response = get()
+        with self.assertNumQueries(4):
+            response = get(headers={'HTTP_IF_NONE_MATCH': response['ETag']})
+        self.assertEqual(response.status_code, 304)
+
+    def test_api_reverse_templates(self):
+        self.assertEqual(
+            base.uri_template('v1_testapp_person_detail', ('pk',)),
+            '/api/v1/person/{pk}/')
+        self.assertEqual(
+            base.uri_template('v1_testapp_person_list', ()),
+            '/api/v1/person/')
+        self.assertTrue(
+            base.uri_template('v1_testapp_person_sets', ('pks',))
+            is base._NOT_REGISTERED)
+
+        calls = []
+        reverse = base.reverse
+
+        def counting_reverse(*args, **kwargs):
+            calls.append(args)
+            return reverse(*args, **kwargs)
+
+        base.reverse = counting_reverse
+        prefix = get_script_prefix()
+        try:
+            for pk in (1, '2', 3):
+                self.assertEqual(
+                    api_reverse(Person, 'detail', api_name='v1', pk=pk),
+                    '/api/v1/person/%s/' % pk)
+            for i in range(3):
+                self.assertEqual(
+                    api_reverse(
+                        Person, 'sets', api_name='v1', pks='2;3',
+                        fail_silently=True),
+                    None)
+            self.assertEqual(calls, [])
+
+            # Non-integer arguments are still validated by reverse()
+            for pk in ('abc', '1\n', -1):
+                self.assertRaises(
+                    NoReverseMatch,
+                    api_reverse, Person, 'detail', api_name='v1', pk=pk)
+            self.assertEqual(len(calls), 3)
+
+            set_script_prefix('/prefix/')
+            self.assertEqual(
+                api_reverse(Person, 'detail', api_name='v1', pk=1),
+                '/prefix/api/v1/person/1/')
+
+            clear_url_caches()
+            del calls[:]
+            api_reverse(Person, 'detail', api_name='v1', pk=1)
+            api_reverse(Person, 'detail', api_name='v1', pk=2)
+            self.assertEqual(len(calls), 1)
+        finally:
+            base.reverse = reverse
+            set_script_prefix(prefix)
+
+        # Templates are cached per language
+        class i18n_urls(object):
+            urlpatterns = i18n_patterns(
+                '', url(r'^api/v1/', include(api_v1.urls)))
+
+        set_urlconf(i18n_urls)
+        try:
+            for language in ('de', 'en', 'de'):
+                with translation.override(language):
+                    self.assertEqual(
+                        api_reverse(Person, 'detail', api_name='v1', pk=1),
+                        '/%s/api/v1/person/1/' % language)
+        finally:
+            set_urlconf(None)
+
     def test_serialization(self):
         person = Person.objects.order_by('id')[0]
         group = Group.objects.create(
@@ -306,3 +631,1339 @@ class APITest(TestCase):
         self.assertEqual(data['name'], 'grouup')
         self.assertTrue('members' in data)
         self.assertEqual(len(data['members']), 1)
+
+    def test_serialization_plan(self):
+        person = Person.objects.order_by('id')[0]
+        group = Group.objects.create(name='grouup')
+        person.groups.add(group)
+        emailaddress = person.emailaddress_set.get()
+        person_uri = api_reverse(Person, 'detail', api_name='v1', pk=person.pk)
+
+        plan = serialization_plan(Person, 'v1', exclude=('is_active',))
+        self.assertTrue(
+            plan is serialization_plan(Person, 'v1', exclude=['is_active']))
+        self.assertFalse(
+            plan is serialization_plan(
+                Person, 'v1', exclude=('is_active',), inline=True))
+        self.assertEqual(plan.relations, [])
+
+        expected = {
+            '__pk__': person.pk,
+            '__pretty__': {'relationship': 'unspecified'},
+            '__str__': 'Given 0 Family 0',
+            '__uri__': person_uri,
+            'created': person.created,
+            'family_name': 'Family 0',
+            'given_name': 'Given 0',
+            'id': person.pk,
+            'relationship': '',
+        }
+        self.assertEqual(api_v1.serialize_instance(person), expected)
+        self.assertEqual(plan.serialize(person, api_v1), expected)
+
+        expected.update({
+            'emailaddress_set': [{
+                '__pk__': emailaddress.pk,
+                '__pretty__': {},
+                '__str__': 'test0@example.com',
+                '__uri__': api_reverse(
+                    EmailAddress, 'detail', api_name='v1',
+                    pk=emailaddress.pk),
+                'email': 'test0@example.com',
+                'id': emailaddress.pk,
+                'person': person_uri,
+            }],
+            'groups': [{
+                '__pk__': group.pk,
+                '__pretty__': {},
+                '__str__': 'Group object',
+                '__uri__': api_reverse(
+                    Group, 'detail', api_name='v1', pk=group.pk),
+                'id': group.pk,
+                'name': 'grouup',
+            }],
+        })
+        self.assertEqual(
+            api_v1.serialize_instance(person, inline_depth=1), expected)
+        self.assertEqual(
+            SerializationPlan(
+                Person, 'v1', exclude=('is_active',), inline=True,
+            ).serialize(person, api_v1, inline_depth=1),
+            expected)
+
+    def test_related_lookups(self):
+        self.assertEqual(api_v1.related_lookups(Person), ([], []))
+        self.assertEqual(
+            api_v1.related_lookups(Person, inline_depth=1),
+            ([], ['emailaddress_set', 'groups']))
+        self.assertEqual(
+            api_v1.related_lookups(EmailAddress, inline_depth=2),
+            (['person'], [
+                'person__emailaddress_set', 'person__groups',
+                'message_set', 'message_set__sent_to']))
+
+        emailaddress = EmailAddress.objects.order_by('id')[0]
+        Message.objects.create(sent_to=emailaddress, message='Hello')
+
+        api_v1.serializers[EmailAddress] = partial(
+            serialize_model_instance, inline_depth=1)
+        try:
+            for limit in (5, 50):
+                with self.assertNumQueries(3):
+                    data = self.get_json(
+                        '/api/v1/emailaddress/?limit=%s' % limit)
+                self.assertEqual(len(data['objects']), limit)
+
+            first = data['objects'][0]
+            self.assertEqual(first['person']['given_name'], 'Given 0')
+            self.assertEqual(len(first['message_set']), 1)
+
+            with self.assertNumQueries(2):
+                data = self.get_json('/api/v1/emailaddress/%s;%s/' % (
+                    emailaddress.pk, emailaddress.pk + 1))
+            self.assertEqual(len(data['objects']), 2)
+        finally:
+            del api_v1.serializers[EmailAddress]
+
+        with self.assertNumQueries(3):
+            self.get_json('/api/v1/person/%s/?full=1' % (
+                emailaddress.person_id))
+
+    def available_json_backends(self):
+        for name, cls in BACKENDS:
+            try:
+                yield name, get_json_backend(name)
+            except ImproperlyConfigured:
+                pass
+
+    def test_json_backends(self):
+        data = {
+            'date': date(2014, 1, 31),
+            'datetime': datetime(2014, 1, 31, 12, 30, 15, 123456),
+            'time': time(12, 30),
+            'decimal': Decimal('1.10'),
+            'lazy': ugettext_lazy('unspecified'),
+            'values': [1, 2.5, None, True, 'text'],
+            'querydict': QueryDict('a=1&a=2&b=3'),
+            'nested': {'__pretty__': {}},
+        }
+        reference = json.dumps(data, cls=JSONEncoder)
+        self.assertEqual(json.loads(reference), {
+            'date': '2014-01-31',
+            'datetime': '2014-01-31T12:30:15.123',
+            'time': '12:30:00',
+            'decimal': '1.10',
+            'lazy': 'unspecified',
+            'values': [1, 2.5, None, True, 'text'],
+            'querydict': {'a': '2', 'b': '3'},
+            'nested': {'__pretty__': {}},
+        })
+
+        for name, backend in self.available_json_backends():
+            encoded = backend.dumps(data)
+            if name == 'orjson':
+                self.assertEqual(json.loads(encoded), json.loads(reference))
+            else:
+                self.assertEqual(encoded, reference)
+            self.assertEqual(backend.loads(encoded), json.loads(reference))
+
+        # The automatically chosen backend never changes the output
+        self.assertEqual(get_json_backend('auto').dumps(data), reference)
+        self.assertNotEqual(get_json_backend('auto').name, 'orjson')
+
+        self.assertRaises(ImproperlyConfigured, get_json_backend, 'xml')
+        with self.settings(TOWEL_API_JSON_BACKEND='json'):
+            self.assertEqual(get_json_backend().name, 'json')
+
+    def test_conditional_requests(self):
+        view = Resource.as_view(
+            api=api_v1, model=Person, version_field='created')
+        person = Person.objects.order_by('pk')[0]
+        detail_uri = api_reverse(
+            Person, 'detail', api_name='v1', pk=person.pk)
+
+        def get(uri, request_type, **headers):
+            kw = {'pk': person.pk} if request_type == 'detail' else {}
+            if request_type == 'set':
+                kw['pks'] = '%s;%s' % (person.pk, person.pk + 1)
+            return self.request_view(
+                uri, request_type, view=view, view_kwargs=kw, headers=headers)
+
+        for uri, request_type in (
+                (detail_uri, 'detail'),
+                ('/api/v1/person/?limit=5', 'list'),
+                ('/api/v1/person/%s;%s/' % (person.pk, person.pk + 1), 'set'),
+        ):
+            response = get(uri, request_type)
+            self.assertEqual(response.status_code, 200)
+            etag = response['ETag']
+            last_modified = response['Last-Modified']
+
+            with self.assertNumQueries(1):
+                response = get(uri, request_type, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(response['ETag'], etag)
+            self.assertEqual(response.content, b'')
+
+            with self.assertNumQueries(1):
+                response = get(
+                    uri, request_type, HTTP_IF_MODIFIED_SINCE=last_modified)
+            self.assertEqual(response.status_code, 304)
+
+            response = get(uri, request_type, HTTP_IF_NONE_MATCH='"other"')
+            self.assertEqual(response.status_code, 200)
+
+            # Different representations have different ETags
+            response = get(uri + '&format=json' if '?' in uri else uri + (
+                '?format=json'), request_type, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 200)
+
+        etag = get(detail_uri, 'detail')['ETag']
+        person.created += timedelta(days=1)
+        person.save()
+        response = get(detail_uri, 'detail', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+        # Deletions change the version of lists
+        response = get('/api/v1/person/?limit=5', 'list')
+        etag = response['ETag']
+        Person.objects.order_by('-pk')[0].delete()
+        response = get(
+            '/api/v1/person/?limit=5', 'list', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+        # Missing objects are still reported as such
+        response = self.request_view(
+            '/', 'detail', view=view, view_kwargs={'pk': 0})
+        self.assertEqual(response.status_code, 404)
+
+        # No conditional requests without version field
+        response = self.client.get(
+            detail_uri, HTTP_ACCEPT='application/json')
+        self.assertFalse(response.has_header('ETag'))
+
+    def test_response_cache(self):
+        cache.clear()
+        person = Person.objects.order_by('pk')[0]
+        group = Group.objects.create(name='Group')
+
+        view = Resource.as_view(api=api_v1, model=Person, cache_timeout=60)
+        get = partial(self.request_view, view=view)
+        detail = partial(
+            get, '/api/v1/person/%s/?full=1' % person.pk, 'detail',
+            view_kwargs={'pk': person.pk})
+
+        response = detail()
+        self.assertEqual(response.status_code, 200)
+        with self.assertNumQueries(0):
+            self.assertEqual(detail().content, response.content)
+
+        # Different representations are cached separately
+        accept = {'HTTP_ACCEPT': 'text/html, application/json;q=0.5'}
+        with self.assertNumQueries(3):
+            detail(headers=accept)
+        with self.assertNumQueries(0):
+            detail(headers=accept)
+
+        # Responses contain absolute URIs, other hosts and schemes do not
+        # share cached responses
+        for headers in (
+                {'HTTP_HOST': 'api.example.com'},
+                {'HTTP_HOST': 'api.example.com', 'wsgi.url_scheme': 'https'}):
+            with self.settings(ALLOWED_HOSTS=['*']):
+                data = json.loads(
+                    detail(headers=headers).content.decode('utf-8'))
+            self.assertTrue(data['emailaddress_set'][0]['__uri__'].startswith(
+                '%s://api.example.com/' % headers.get(
+                    'wsgi.url_scheme', 'http')))
+
+        # Saves invalidate cached responses
+        person.given_name = 'Changed'
+        person.save()
+        response = detail()
+        self.assertEqual(
+            json.loads(response.content.decode('utf-8'))['given_name'],
+            'Changed')
+
+        # Many to many changes and inlined models as well
+        person.groups.add(group)
+        data = json.loads(detail().content.decode('utf-8'))
+        self.assertEqual(data['groups'][0]['name'], 'Group')
+        group.name = 'Renamed'
+        group.save()
+        data = json.loads(detail().content.decode('utf-8'))
+        self.assertEqual(data['groups'][0]['name'], 'Renamed')
+
+        # Lists are invalidated by deletions
+        response = get('/api/v1/person/?limit=1000')
+        total = json.loads(response.content.decode('utf-8'))['meta']['total']
+        with self.assertNumQueries(0):
+            get('/api/v1/person/?limit=1000')
+        Person.objects.order_by('-pk')[0].delete()
+        response = get('/api/v1/person/?limit=1000')
+        self.assertEqual(
+            json.loads(response.content.decode('utf-8'))['meta']['total'],
+            total - 1)
+
+        # Errors are not cached
+        for i in range(2):
+            with self.assertNumQueries(1):
+                response = get('/', 'detail', view_kwargs={'pk': 0})
+            self.assertEqual(response.status_code, 404)
+
+        # Responses are not cached without cache_timeout
+        with self.assertNumQueries(1):
+            self.client.get(
+                '/api/v1/person/%s/' % person.pk,
+                HTTP_ACCEPT='application/json')
+        with self.assertNumQueries(1):
+            self.client.get(
+                '/api/v1/person/%s/' % person.pk,
+                HTTP_ACCEPT='application/json')
+
+    def test_sparse_fieldsets(self):
+        person = Person.objects.order_by('pk')[0]
+        uri = api_reverse(Person, 'detail', api_name='v1', pk=person.pk)
+        meta = set(['__uri__', '__str__', '__pretty__', '__pk__'])
+
+        data = self.get_json(uri + '?fields=family_name,created')
+        self.assertEqual(set(data), meta | set(['family_name', 'created']))
+        self.assertEqual(data['__str__'], 'Given 0 Family 0')
+
+        data = self.get_json(uri + '?exclude=created&exclude=relationship')
+        self.assertEqual(
+            set(data), meta | set(['id', 'family_name', 'given_name']))
+
+        # Fields excluded upon registration stay excluded
+        data = self.get_json(uri + '?fields=is_active,given_name')
+        self.assertEqual(set(data), meta | set(['given_name']))
+
+        data = self.get_json('/api/v1/person/?fields=id&limit=5')
+        self.assertEqual(len(data['objects']), 5)
+        self.assertEqual(set(data['objects'][0]), meta | set(['id']))
+        self.assertTrue('fields=id' in data['meta']['next'])
+
+        api_v1.serializers[EmailAddress] = partial(
+            serialize_model_instance, inline_depth=1)
+        try:
+            with self.assertNumQueries(2):
+                data = self.get_json(
+                    '/api/v1/emailaddress/?fields=email,person.family_name'
+                    '&exclude=person.id')
+            self.assertEqual(
+                set(data['objects'][0]), meta | set(['email', 'person']))
+            self.assertEqual(
+                set(data['objects'][0]['person']),
+                meta | set(['family_name']))
+
+            # Relations which are not serialized are not fetched either
+            with self.assertNumQueries(2):
+                data = self.get_json(
+                    '/api/v1/emailaddress/?exclude=person,message_set')
+            self.assertEqual(set(data['objects'][0]), meta | set([
+                'id', 'email']))
+        finally:
+            del api_v1.serializers[EmailAddress]
+
+        # Only the requested columns are loaded if str_fields is set
+        # Not using CaptureQueriesContext, which requires Django 1.6
+        with self.assertNumQueries(2):
+            offset = len(connection.queries)
+            data = self.get_view_json(
+                '/api/v1/person/?fields=created',
+                str_fields=('given_name', 'family_name'))
+        self.assertFalse(
+            'relationship' in connection.queries[offset + 1]['sql'])
+        self.assertEqual(set(data['objects'][0]), meta | set(['created']))
+        self.assertEqual(data['objects'][0]['__str__'], 'Given 0 Family 0')
+        self.assertEqual(data['objects'][0]['__uri__'], self.get_json(
+            '/api/v1/person/')['objects'][0]['__uri__'])
+
+    def test_values_fast_path(self):
+        Person.objects.filter(pk__in=Person.objects.order_by(
+            'pk').values_list('pk', flat=True)[:10]).update(
+            relationship='married')
+
+        def get(uri, model=Person, **kwargs):
+            with self.assertNumQueries(2):
+                return self.get_view_json(
+                    uri, model=model, values_fast_path=True, **kwargs)
+
+        def without_str(data):
+            return dict(data, objects=[
+                dict((key, value) for key, value in obj.items()
+                     if key != '__str__')
+                for obj in data['objects']])
+
+        for uri, model, values_str, str_fields in (
+                ('/api/v1/person/?limit=50', Person,
+                 '{given_name} {family_name}', ()),
+                ('/api/v1/person/?limit=50&offset=60&fields=created', Person,
+                 '{given_name} {family_name}', ('given_name', 'family_name')),
+                ('/api/v1/emailaddress/?limit=30&exclude=email', EmailAddress,
+                 '{email}', ('email',)),
+        ):
+            expected = self.get_json(uri)
+            self.assertEqual(get(uri, model), without_str(expected))
+            data = get(
+                uri, model, streaming=True, total_policy='none',
+                values_str=values_str, str_fields=str_fields)
+            self.assertEqual(data['objects'], expected['objects'])
+            self.assertEqual(data['meta']['next'], expected['meta']['next'])
+
+        # Inlining requires instances
+        api_v1.serializers[EmailAddress] = partial(
+            serialize_model_instance, inline_depth=1)
+        try:
+            self.assertEqual(api_v1.row_serializer(EmailAddress), None)
+        finally:
+            del api_v1.serializers[EmailAddress]
+        self.assertNotEqual(api_v1.row_serializer(EmailAddress), None)
+
+    def test_bulk_resource(self):
+        view = BulkResource.as_view(api=api_v1, model=Group)
+        factory = RequestFactory()
+        # Django < 1.6 does not use savepoints inside test cases
+        savepoints = 2 if hasattr(transaction, 'atomic') else 0
+
+        def request(method, data, uri='/api/v1/group/', **kwargs):
+            response = view(
+                factory.generic(
+                    method.upper(), uri, json.dumps(data), 'application/json',
+                    HTTP_ACCEPT='application/json'),
+                **kwargs)
+            return response, (
+                json.loads(response.content.decode('utf-8'))
+                if response.content else None)
+
+        response, data = request('post', [
+            {'name': 'One'}, {'name': 'Two'}, {'name': 'Three'},
+        ], request_type='list')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(
+            [obj['name'] for obj in data['objects']], ['One', 'Two', 'Three'])
+        pks = [obj['__pk__'] for obj in data['objects']]
+        set_uri = '/api/v1/group/%s/' % ';'.join(map(str, pks))
+        set_kwargs = {
+            'request_type': 'set',
+            'pks': ';'.join(map(str, pks)),
+        }
+
+        # Errors are reported per object, nothing is saved
+        response, data = request('post', [
+            {'name': 'Four'}, {}, {'name': 'x' * 101}, 'Six',
+        ], request_type='list')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(data['objects'][0], None)
+        self.assertEqual(
+            data['objects'][1]['name'], ['This field is required.'])
+        self.assertTrue(data['objects'][2]['name'])
+        self.assertTrue(data['objects'][3]['__all__'])
+        self.assertEqual(Group.objects.count(), 3)
+
+        response, data = request('post', {'name': 'Four'}, request_type='list')
+        self.assertEqual(response.status_code, 400)
+
+        response, data = request(
+            'post', [{'name': 'Many'}] * 5, request_type='list')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(Group.objects.count(), 8)
+
+        view = BulkResource.as_view(
+            api=api_v1, model=Group, use_bulk_create=True,
+            use_bulk_update=True, max_bulk_objects=10)
+        # SAVEPOINT, INSERT, RELEASE SAVEPOINT
+        with self.assertNumQueries(1 + savepoints):
+            response, data = request(
+                'post', [{'name': 'Bulk'}] * 10, request_type='list')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(data, {'created': 10})
+        self.assertEqual(Group.objects.filter(name='Bulk').count(), 10)
+
+        response, data = request(
+            'post', [{'name': 'Bulk'}] * 11, request_type='list')
+        self.assertEqual(response.status_code, 413)
+
+        # Per object updates
+        response, data = request('patch', {
+            str(pks[0]): {'name': 'Eins'},
+            str(pks[1]): {},
+            str(pks[2]): {'name': 'Drei'},
+        }, uri=set_uri, **set_kwargs)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            [obj['name'] for obj in data['objects']], ['Eins', 'Two', 'Drei'])
+
+        response, data = request('put', {
+            str(pks[0]): {'name': 'One'},
+            str(pks[1]): {},
+            str(pks[2]): {'name': 'Three'},
+        }, uri=set_uri, **set_kwargs)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(data['objects'][0], None)
+        self.assertTrue(data['objects'][1]['name'])
+        self.assertEqual(Group.objects.get(pk=pks[0]).name, 'Eins')
+
+        response, data = request('put', {
+            str(pks[0]): {'name': 'One'},
+        }, uri=set_uri, **set_kwargs)
+        self.assertEqual(response.status_code, 400)
+
+        # Same data for all objects, using a single UPDATE query
+        # SAVEPOINT, SELECT, UPDATE, SELECT, RELEASE SAVEPOINT
+        with self.assertNumQueries(3 + savepoints):
+            response, data = request(
+                'patch', {'name': 'Same'}, uri=set_uri, **set_kwargs)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            [obj['name'] for obj in data['objects']], ['Same'] * 3)
+
+        # Data which the form does not handle is saved object by object
+        response, data = request(
+            'patch', {'id': pks[0], 'name': 'Other'}, uri=set_uri,
+            **set_kwargs)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            [obj['__pk__'] for obj in data['objects']], pks)
+        self.assertEqual(
+            [obj['name'] for obj in data['objects']], ['Other'] * 3)
+
+        # Primary keys are normalized
+        response, data = request(
+            'patch', {'0%s' % pks[0]: {'name': 'Same'}}, uri=set_uri,
+            request_type='set', pks='0%s' % pks[0])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['objects'][0]['__pk__'], pks[0])
+
+        # Changes have to be recorded by save()
+        saved = []
+        receiver = lambda sender, instance, **kwargs: saved.append(instance)
+        post_save.connect(receiver, sender=Group)
+        try:
+            view = BulkResource.as_view(
+                api=api_v1, model=Group, use_bulk_update=True,
+                version_field='name')
+            response, data = request(
+                'patch', {'name': 'Same'}, uri=set_uri, **set_kwargs)
+            self.assertEqual(len(saved), 3)
+
+            changes.track_deletions([Group])
+            view = BulkResource.as_view(
+                api=api_v1, model=Group, use_bulk_update=True)
+            response, data = request(
+                'patch', {'name': 'Same'}, uri=set_uri, **set_kwargs)
+            self.assertEqual(len(saved), 6)
+        finally:
+            post_save.disconnect(receiver, sender=Group)
+            changes._tracked.pop(Group, None)
+
+        # Large sets are updated and deleted in chunks
+        view = BulkResource.as_view(
+            api=api_v1, model=Group, use_bulk_update=True, set_chunk_size=2)
+        # Two SELECT, UPDATE and SELECT queries each
+        with self.assertNumQueries(6 + savepoints):
+            response, data = request(
+                'patch', {'name': 'Chunk'}, uri=set_uri, **set_kwargs)
+        self.assertEqual(
+            [obj['name'] for obj in data['objects']], ['Chunk'] * 3)
+
+        view = BulkResource.as_view(
+            api=api_v1, model=Group, max_bulk_objects=2)
+        for method in ('patch', 'delete'):
+            response, data = request(
+                method, {'name': 'Large'}, uri=set_uri, **set_kwargs)
+            self.assertEqual(response.status_code, 413)
+        self.assertEqual(Group.objects.filter(pk__in=pks).count(), 3)
+
+        view = BulkResource.as_view(
+            api=api_v1, model=Group, set_chunk_size=2)
+        response, data = request(
+            'delete', None, uri=set_uri + '0;/', request_type='set',
+            pks=set_kwargs['pks'] + ';0')
+        self.assertEqual(response.status_code, 404)
+
+        response, data = request('delete', None, uri=set_uri, **set_kwargs)
+        self.assertEqual(response.status_code, 204)
+        self.assertEqual(Group.objects.filter(pk__in=pks).count(), 0)
+
+        response = view(
+            factory.options('/api/v1/group/'), request_type='set', pks='1')
+        self.assertEqual(
+            response['Allow'], 'DELETE, GET, HEAD, OPTIONS, PATCH, PUT')
+
+    def test_export(self):
+        expected = [
+            obj for obj in self.get_json('/api/v1/person/?limit=1000')[
+                'objects'] if obj['given_name'].endswith('1')]
+        expected.sort(key=lambda obj: obj['__pk__'])
+        self.assertEqual(len(expected), 10)
+
+        for values_fast_path in (False, True):
+            view = Resource.as_view(
+                api=api_v1,
+                model=Person,
+                queryset=Person.objects.filter(given_name__endswith='1'),
+                export_chunk_size=3,
+                values_fast_path=values_fast_path,
+                values_str='{given_name} {family_name}')
+
+            # Four chunks, the last one is incomplete
+            with self.assertNumQueries(4):
+                response = view(
+                    RequestFactory().get('/api/v1/person/export/'),
+                    request_type='export')
+                content = b''.join(response.streaming_content)
+
+            self.assertEqual(
+                response['Content-Type'],
+                'application/x-ndjson; charset=utf-8')
+            lines = content.decode('utf-8').split('\n')
+            self.assertEqual(lines[-1], '')
+            self.assertEqual(
+                [json.loads(line) for line in lines[:-1]], expected)
+
+        api = API('export')
+        api.register(Person, export=True)
+        api.register(Group)
+        self.assertEqual(
+            [pattern.name for pattern in api.resources[0]['urlpatterns']],
+            ['export_testapp_person_list', 'export_testapp_person_detail',
+             'export_testapp_person_set', 'export_testapp_person_export'])
+        self.assertEqual(len(api.resources[1]['urlpatterns']), 3)
+
+    def test_changes(self):
+        options = {'changes_field': 'created', 'changes_limit': 40}
+        now = datetime.now()
+        for idx, person in enumerate(Person.objects.order_by('pk')):
+            # Two objects share every timestamp
+            Person.objects.filter(pk=person.pk).update(
+                created=now - timedelta(seconds=100 - idx // 2))
+
+        def get(uri, **kwargs):
+            return self.get_view_json(
+                uri, 'changes', **dict(options, **kwargs))
+
+        def sync(uri):
+            pks = []
+            while True:
+                data = get(uri)
+                pks.extend(obj['__pk__'] for obj in data['objects'])
+                uri = data['meta']['next']
+                if not data['meta']['more']:
+                    return pks, data
+
+        expected = list(Person.objects.order_by(
+            'created', 'pk').values_list('pk', flat=True))
+        pks, data = sync('/api/v1/person/changes/')
+        self.assertEqual(pks, expected)
+        self.assertEqual(data['deleted'], [])
+        cursor = data['meta']['cursor']
+
+        # Nothing changed
+        data = get('/api/v1/person/changes/?since=%s' % cursor)
+        self.assertEqual(data['objects'], [])
+        self.assertEqual(data['meta']['cursor'], cursor)
+
+        changes.track_deletions([Person])
+        try:
+            first, second, third = Person.objects.order_by('pk')[:3]
+            second_pk, third_pk = second.pk, third.pk
+            first.given_name = 'Changed'
+            first.created = now
+            first.save()
+            second.delete()
+            Group.objects.create(name='Untracked').delete()
+
+            with self.assertNumQueries(2):
+                data = get('/api/v1/person/changes/?since=%s' % cursor)
+            self.assertEqual(
+                [obj['given_name'] for obj in data['objects']], ['Changed'])
+            self.assertEqual(data['deleted'], [{
+                '__pk__': second_pk,
+                '__uri__': 'http://testserver' + api_reverse(
+                    Person, 'detail', api_name='v1', pk=second_pk),
+            }])
+
+            # The new cursor includes the deletion
+            third.delete()
+            data = get('/api/v1/person/changes/?since=%s' % (
+                data['meta']['cursor']))
+            self.assertEqual(data['objects'], [])
+            self.assertEqual(
+                [obj['__pk__'] for obj in data['deleted']], [third_pk])
+
+            # Deletions are paginated as well
+            for person in Person.objects.order_by('-pk')[:50]:
+                person.delete()
+            data = get('/api/v1/person/changes/?since=%s&limit=10' % cursor)
+            self.assertEqual(len(data['deleted']), 10)
+            self.assertTrue(data['meta']['more'])
+
+            # Deletions are only reported with a matching discriminator
+            changes.track_deletions([Person], discriminator='family_name')
+            person = Person.objects.exclude(pk=first.pk).order_by('pk')[0]
+            person_pk, family_name = person.pk, person.family_name
+            person.delete()
+            for discriminator, expected in (
+                    (family_name, [person_pk]), ('Other', [])):
+                data = get(
+                    '/api/v1/person/changes/?since=%s' % cursor,
+                    get_changes_discriminator=lambda: discriminator)
+                self.assertEqual(
+                    [obj['__pk__'] for obj in data['deleted']], expected)
+
+            # Deletions are reported without URIs by non-canonical resources
+            data = get(
+                '/api/other/person/changes/?since=%s' % cursor,
+                api=API('other'))
+            self.assertTrue(data['deleted'])
+            self.assertEqual(
+                set(obj['__uri__'] for obj in data['deleted']), set([None]))
+        finally:
+            changes._tracked.pop(Person, None)
+
+        for since in ('garbage', 'bnVsbA', cursor[:-2],
+                      encode_cursor([0, 'abc', 1]), encode_cursor([0, 1])):
+            data = get(
+                '/api/v1/person/changes/?since=%s' % since, status_code=400)
+            self.assertEqual(data['error'], 'Invalid cursor')
+
+        # Filters are applied
+        options['apply_filters'] = lambda queryset: queryset.filter(
+            given_name='Changed')
+        pks, data = sync('/api/v1/person/changes/?since=%s' % cursor)
+        self.assertEqual(pks, [first.pk])
+
+        with self.assertRaises(ImproperlyConfigured):
+            API('test').register(Person, changes=True)
+
+        # Multi-tenant resources would never report deletions otherwise
+        with self.assertRaises(ImproperlyConfigured):
+            mt_api.Resource(
+                api=api_v1, model=Person,
+                changes_field='created').get_changes_discriminator()
+
+    def test_batch(self):
+        person = Person.objects.order_by('pk')[0]
+        emailaddress = person.emailaddress_set.get()
+        person_uri = api_reverse(Person, 'detail', api_name='v1', pk=person.pk)
+
+        def post(operations, **kwargs):
+            response = batch(
+                RequestFactory().post(
+                    '/api/v1/batch/', json.dumps(operations),
+                    'application/json', HTTP_ACCEPT='application/json',
+                    **kwargs),
+                api=api_v1)
+            content = response.content
+            if response.has_header('Content-Encoding'):
+                content = zlib.decompress(content, 16 + zlib.MAX_WBITS)
+            return response, json.loads(content.decode('utf-8'))
+
+        response, data = post([
+            {'path': person_uri},
+            {'method': 'get', 'path': '/api/v1/person/?limit=2&fields=id'},
+            {'method': 'POST', 'path': '/api/v1/message/', 'body': {
+                'message': 'Hello', 'sent_to': emailaddress.pk}},
+            {'method': 'POST', 'path': '/api/v1/message/', 'body': {}},
+            {'path': '/api/v1/info/?hello=world'},
+            {'path': '/api/v1/nothing/'},
+            {'path': '/admin/'},
+            {'path': '/api/v1/batch/'},
+            {'method': 'OPTIONS', 'path': '/api/v1/person/'},
+            'Bla',
+        ])
+        self.assertEqual(response.status_code, 200)
+        responses = data['responses']
+        self.assertEqual(
+            [item['status'] for item in responses],
+            [200, 200, 201, 400, 200, 404, 404, 404, 200, 400])
+        self.assertEqual(responses[0]['body'], self.get_json(person_uri))
+        self.assertEqual(
+            responses[1]['body'],
+            self.get_json('/api/v1/person/?limit=2&fields=id'))
+        self.assertEqual(responses[2]['body']['message'], 'Hello')
+        self.assertEqual(Message.objects.get().message, 'Hello')
+        self.assertEqual(
+            responses[3]['body']['form']['message'],
+            ['This field is required.'])
+        self.assertEqual(responses[4]['body']['data'], {})
+        self.assertEqual(responses[4]['body']['method'], 'GET')
+        self.assertEqual(
+            responses[8]['headers']['Allow'], 'GET, HEAD, OPTIONS')
+
+        # Sub-responses are never compressed
+        with self.settings(TOWEL_API_COMPRESSION=('gzip',)):
+            response, data = post(
+                [{'path': '/api/v1/person/?limit=50'}],
+                HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(
+            data['responses'][0]['body'],
+            self.get_json('/api/v1/person/?limit=50'))
+        self.assertNotIn('Content-Encoding', data['responses'][0]['headers'])
+
+        response, data = post({'path': person_uri})
+        self.assertEqual(response.status_code, 400)
+
+        with self.settings(TOWEL_API_BATCH_MAX_REQUESTS=2):
+            response, data = post([{'path': person_uri}] * 3)
+        self.assertEqual(response.status_code, 413)
+
+        # Consecutive GET requests run concurrently outside transactions.
+        # The in-memory test database is not available in other threads,
+        # therefore only views not using the database are requested here.
+        in_transaction = batch_module._in_transaction
+        batch_module._in_transaction = lambda: False
+        try:
+            with self.settings(TOWEL_API_BATCH_WORKERS=2):
+                response, data = post([
+                    {'path': '/api/v1/info/?idx=%s' % idx}
+                    for idx in range(5)])
+                self.assertEqual(
+                    [item['body']['method'] for item in data['responses']],
+                    ['GET'] * 5)
+
+                # Requests following writes run in this thread
+                response, data = post([
+                    {'method': 'POST', 'path': '/api/v1/message/', 'body': {
+                        'message': 'Again', 'sent_to': emailaddress.pk}},
+                    {'path': '/api/v1/message/'},
+                    {'path': '/api/v1/message/'},
+                ])
+                self.assertEqual(
+                    [item['status'] for item in data['responses']],
+                    [201, 200, 200])
+        finally:
+            batch_module._in_transaction = in_transaction
+
+        # Requests inside transactions never run concurrently
+        get_pool = batch_module._get_pool
+        batch_module._get_pool = None
+        try:
+            with self.settings(TOWEL_API_BATCH_WORKERS=2):
+                response, data = post([{'path': person_uri}] * 2)
+            self.assertEqual(
+                [item['status'] for item in data['responses']], [200, 200])
+        finally:
+            batch_module._get_pool = get_pool
+
+    def test_token_auth(self):
+        user = User.objects.create_user('test', 'test@example.com', 'test')
+        token = Token.objects.create(user=user, key='secret')
+        view = token_auth(lambda request: HttpResponse(request.user.username))
+
+        def get(authorization):
+            request = RequestFactory().get(
+                '/api/v1/', HTTP_AUTHORIZATION=authorization)
+            request.user = AnonymousUser()
+            return view(request)
+
+        with self.assertNumQueries(1):
+            response = get('Token secret')
+        self.assertEqual(response.content, b'test')
+        self.assertEqual(response['Vary'], 'Authorization')
+
+        # The second lookup only loads the user, the cache does not contain
+        # the password hash
+        with self.assertNumQueries(1):
+            self.assertEqual(get('Bearer secret').content, b'test')
+        self.assertEqual(
+            cache.get(decorators._cache_key('token', 'secret')), user.pk)
+
+        self.assertEqual(get('Token wrong').content, b'')
+        self.assertEqual(get('Basic secret').content, b'')
+
+        token.delete()
+        self.assertEqual(get('Token secret').content, b'')
+
+        user.is_active = False
+        user.save()
+        Token.objects.create(user=user, key='secret')
+        self.assertEqual(get('Token secret').content, b'')
+
+        # Tokens are invalidated even if this process never looked them up
+        key = decorators._cache_key('token', 'other')
+        cache.set(key, user.pk)
+        Token.objects.create(user=user, key='other')
+        self.assertIsNone(cache.get(key))
+
+    def test_http_basic_auth(self):
+        user = User.objects.create_user('test', 'test@example.com', 'test')
+        view = http_basic_auth(
+            lambda request: HttpResponse(request.user.username))
+
+        def get(credentials):
+            request = RequestFactory().get(
+                '/api/v1/', HTTP_AUTHORIZATION='Basic %s' % (
+                    base64.b64encode(credentials).decode('ascii')))
+            request.user = AnonymousUser()
+            return view(request)
+
+        self.assertEqual(get(b'test:test').content, b'test')
+        self.assertEqual(get(b'test:wrong').content, b'')
+
+        request = RequestFactory().get(
+            '/api/v1/', HTTP_AUTHORIZATION='Basic a')
+        self.assertEqual(view(request).status_code, 400)
+
+        with self.settings(TOWEL_API_BASIC_AUTH_CACHE_TIMEOUT=60):
+            self.assertEqual(get(b'test:test').content, b'test')
+
+            # Cached verifications only load the user
+            with self.assertNumQueries(1):
+                self.assertEqual(get(b'test:test').content, b'test')
+
+            # The password hash is not cached
+            key = decorators._cache_key('basic-auth', 'test:test')
+            self.assertNotIn(user.password, cache.get(key))
+
+            user.set_password('changed')
+            user.save()
+            self.assertEqual(get(b'test:test').content, b'')
+            self.assertEqual(get(b'test:changed').content, b'test')
+
+    def test_rate_limit(self):
+        cache.clear()
+        user = User.objects.create_user('test', 'test@example.com', 'test')
+
+        @rate_limit(requests=2, period=60)
+        def view(request):
+            return HttpResponse('ok')
+
+        def get(user=None, view=view):
+            request = RequestFactory().get(
+                '/api/v1/', HTTP_ACCEPT='application/json')
+            request.user = user or AnonymousUser()
+            return view(request)
+
+        self.assertEqual(get().status_code, 200)
+        self.assertEqual(get().status_code, 200)
+        response = get()
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response['Retry-After'], '30')
+        self.assertEqual(
+            json.loads(response.content.decode('utf-8')),
+            {'error': 'Too many requests'})
+
+        # Every client has its own bucket
+        self.assertEqual(get(user).status_code, 200)
+
+        @rate_limit(concurrent=1)
+        def nested(request):
+            # The nested request is processed while the outer request is
+            # still in flight
+            return HttpResponse(nested(request).status_code)
+
+        response = get(view=nested)
+        self.assertEqual(response.content, b'429')
+        self.assertEqual(get(view=nested).content, b'429')
+
+        # Requests rejected because of concurrency do not take tokens
+        @rate_limit(requests=2, period=60, concurrent=1)
+        def both(request):
+            return HttpResponse(both(request).status_code)
+
+        cache.clear()
+        self.assertEqual(get(user, view=both).content, b'429')
+        self.assertEqual(get(user, view=both).content, b'429')
+        self.assertEqual(get(user, view=both).status_code, 429)
+
+        # 429 responses use the passed JSON backend
+        class Backend(JSONBackend):
+            def dumps(self, data):
+                return super(Backend, self).dumps(dict(data, custom=True))
+
+        limited = rate_limit(requests=1, json_backend=Backend())(
+            lambda request: HttpResponse('ok'))
+        cache.clear()
+        get(view=limited)
+        self.assertEqual(
+            json.loads(get(view=limited).content.decode('utf-8')),
+            {'error': 'Too many requests', 'custom': True})
+
+        unlimited = rate_limit(requests=1, key=lambda request: None)(
+            lambda request: HttpResponse('ok'))
+        for i in range(3):
+            self.assertEqual(get(view=unlimited).status_code, 200)
+
+    def test_formats(self):
+        person = Person.objects.create(family_name='Muster')
+        uri = api_reverse(Person, 'detail', api_name='v1', pk=person.pk)
+        reference = self.get_json(uri)
+
+        response = self.client.get(uri + '?format=xml')
+        self.assertEqual(response.status_code, 406)
+
+        formats.register_format(
+            'text', 'text/plain', dumps=lambda data: ','.join(sorted(data)))
+        try:
+            response = self.client.get(uri, HTTP_ACCEPT='text/plain')
+            self.assertEqual(response['Content-Type'], 'text/plain')
+            self.assertEqual(
+                response.content.decode('utf-8'),
+                ','.join(sorted(reference)))
+
+            # Formats without loads are not accepted as request bodies
+            response = self.client.post(
+                '/api/v1/message/', 'message', 'text/plain',
+                HTTP_ACCEPT='application/json')
+            self.assertEqual(response.status_code, 415)
+        finally:
+            formats.unregister_format('text')
+
+        self.assertEqual(formats.get_format('text/plain'), None)
+        self.assertEqual(
+            formats.get_format('application/json; charset=utf-8').name,
+            'json')
+
+        # JSON is preferred when the client accepts anything
+        response = self.client.get(uri, HTTP_ACCEPT='*/*')
+        self.assertEqual(response['Content-Type'], 'application/json')
+
+    @unittest.skipUnless(
+        formats.get_format('msgpack'), 'msgpack is not installed')
+    def test_msgpack(self):
+        import msgpack
+
+        person = Person.objects.create(family_name='Muster')
+        emailaddress = person.emailaddress_set.create(email='test@example.com')
+        uri = api_reverse(Person, 'detail', api_name='v1', pk=person.pk)
+
+        response = self.client.get(uri, HTTP_ACCEPT='application/msgpack')
+        self.assertEqual(response['Content-Type'], 'application/msgpack')
+        data = msgpack.unpackb(response.content, raw=False)
+        self.assertEqual(data, self.get_json(uri))
+
+        # Field names and values are not binary data, on Python 2 neither
+        for key, value in data.items():
+            self.assertTrue(isinstance(key, six.text_type))
+            if not isinstance(value, (six.integer_types, dict)):
+                self.assertTrue(isinstance(value, six.text_type), value)
+
+        response = self.client.get(
+            '/api/v1/person/', HTTP_ACCEPT='application/vnd.msgpack')
+        self.assertEqual(
+            msgpack.unpackb(response.content, raw=False),
+            self.get_json('/api/v1/person/'))
+
+        response = self.client.post(
+            '/api/v1/message/',
+            msgpack.packb({'message': 'Bla', 'sent_to': emailaddress.pk}),
+            'application/x-msgpack',
+            HTTP_ACCEPT='application/msgpack')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(Message.objects.get().message, 'Bla')
+
+    @unittest.skipUnless(formats.get_format('cbor'), 'cbor2 is not installed')
+    def test_cbor(self):
+        import cbor2
+
+        person = Person.objects.create(family_name='Muster')
+        emailaddress = person.emailaddress_set.create(email='test@example.com')
+        uri = api_reverse(Person, 'detail', api_name='v1', pk=person.pk)
+
+        response = self.client.get(uri + '?format=cbor')
+        self.assertEqual(response['Content-Type'], 'application/cbor')
+        data = cbor2.loads(response.content)
+        self.assertEqual(data['__pk__'], person.pk)
+        self.assertEqual(data['family_name'], 'Muster')
+        self.assertTrue(all(isinstance(key, six.text_type) for key in data))
+        self.assertTrue(isinstance(data['family_name'], six.text_type))
+        self.assertTrue(isinstance(data['created'], datetime))
+        self.assertEqual(data['__uri__'], self.get_json(uri)['__uri__'])
+
+        # Values encoded like JSON are text as well
+        data = cbor2.loads(formats.get_format('cbor').dumps({
+            'time': time(12, 30)}))
+        self.assertEqual(data, {'time': '12:30:00'})
+        self.assertTrue(isinstance(data['time'], six.text_type))
+
+        # Naive datetimes are localized in the default time zone
+        with self.settings(TIME_ZONE='Europe/Zurich'):
+            data = cbor2.loads(formats.get_format('cbor').dumps({
+                'winter': [datetime(2014, 1, 31, 12, 30)],
+                'summer': datetime(2014, 7, 31, 12, 30),
+            }))
+        self.assertEqual(
+            data['winter'][0].utcoffset(), timedelta(hours=1))
+        self.assertEqual(data['summer'].utcoffset(), timedelta(hours=2))
+
+        response = self.client.post(
+            '/api/v1/message/',
+            cbor2.dumps({'message': 'Bla', 'sent_to': emailaddress.pk}),
+            'application/cbor',
+            HTTP_ACCEPT='application/cbor')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(Message.objects.get().message, 'Bla')
+
+    def test_compression(self):
+        def get(uri, encoding='gzip', **kwargs):
+            return self.client.get(
+                uri, HTTP_ACCEPT='application/json',
+                HTTP_ACCEPT_ENCODING=encoding, **kwargs)
+
+        def gunzip(content):
+            return json.loads(zlib.decompress(
+                content, 16 + zlib.MAX_WBITS).decode('utf-8'))
+
+        expected = self.get_json('/api/v1/person/?limit=50')
+
+        # Disabled by default
+        response = get('/api/v1/person/?limit=50')
+        self.assertFalse(response.has_header('Content-Encoding'))
+        self.assertEqual(response['Vary'], 'Accept')
+
+        with self.settings(TOWEL_API_COMPRESSION=('br', 'gzip')):
+            response = get('/api/v1/person/?limit=50')
+            self.assertEqual(response['Content-Encoding'], 'gzip')
+            self.assertEqual(response['Vary'], 'Accept, Accept-Encoding')
+            self.assertEqual(
+                int(response['Content-Length']), len(response.content))
+            self.assertEqual(gunzip(response.content), expected)
+
+            for encoding in ('', 'gzip;q=0', 'identity', 'deflate'):
+                response = get('/api/v1/person/?limit=50', encoding)
+                self.assertFalse(response.has_header('Content-Encoding'))
+                self.assertEqual(
+                    json.loads(response.content.decode('utf-8')), expected)
+
+            with self.settings(TOWEL_API_COMPRESSION=('gzip',)):
+                self.assertEqual(
+                    get('/api/v1/person/?limit=50', '*')['Content-Encoding'],
+                    'gzip')
+
+            # Short responses are not compressed, and do not vary
+            response = get('/api/v1/person/?limit=1')
+            self.assertFalse(response.has_header('Content-Encoding'))
+            self.assertEqual(response['Vary'], 'Accept')
+
+            # Streamed responses are compressed chunk by chunk
+            response = self.request_view(
+                '/api/v1/person/?limit=50', streaming=True,
+                headers={'HTTP_ACCEPT_ENCODING': 'gzip'})
+            self.assertEqual(response['Content-Encoding'], 'gzip')
+            chunks = list(response.streaming_content)
+            self.assertEqual(gunzip(b''.join(chunks)), expected)
+
+            # Text chunks are encoded before compressing them
+            response = compress_response(
+                RequestFactory().get('/', HTTP_ACCEPT_ENCODING='gzip'),
+                StreamingHttpResponse(['["Gr\xfc', '\xdfe"]']))
+            self.assertEqual(
+                gunzip(b''.join(response.streaming_content)),
+                ['Gr\xfc\xdfe'])
+
+            # Cached responses and validators depend on the content coding
+            view = Resource.as_view(
+                api=api_v1, model=Person, cache_timeout=60,
+                get_version=lambda: (None,))
+            etags = set()
+            for encoding in ('gzip', '', 'gzip'):
+                response = self.request_view(
+                    '/api/v1/person/?limit=50', view=view,
+                    headers={'HTTP_ACCEPT_ENCODING': encoding})
+                etags.add(response['ETag'])
+                self.assertEqual(
+                    response.has_header('Content-Encoding'), bool(encoding))
+            self.assertEqual(len(etags), 2)
+
+    @unittest.skipUnless(
+        'br' in compression.COMPRESSORS, 'brotli is not installed')
+    def test_brotli(self):
+        import brotli
+
+        def get(encoding, **kwargs):
+            return self.request_view(
+                '/api/v1/person/?limit=50',
+                headers={'HTTP_ACCEPT_ENCODING': encoding}, **kwargs)
+
+        expected = self.get_json('/api/v1/person/?limit=50')
+
+        with self.settings(TOWEL_API_COMPRESSION=('br', 'gzip')):
+            for encoding in ('br', '*', 'gzip, deflate, br'):
+                response = get(encoding)
+                self.assertEqual(response['Content-Encoding'], 'br')
+                self.assertEqual(
+                    json.loads(brotli.decompress(
+                        response.content).decode('utf-8')),
+                    expected)
+
+            self.assertEqual(
+                get('gzip, br;q=0.5')['Content-Encoding'], 'gzip')
+
+            response = get('br', streaming=True)
+            self.assertEqual(response['Content-Encoding'], 'br')
+            self.assertEqual(
+                json.loads(brotli.decompress(b''.join(
+                    response.streaming_content)).decode('utf-8')),
+                expected)
+
+        # Preferences are configurable
+        with self.settings(TOWEL_API_COMPRESSION=('gzip', 'br')):
+            self.assertEqual(get('*')['Content-Encoding'], 'gzip')
+            self.assertEqual(get('br')['Content-Encoding'], 'br')
+
+    def test_profiling(self):
+        def get(uri):
+            return self.client.get(uri, HTTP_ACCEPT='application/json')
+
+        self.assertFalse(
+            get('/api/v1/person/').has_header('Server-Timing'))
+
+        profiled = []
+
+        def receiver(sender, **kwargs):
+            profiled.append(kwargs)
+
+        request_profiled.connect(receiver)
+        try:
+            with self.settings(TOWEL_API_PROFILING=True):
+                response = get('/api/v1/person/')
+            self.assertEqual(
+                [part.split(';')[0]
+                    for part in response['Server-Timing'].split(', ')],
+                ['parse', 'serialize', 'handler', 'encode', 'db', 'total'])
+            self.assertTrue('db;dur=' in response['Server-Timing'])
+            self.assertTrue('desc="2 queries"' in response['Server-Timing'])
+
+            self.assertEqual(len(profiled), 1)
+            self.assertEqual(profiled[0]['queries'], 2)
+            self.assertEqual(profiled[0]['response'], response)
+            self.assertTrue(profiled[0]['timings']['total'] > 0)
+            self.assertTrue(
+                profiled[0]['timings']['serialize'] <=
+                profiled[0]['timings']['handler'])
+
+            response = get('/api/v1/person/?profile=%s' % profiling_token())
+            self.assertTrue(response.has_header('Server-Timing'))
+            self.assertEqual(len(profiled), 2)
+
+            response = get('/api/v1/person/?profile=invalid')
+            self.assertFalse(response.has_header('Server-Timing'))
+            self.assertEqual(len(profiled), 2)
+        finally:
+            request_profiled.disconnect(receiver)
+
+        # Queries are not recorded anymore after failing requests either
+        use_debug_cursor = connection.use_debug_cursor
+        with self.settings(TOWEL_API_PROFILING=True):
+            self.assertRaises(
+                ZeroDivisionError,
+                self.request_view,
+                '/api/v1/person/',
+                get_query_set=lambda: 1 / 0)
+        self.assertEqual(connection.use_debug_cursor, use_debug_cursor)
+
+    def test_negotiation(self):
+        supported = Serializer().supported_types
+        self.assertEqual(supported[-1], 'application/json')
+
+        for accept, expected in [
+                ('', ''),
+                ('application/json', 'application/json'),
+                ('*/*', 'application/json'),
+                ('application/*;q=0.5, text/html', 'application/json'),
+                ('text/html,application/xhtml+xml,*/*;q=0.8',
+                    'application/json'),
+                ('text/html', ''),
+        ]:
+            self.assertEqual(negotiate(supported, accept), expected)
+
+        # Results are cached, but not without bounds
+        serializers._negotiated.clear()
+        best_match = serializers.best_match
+        calls = []
+        serializers.best_match = lambda *args: calls.append(args) or ''
+        try:
+            negotiate(supported, '*/*')
+            negotiate(supported, '*/*')
+            self.assertEqual(len(calls), 1)
+
+            for idx in range(serializers.NEGOTIATE_CACHE_SIZE):
+                negotiate(supported, 'text/x-%s' % idx)
+            self.assertEqual(len(serializers._negotiated), 1)
+        finally:
+            serializers.best_match = best_match
+            serializers._negotiated.clear()
+
+    @unittest.skipUnless(
+        os.environ.get('TOWEL_BENCHMARK'), 'Set TOWEL_BENCHMARK to run')
+    def test_negotiation_benchmark(self):
+        from towel.api.mimeparse import best_match
+
+        supported = Serializer().supported_types
+        headers = [
+            'text/html,application/xhtml+xml,application/xml;q=0.9,'
+            'image/webp,*/*;q=0.8',
+            'text/html,application/xhtml+xml,application/xml;q=0.9,'
+            'image/avif,image/webp,image/apng,*/*;q=0.8,'
+            'application/signed-exchange;v=b3;q=0.7',
+            'application/json, text/plain, */*',
+            'application/json',
+            '*/*',
+        ]
+
+        for name, function in [('best_match', best_match),
+                               ('negotiate', negotiate)]:
+            print('negotiate %s Accept headers (%s): %.2fus' % (
+                len(headers),
+                name,
+                min(timeit.repeat(
+                    lambda: [function(supported, h) for h in headers],
+                    number=1000, repeat=3)) * 1000))
+
+    @unittest.skipUnless(
+        os.environ.get('TOWEL_BENCHMARK'), 'Set TOWEL_BENCHMARK to run')
+    def test_values_fast_path_benchmark(self):
+        request = RequestFactory().get(
+            '/api/v1/person/?limit=100', HTTP_ACCEPT='application/json')
+
+        for fast in (False, True):
+            view = Resource.as_view(
+                api=api_v1, model=Person, values_fast_path=fast,
+                values_str='{given_name} {family_name}')
+            print('list 100 persons (values_fast_path=%s): %.2fms' % (
+                fast,
+                min(timeit.repeat(
+                    lambda: view(request, request_type='list'),
+                    number=10, repeat=3)) * 100))
+
+    @unittest.skipUnless(
+        os.environ.get('TOWEL_BENCHMARK'), 'Set TOWEL_BENCHMARK to run')
+    def test_json_backends_benchmark(self):
+        objects = [
+            api_v1.serialize_instance(person)
+            for person in Person.objects.all()] * 10
+        for obj in objects[:100]:
+            obj['decimal'] = Decimal('3.50')
+            obj['lazy'] = ugettext_lazy('unspecified')
+
+        for name, backend in self.available_json_backends():
+            print('encode 1000 objects with %s: %.2fms' % (
+                name,
+                min(timeit.repeat(
+                    lambda: backend.dumps({'objects': objects}),
+                    number=10, repeat=3)) * 100))
+
+    @unittest.skipUnless(
+        os.environ.get('TOWEL_BENCHMARK'), 'Set TOWEL_BENCHMARK to run')
+    def test_serialization_plan_benchmark(self):
+        persons = list(Person.objects.all())
+
+        def planned():
+            for person in persons:
+                api_v1.serialize_instance(person)
+
+        def unplanned():
+            # Introspecting the model for every instance is what
+            # serialize_model_instance did before plans were cached.
+            for person in persons:
+                SerializationPlan(
+                    Person, 'v1', exclude=('is_active',),
+                ).serialize(person, api_v1)
+
+        for name, fn in (('unplanned', unplanned), ('planned', planned)):
+            print('serialize %s x %s: %.2fms per round' % (
+                len(persons), name,
+                min(timeit.repeat(fn, number=10, repeat=3)) * 100))
@@ -1,7 +1,7 @@
 # flake8: noqa
 from .api import API, serialize_model_instance
 from .base import APIException, api_reverse
-from .resources import Resource
+from .resources import BulkResource, Resource
 from .serializers import Serializer
 
 # Is that really public API?
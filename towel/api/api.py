@@ -1,17 +1,19 @@
 from __future__ import absolute_import, unicode_literals
 
-from django.core.urlresolvers import NoReverseMatch, reverse
+from functools import partial
+
+from django.core.exceptions import ImproperlyConfigured
+from django.core.urlresolvers import reverse
 from django.conf.urls import patterns, include, url
-from django.db import models
-from django.db.models.related import RelatedObject
 from django.http import HttpResponse
-from django.utils.encoding import force_text
 from django.utils.functional import curry
 from django.utils.six.moves import http_client
 from django.views.decorators.csrf import csrf_exempt
 
 from towel.utils import app_model_label
-from .base import api_reverse
+from .caching import track_models
+from .changes import track_deletions
+from .plans import instance_model, serialization_plan
 from .resources import Resource
 from .serializers import Serializer
 
@@ -64,11 +66,19 @@ class API(object):
         api_v2 = API('v2', decorators=[csrf_exempt, login_required])
 
         # register resources as before
+
+    ``json_backend`` overrides the ``TOWEL_API_JSON_BACKEND`` setting for
+    this API, see :py:mod:`towel.api.json_backends`.
     """
 
-    def __init__(self, name, decorators=[csrf_exempt]):
+    #: Maximum count of root documents cached per API (one per host, scheme
+    #: and script prefix)
+    max_root_documents = 100
+
+    def __init__(self, name, decorators=[csrf_exempt], json_backend=None):
         self.name = name
         self.decorators = decorators
+        self.json_backend = json_backend
 
         self.resources = []
         self.serializers = {}
@@ -76,6 +86,13 @@ class API(object):
 
         self.default_serializer = serialize_model_instance
 
+        self._urls = None
+        self._root_documents = {}
+
+    def _registry_changed(self):
+        self._urls = None
+        self._root_documents = {}
+
     @property
     def urls(self):
         """
@@ -88,7 +105,12 @@ class API(object):
             urlpatterns = patterns('',
                 url(r'^api/v1/', include(api_v1.urls)),
             )
+
+        The URL patterns are only built once; registering resources or
+        views later rebuilds them.
         """
+        if self._urls is not None:
+            return self._urls
 
         def view(request):
             return self.root(request)
@@ -108,7 +130,8 @@ class API(object):
                 include(resource['urlpatterns']),
             ))
 
-        return patterns('', *urlpatterns)
+        self._urls = patterns('', *urlpatterns)
+        return self._urls
 
     def root(self, request):
         """
@@ -121,7 +144,7 @@ class API(object):
             return response
 
         elif request.method not in ('GET', 'HEAD'):
-            return Serializer().serialize(
+            return Serializer(json_backend=self.json_backend).serialize(
                 {
                     'error': 'Not acceptable',
                 },
@@ -130,10 +153,26 @@ class API(object):
                 output_format=request.GET.get('format'),
             )
 
+        return Serializer(json_backend=self.json_backend).serialize(
+            self.root_document(request),
+            request=request,
+            output_format=request.GET.get('format'))
+
+    def root_document(self, request):
+        """
+        Returns the list of resources and views returned by ``root``. The
+        document only depends on the absolute URI of the API root, it is
+        therefore built once per scheme, host and script prefix.
+        """
+        root_uri = request.build_absolute_uri(reverse('api_%s' % self.name))
+        try:
+            return self._root_documents[root_uri]
+        except KeyError:
+            pass
+
         response = {
             '__str__': self.name,
-            '__uri__': request.build_absolute_uri(
-                reverse('api_%s' % self.name)),
+            '__uri__': root_uri,
             'resources': [],
         }
 
@@ -157,14 +196,15 @@ class API(object):
             if resource['canonical']:
                 response[resource['model'].__name__.lower()] = r
 
-        return Serializer().serialize(
-            response,
-            request=request,
-            output_format=request.GET.get('format'))
+        if len(self._root_documents) >= self.max_root_documents:
+            # The host is controlled by clients, do not grow without bounds
+            self._root_documents.clear()
+        self._root_documents[root_uri] = response
+        return response
 
     def register(self, model, view_class=None, canonical=True,
                  decorators=None, prefix=None, view_init=None,
-                 serializer=None):
+                 serializer=None, export=False, changes=False):
         """
         Registers another resource on this API. The sole required argument is
         the Django model which should be exposed. The other arguments are:
@@ -191,6 +231,14 @@ class API(object):
           instance and additional keyword arguments (accept ``**kwargs`` for
           forward compatibility) and returns the serialized representation as
           a Python dict.
+        - ``export``: Whether an ``export/`` endpoint streaming all objects
+          as newline delimited JSON should be added, see
+          ``Resource.get_export``.
+        - ``changes``: Whether a ``changes/`` endpoint returning objects
+          changed since a cursor should be added, see
+          ``Resource.get_changes``. Requires ``changes_field`` to be set on
+          the view class or in ``view_init``. Deletions are recorded if the
+          ``TOWEL_API_TOMBSTONE_MODEL`` setting is set.
         """
 
         view_class = view_class or Resource
@@ -202,6 +250,12 @@ class API(object):
             else:
                 view_init['model'] = model
 
+        if changes and not view_init.get(
+                'changes_field', view_class.changes_field):
+            raise ImproperlyConfigured(
+                'Change feeds require a changes_field for %s.%s' % (
+                    app_model_label(model)))
+
         view = view_class.as_view(api=self, **view_init)
 
         name = lambda ident: None
@@ -222,13 +276,34 @@ class API(object):
             'prefix': prefix or r'^%s/' % model.__name__.lower(),
             'urlpatterns': patterns('', *[
                 url(regex, view, data, name=name(suffix))
-                for regex, suffix, data in view_class.urls
+                for regex, suffix, data in (
+                    list(view_class.urls)
+                    + (list(view_class.export_urls) if export else [])
+                    + (list(view_class.changes_urls) if changes else []))
             ]),
         })
 
+        self._registry_changed()
+
+        if changes:
+            track_deletions(
+                [view_init['model']],
+                discriminator=view_init.get(
+                    'changes_discriminator',
+                    view_class.changes_discriminator))
+
         if serializer:
             self.serializers[model] = serializer
 
+        if getattr(view_class, 'cache_timeout', None) or view_init.get(
+                'cache_timeout'):
+            # Start tracking writes now, not only when the first request
+            # arrives. Models inlined with ?full=1 are included as well.
+            track_models(
+                set([view_init['model']])
+                | self.inlined_models(view_init['model'])
+                | self.inlined_models(view_init['model'], 1))
+
     def set_default_serializer(self, serializer):
         """
         By default, ``serialize_model_instance`` is used to serialize models.
@@ -245,10 +320,145 @@ class API(object):
         this API.
         """
         serializer = self.serializers.get(
-            instance.__class__,
+            instance_model(instance),
             self.default_serializer)
         return serializer(instance, api=self, **kwargs)
 
+    def _serializer_options(self, model):
+        """
+        Returns the keyword arguments bound to the serializer of ``model`` if
+        it is ``serialize_model_instance`` or a ``functools.partial``
+        thereof, ``None`` otherwise
+        """
+        serializer = self.serializers.get(model, self.default_serializer)
+        options = {}
+        if isinstance(serializer, partial) and not serializer.args:
+            options = serializer.keywords or {}
+            serializer = serializer.func
+
+        if serializer is not serialize_model_instance:
+            return None
+        return options
+
+    def _inline_plan(self, model, inline_depth):
+        """
+        Returns the inlining ``SerializationPlan`` and the effective inline
+        depth for ``model``, or ``(None, 0)`` if nothing is inlined or the
+        serializer cannot be analyzed.
+        """
+        options = self._serializer_options(model)
+        if options is None:
+            return None, 0
+
+        if inline_depth is None:
+            inline_depth = options.get('inline_depth', 0)
+        if inline_depth <= 0:
+            return None, 0
+
+        return serialization_plan(
+            model,
+            self.name,
+            fields=options.get('fields', ()),
+            exclude=options.get('exclude', ()),
+            inline=True,
+        ), inline_depth
+
+    def row_serializer(self, model, sparse_fields=(), sparse_exclude=(),
+                       str_function=None, str_fields=()):
+        """
+        Returns a tuple of column names for ``values_list()`` and a function
+        serializing the resulting rows the same way as the serializer of
+        ``model`` would serialize model instances, except for ``__str__``
+        which is determined by ``str_function`` (see
+        ``SerializationPlan.row_serializer``).
+
+        ``None`` is returned if rows cannot be serialized, that is if the
+        serializer is not ``serialize_model_instance`` (or a
+        ``functools.partial`` binding nothing but ``fields``, ``exclude``
+        and ``only_registered``), inlines objects or if the model's fields
+        are not plain values (see ``SerializationPlan.supports_rows``).
+        """
+        options = self._serializer_options(model)
+        if options is None or options.get('inline_depth', 0) > 0:
+            return None
+        if set(options) - set(['fields', 'exclude', 'only_registered',
+                               'inline_depth']):
+            return None
+
+        plan = serialization_plan(
+            model,
+            self.name,
+            fields=options.get('fields', ()),
+            exclude=options.get('exclude', ()),
+        )
+        if sparse_fields or sparse_exclude:
+            plan = plan.restrict(sparse_fields, sparse_exclude)
+        if not plan.supports_rows():
+            return None
+
+        return plan.row_serializer(
+            str_function=str_function,
+            str_fields=str_fields,
+            only_registered=options.get('only_registered', True))
+
+    def inlined_models(self, model, inline_depth=None):
+        """
+        Returns the set of models whose instances are inlined when
+        serializing instances of ``model``, the same way as
+        ``related_lookups``.
+        """
+        plan, inline_depth = self._inline_plan(model, inline_depth)
+        if plan is None:
+            return set()
+
+        related = set(item[3] for item in plan.foreign_keys)
+        related.update(item[2] for item in plan.relations)
+        for related_model in list(related):
+            related.update(
+                self.inlined_models(related_model, inline_depth - 1))
+        return related
+
+    def related_lookups(self, model, inline_depth=None):
+        """
+        Returns a tuple of ``select_related`` and ``prefetch_related`` lookups
+        which avoid additional queries when serializing instances of ``model``
+        with the passed ``inline_depth``, or with the serializer's own
+        ``inline_depth`` if ``None``.
+
+        Only serializers which are ``serialize_model_instance`` or a
+        ``functools.partial`` thereof can be analyzed, nothing is returned for
+        other serializers.
+        """
+        plan, inline_depth = self._inline_plan(model, inline_depth)
+        if plan is None:
+            return [], []
+
+        select_related, prefetch_related = [], []
+        single = [(name, related) for name, _a, _u, related
+                  in plan.foreign_keys]
+        single.extend(
+            (name, related) for name, multiple, related in plan.relations
+            if not multiple)
+        multiple = [
+            (name, related) for name, multiple, related in plan.relations
+            if multiple]
+
+        for name, related in single:
+            select, prefetch = self.related_lookups(related, inline_depth - 1)
+            select_related.append(name)
+            select_related.extend(
+                '%s__%s' % (name, lookup) for lookup in select)
+            prefetch_related.extend(
+                '%s__%s' % (name, lookup) for lookup in prefetch)
+
+        for name, related in multiple:
+            select, prefetch = self.related_lookups(related, inline_depth - 1)
+            prefetch_related.append(name)
+            prefetch_related.extend(
+                '%s__%s' % (name, lookup) for lookup in select + prefetch)
+
+        return select_related, prefetch_related
+
     def add_view(self, view, prefix=None, decorators=None):
         """
         Add custom views to this API
@@ -273,11 +483,13 @@ class API(object):
             'prefix': prefix,
             'view': view,
         })
+        self._registry_changed()
 
 
 def serialize_model_instance(instance, api, inline_depth=0,
                              fields=(), exclude=(), only_registered=True,
                              build_absolute_uri=lambda uri: uri,
+                             sparse_fields=(), sparse_exclude=(),
                              **kwargs):
     """
     Serializes a single model instance.
@@ -293,6 +505,11 @@ def serialize_model_instance(instance, api, inline_depth=0,
     The ``fields`` and ``exclude`` parameters are especially helpful when used
     together with ``functools.partial``.
 
+    ``sparse_fields`` and ``sparse_exclude`` are the fieldsets requested by
+    the client (``?fields=`` and ``?exclude=``). They can only restrict the
+    output further and never override ``fields`` and ``exclude``. Dotted
+    paths such as ``person.family_name`` are applied to inlined objects.
+
     Set ``only_registered=False`` if you want to serialize models which do not
     have a canonical URI inside this API.
 
@@ -314,109 +531,30 @@ def serialize_model_instance(instance, api, inline_depth=0,
       ``__pretty__`` dictionary for your convenience.
     - The primary key of the model instance is always available as
       ``__pk__``.
+    - The fields of a model are only introspected once for every combination
+      of ``fields``, ``exclude`` and inlining; the resulting
+      :py:class:`~towel.api.plans.SerializationPlan` is cached and reused
+      for all following instances.
     """
 
     # It's not exactly a fatal error, but it helps during development. This
     # statement will disappear in the future.
     assert not kwargs, 'Unknown keyword arguments to serialize_model_instance'
 
-    uri = api_reverse(
-        instance, 'detail', api_name=api.name, pk=instance.pk,
-        fail_silently=True)
-
-    if uri is None and only_registered:
-        return None
-
-    data = {
-        '__uri__': build_absolute_uri(uri),
-        '__str__': force_text(instance),
-        '__pretty__': {},
-        '__pk__': instance.pk,
-    }
-    opts = instance._meta
-
-    for f_name in opts.get_all_field_names():
-        f, model, direct, m2m = opts.get_field_by_name(f_name)
-
-        if fields and f.name not in fields:
-            continue
-
-        if f.name in exclude:
-            continue
-
-        # TODO maybe check before querying the database whether the objects
-        # are included in the API or only_registered=False?
-
-        if isinstance(f, (models.ManyToManyField, RelatedObject)):
-            if inline_depth > 0:
-                is_relobj = isinstance(f, RelatedObject)
-                name = f.get_accessor_name() if is_relobj else f.name
-
-                if is_relobj and not f.field.rel.multiple:
-                    try:
-                        obj = getattr(instance, name)
-                    except models.ObjectDoesNotExist:
-                        obj = None
-
-                    data[name] = api.serialize_instance(
-                        obj,
-                        inline_depth=inline_depth - 1,
-                        build_absolute_uri=build_absolute_uri,
-                        only_registered=only_registered,
-                    ) if obj else None
-                else:
-                    related = [api.serialize_instance(
-                        obj,
-                        inline_depth=inline_depth - 1,
-                        build_absolute_uri=build_absolute_uri,
-                        only_registered=only_registered,
-                    ) for obj in getattr(instance, name).all()]
-                    if any(related):
-                        data[name] = related
-
-        elif f.rel:
-            value = f.value_from_object(instance)
-            if value is None:
-                data[f.name] = None
-                continue
-
-            try:
-                data[f.name] = build_absolute_uri(api_reverse(
-                    f.rel.to,
-                    'detail',
-                    api_name=api.name,
-                    pk=f.value_from_object(instance)))
-            except NoReverseMatch:
-                if only_registered:
-                    continue
-
-            if inline_depth > 0:
-                related = getattr(instance, f.name)
-
-                if related:
-                    # XXX What about only_registered, kwargs? Should they be
-                    # passed to other calls as well, or should we assume that
-                    # customization can only happen using functools.partial
-                    # upon registration time?
-                    data[f.name] = api.serialize_instance(
-                        related,
-                        inline_depth=inline_depth - 1,
-                        build_absolute_uri=build_absolute_uri,
-                        only_registered=only_registered,
-                    )
-
-        elif isinstance(f, models.FileField):
-            try:
-                value = f.value_from_object(instance)
-                data[f.name] = build_absolute_uri(value.url)
-            except ValueError:
-                data[f.name] = ''
-
-        else:
-            data[f.name] = f.value_from_object(instance)
-
-            if f.flatchoices:
-                data['__pretty__'][f.name] = force_text(
-                    dict(f.flatchoices).get(data[f.name], '-'))
-
-    return data
+    plan = serialization_plan(
+        instance_model(instance),
+        api.name,
+        fields=fields,
+        exclude=exclude,
+        inline=inline_depth > 0,
+    )
+    if sparse_fields or sparse_exclude:
+        plan = plan.restrict(sparse_fields, sparse_exclude)
+
+    return plan.serialize(
+        instance,
+        api,
+        inline_depth=inline_depth,
+        only_registered=only_registered,
+        build_absolute_uri=build_absolute_uri,
+    )
@@ -1,7 +1,13 @@
 from __future__ import absolute_import, unicode_literals
 
-from django.core.urlresolvers import NoReverseMatch, reverse
+import re
+from weakref import WeakKeyDictionary
+
+from django.core.urlresolvers import (
+    NoReverseMatch, get_resolver, get_script_prefix, get_urlconf, reverse)
+from django.utils import six
 from django.utils.six.moves import http_client
+from django.utils.translation import get_language
 
 from towel.utils import app_model_label
 
@@ -46,6 +52,68 @@ class APIException(Exception):
         self.data = data
 
 
+#: URI templates of API endpoints, stored per URL resolver instance. URLconf
+#: reloads (``clear_url_caches()``, a changed ``ROOT_URLCONF`` or
+#: ``set_urlconf()``) use a new resolver and therefore start with an empty
+#: cache.
+_uri_templates = WeakKeyDictionary()
+
+#: Marker for URL names which do not exist at all
+_NOT_REGISTERED = object()
+
+_digits_re = re.compile(r'^[0-9]+\Z')
+
+
+def _is_integer(value):
+    if isinstance(value, bool):
+        return False
+    if isinstance(value, six.integer_types):
+        # API URL patterns do not accept a minus sign
+        return value >= 0
+    return isinstance(value, six.string_types) and _digits_re.match(value)
+
+
+def uri_template(name, kwarg_names):
+    """
+    Returns a ``str.format`` template such as ``'/api/v1/person/{pk}/'`` for
+    the URL pattern ``name`` and the keyword arguments ``kwarg_names``.
+
+    ``None`` is returned if no template could be determined (in this case,
+    ``reverse()`` has to be used), ``_NOT_REGISTERED`` if there is no URL
+    pattern with this name at all. Results are cached per URL resolver,
+    script prefix and language.
+    """
+    resolver = get_resolver(get_urlconf())
+    templates = _uri_templates.setdefault(resolver, {})
+    # i18n_patterns prefix URIs with the active language
+    key = (get_script_prefix(), get_language(), name, kwarg_names)
+
+    try:
+        return templates[key]
+    except KeyError:
+        pass
+
+    # Digits are accepted by all API URL patterns. Those placeholders are
+    # then replaced with format fields.
+    placeholders = dict(
+        (kwarg, '9081726354%s' % idx) for idx, kwarg in enumerate(kwarg_names))
+
+    try:
+        uri = reverse(name, kwargs=placeholders)
+    except NoReverseMatch:
+        template = None if name in resolver.reverse_dict else _NOT_REGISTERED
+    else:
+        template = uri.replace('{', '{{').replace('}', '}}')
+        for kwarg, placeholder in placeholders.items():
+            if template.count(placeholder) != 1:
+                template = None
+                break
+            template = template.replace(placeholder, '{%s}' % kwarg)
+
+    templates[key] = template
+    return template
+
+
 def api_reverse(model, ident, api_name='api', fail_silently=False, **kwargs):
     """
     Determines the canonical URL of API endpoints for arbitrary models
@@ -61,12 +129,25 @@ def api_reverse(model, ident, api_name='api', fail_silently=False, **kwargs):
     Passing an instance works too::
 
         api_reverse(instance, 'detail', pk=instance.pk)
+
+    Every URL pattern is only reversed once, following calls substitute
+    integer arguments into a cached URI template. Models not registered with
+    the API are remembered as well.
     """
+    name = '_'.join((api_name,) + app_model_label(model) + (ident,))
+    template = uri_template(name, tuple(sorted(kwargs)))
+
+    if template is _NOT_REGISTERED:
+        if fail_silently:
+            return None
+        raise NoReverseMatch('No API endpoint named %r.' % name)
+
+    if template is not None and all(
+            _is_integer(value) for value in kwargs.values()):
+        return template.format(**kwargs)
+
     try:
-        return reverse(
-            '_'.join(
-                (api_name,) + app_model_label(model) + (ident,)),
-            kwargs=kwargs)
+        return reverse(name, kwargs=kwargs)
     except NoReverseMatch:
         if fail_silently:
             return None
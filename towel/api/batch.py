@@ -0,0 +1,268 @@
+"""
+Batch requests
+==============
+
+The ``batch`` view executes several API requests at once, saving the
+overhead of separate HTTP requests (middleware, authentication, latency).
+Add it to an API using ``add_view``::
+
+    from towel.api.batch import batch
+
+    api_v1.add_view(batch)
+
+The view accepts a ``POST`` request containing a JSON array of requests::
+
+    [
+        {"method": "GET", "path": "/api/v1/person/?limit=5"},
+        {"method": "POST", "path": "/api/v1/message/",
+         "body": {"message": "Hello", "sent_to": 3}}
+    ]
+
+``method`` defaults to ``GET``, ``body`` is sent as JSON. Only paths below
+the API's root URI are accepted. Requests are processed in order; the
+response contains a list ``responses`` with ``status``, ``headers`` and the
+parsed ``body`` of every request.
+
+The following settings are available:
+
+- ``TOWEL_API_BATCH_MAX_REQUESTS``: Maximum count of requests in a batch,
+  defaults to 50.
+- ``TOWEL_API_BATCH_WORKERS``: If larger than zero, consecutive ``GET`` and
+  ``HEAD`` requests are executed concurrently using a thread pool of this
+  size. Defaults to ``0``. Worker threads use their own database
+  connections and would not see uncommitted writes, requests are therefore
+  executed one after another inside transactions (e.g. with
+  ``ATOMIC_REQUESTS``) and after the first request which is neither
+  ``GET`` nor ``HEAD``.
+"""
+
+from __future__ import absolute_import, unicode_literals
+
+import copy
+from multiprocessing.pool import ThreadPool
+import threading
+
+from django.conf import settings
+from django.core.urlresolvers import (
+    Resolver404, get_script_prefix, get_urlconf, resolve, reverse,
+    set_script_prefix, set_urlconf)
+from django.db import connections
+from django.http import QueryDict
+from django.utils import translation
+from django.utils.encoding import force_bytes, force_text
+from django.utils.six.moves import http_client
+
+try:
+    from django.db import close_old_connections
+except ImportError:  # Django < 1.6
+    from django.db import close_connection as close_old_connections
+
+from .json_backends import get_json_backend
+from .parsers import RequestParser
+from .serializers import Serializer
+
+
+#: HTTP methods accepted for batched requests
+METHODS = ('GET', 'HEAD', 'POST', 'PUT', 'PATCH', 'DELETE', 'OPTIONS')
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _get_pool(workers):
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPool(workers)
+        return _pool
+
+
+def _in_transaction():
+    for connection in connections.all():
+        if not hasattr(connection, 'in_atomic_block'):  # Django < 1.6
+            if connection.is_managed():
+                return True
+        elif connection.in_atomic_block:
+            return True
+    return False
+
+
+def _error(status, message):
+    return {
+        'status': status,
+        'headers': {},
+        'body': {'error': message},
+    }
+
+
+def build_request(request, method, path, body=b''):
+    """
+    Returns a copy of ``request`` for executing ``method`` on ``path``
+    (which may contain a querystring). The copy shares the user and session
+    with ``request``; authentication is therefore not repeated.
+    """
+    path, _sep, query = path.partition('?')
+    prefix = get_script_prefix()
+    path_info = '/' + path[len(prefix):]
+
+    subrequest = copy.copy(request)
+    subrequest.method = method
+    subrequest.path = path
+    subrequest.path_info = path_info
+    # Sub-responses are embedded in the batch response and must neither be
+    # conditional nor compressed
+    subrequest.META = dict(
+        (key, value) for key, value in request.META.items()
+        if not key.startswith('HTTP_IF_') and key != 'HTTP_ACCEPT_ENCODING')
+    subrequest.META.update({
+        'REQUEST_METHOD': method,
+        'PATH_INFO': path_info,
+        'QUERY_STRING': query,
+        'HTTP_ACCEPT': 'application/json',
+        'CONTENT_TYPE': 'application/json',
+        'CONTENT_LENGTH': str(len(body)),
+    })
+    subrequest.GET = QueryDict(query)
+    subrequest._body = body
+    for attr in ('_post', '_files', '_stream'):
+        subrequest.__dict__.pop(attr, None)
+    return subrequest
+
+
+def execute(request, operation, api_root, json_backend):
+    """
+    Executes a single batched request and returns its result
+    """
+    if not isinstance(operation, dict):
+        return _error(http_client.BAD_REQUEST, 'Expected an object.')
+
+    method = force_text(operation.get('method', 'GET')).upper()
+    path = force_text(operation.get('path', ''))
+    if method not in METHODS:
+        return _error(
+            http_client.METHOD_NOT_ALLOWED, 'Method not allowed')
+    if not path.startswith(api_root) or path.split('?')[0] == request.path:
+        return _error(http_client.NOT_FOUND, 'Not found')
+
+    body = b''
+    if operation.get('body') is not None:
+        body = force_bytes(json_backend.dumps(operation['body']))
+
+    subrequest = build_request(request, method, path, body)
+    try:
+        match = resolve(
+            subrequest.path_info, getattr(request, 'urlconf', None))
+    except Resolver404:
+        return _error(http_client.NOT_FOUND, 'Not found')
+
+    subrequest.resolver_match = match
+    response = match.func(subrequest, *match.args, **match.kwargs)
+
+    if response.streaming:
+        content = b''.join(response.streaming_content)
+    else:
+        content = response.content
+
+    content_type = response.get('Content-Type', '')
+    if not content:
+        body = None
+    elif content_type.startswith('application/json'):
+        body = json_backend.loads(content.decode('utf-8'))
+    else:
+        body = content.decode(
+            getattr(response, 'charset', settings.DEFAULT_CHARSET))
+
+    return {
+        'status': response.status_code,
+        'headers': dict(
+            (key, value) for key, value in response.items()
+            if key != 'Content-Length'),
+        'body': body,
+    }
+
+
+def batch(request, api):
+    """
+    Executes a list of API requests, see the module docstring
+    """
+    json_backend = get_json_backend(api.json_backend)
+    serializer = Serializer(json_backend=api.json_backend)
+
+    if request.method != 'POST':
+        return serializer.serialize(
+            {'error': 'Method not allowed'},
+            request=request,
+            status=http_client.METHOD_NOT_ALLOWED,
+            output_format=request.GET.get('format'))
+
+    response = RequestParser(json_backend=api.json_backend).parse(request)
+    if response:
+        return response
+
+    operations = request.POST
+    max_requests = getattr(settings, 'TOWEL_API_BATCH_MAX_REQUESTS', 50)
+    if not isinstance(operations, list):
+        return serializer.serialize(
+            {'error': 'Expected a list of requests.'},
+            request=request,
+            status=http_client.BAD_REQUEST,
+            output_format=request.GET.get('format'))
+    if len(operations) > max_requests:
+        return serializer.serialize(
+            {'error': 'Too many requests, at most %s are allowed.' % (
+                max_requests)},
+            request=request,
+            status=http_client.REQUEST_ENTITY_TOO_LARGE,
+            output_format=request.GET.get('format'))
+
+    api_root = reverse('api_%s' % api.name)
+    workers = getattr(settings, 'TOWEL_API_BATCH_WORKERS', 0)
+    if _in_transaction():
+        workers = 0
+    results = [None] * len(operations)
+    pending = []
+
+    # The script prefix, URLconf and the active language are thread local
+    prefix = get_script_prefix()
+    urlconf = get_urlconf()
+    language = translation.get_language()
+
+    def run_in_thread(idx):
+        set_script_prefix(prefix)
+        set_urlconf(urlconf)
+        translation.activate(language)
+        try:
+            return execute(request, operations[idx], api_root, json_backend)
+        finally:
+            translation.deactivate()
+            set_urlconf(None)
+            close_old_connections()
+
+    def flush():
+        if len(pending) > 1:
+            for idx, result in zip(
+                    pending, _get_pool(workers).map(run_in_thread, pending)):
+                results[idx] = result
+        elif pending:
+            results[pending[0]] = execute(
+                request, operations[pending[0]], api_root, json_backend)
+        del pending[:]
+
+    for idx, operation in enumerate(operations):
+        safe = isinstance(operation, dict) and force_text(
+            operation.get('method', 'GET')).upper() in ('GET', 'HEAD')
+        if workers > 0 and safe:
+            pending.append(idx)
+            continue
+
+        flush()
+        results[idx] = execute(request, operation, api_root, json_backend)
+        if not safe:
+            # Later requests have to see the (uncommitted) writes
+            workers = 0
+    flush()
+
+    return serializer.serialize(
+        {'responses': results},
+        request=request,
+        output_format=request.GET.get('format'))
@@ -0,0 +1,93 @@
+"""
+Response caching
+================
+
+Cached API responses are invalidated using per-model generation counters
+instead of deleting cache entries: The generations of all models a response
+depends upon are part of its cache key. Saving or deleting an instance of
+such a model increments its generation, and following requests use a new
+cache key. Old entries expire by themselves.
+
+Only models passed to :py:func:`track_models` are considered by the signal
+handlers, all other writes do not touch the cache at all.
+"""
+
+from __future__ import absolute_import, unicode_literals
+
+import time
+
+from django.core.cache import cache
+from django.db.models.signals import m2m_changed, post_delete, post_save
+
+from towel.utils import app_model_label
+
+
+#: Models whose writes increment their generation
+_tracked = set()
+
+
+def _concrete(model):
+    return getattr(model._meta, 'concrete_model', None) or model
+
+
+def generation_key(model):
+    return 'towel-api-generation:%s.%s' % app_model_label(_concrete(model))
+
+
+def track_models(models):
+    """
+    Makes saves and deletions of instances of the passed models increment
+    the models' generations
+    """
+    _tracked.update(_concrete(model) for model in models)
+
+
+def get_generations(models):
+    """
+    Returns a tuple containing the current generations of the passed models
+    """
+    keys = [generation_key(model) for model in models]
+    generations = cache.get_many(keys)
+
+    missing = [key for key in keys if key not in generations]
+    if missing:
+        # Start with a value which has not been used before, even if the
+        # counter has been evicted from the cache.
+        for key in missing:
+            cache.add(key, int(time.time() * 1000), None)
+        generations.update(cache.get_many(missing))
+
+    return tuple(generations.get(key, 0) for key in keys)
+
+
+def bump_generation(model):
+    """
+    Increments the generation of ``model``, which invalidates all cached
+    responses depending on it
+    """
+    key = generation_key(model)
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.add(key, int(time.time() * 1000), None)
+
+
+def _invalidate(sender, **kwargs):
+    if _concrete(sender) in _tracked:
+        bump_generation(sender)
+
+
+def _invalidate_m2m(sender, instance, action, model, **kwargs):
+    if not action.startswith('post_'):
+        return
+
+    for related in (instance.__class__, model):
+        if _concrete(related) in _tracked:
+            bump_generation(related)
+
+
+post_save.connect(_invalidate, dispatch_uid='towel.api.caching.post_save')
+post_delete.connect(
+    _invalidate, dispatch_uid='towel.api.caching.post_delete')
+m2m_changed.connect(
+    _invalidate_m2m, dispatch_uid='towel.api.caching.m2m_changed')
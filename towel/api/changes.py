@@ -0,0 +1,127 @@
+"""
+Change feeds
+============
+
+Resources registered with ``API.register(..., changes=True)`` provide a
+``changes/`` endpoint returning objects modified after a cursor (see
+``Resource.get_changes``). Deletions cannot be found in the model's table
+anymore, they are recorded in a log table instead. The log model is
+configured using the ``TOWEL_API_TOMBSTONE_MODEL`` setting (e.g.
+``'sync.Tombstone'``) and must have the following fields:
+
+* ``model``: A character field (``max_length=100``) containing the model
+  label, e.g. ``'testapp.person'``. Should be indexed.
+* ``object_pk``: A character field containing the primary key of the
+  deleted object.
+* ``discriminator``: Optional, a character field (``blank=True``) containing
+  e.g. the tenant of the deleted object. Required if deletions are tracked
+  with a discriminator or if :py:class:`towel.mt.api.Resource` is used.
+
+The auto-incrementing primary key of the log model determines the order of
+deletions. Old entries can be deleted at any time, clients with cursors
+older than the remaining entries miss those deletions though.
+"""
+
+from __future__ import absolute_import, unicode_literals
+
+from django.conf import settings
+from django.db.models.signals import post_delete
+from django.utils.encoding import force_text
+
+from towel.utils import app_model_label
+
+
+#: Models whose deletions are recorded, mapped to the name of the attribute
+#: recorded as discriminator or ``None``
+_tracked = {}
+
+
+def _concrete(model):
+    return getattr(model._meta, 'concrete_model', None) or model
+
+
+def model_label(model):
+    return '%s.%s' % app_model_label(_concrete(model))
+
+
+def tombstone_model():
+    """
+    Returns the model configured using ``TOWEL_API_TOMBSTONE_MODEL`` or
+    ``None`` if the setting is missing
+    """
+    label = getattr(settings, 'TOWEL_API_TOMBSTONE_MODEL', None)
+    if label is None:
+        return None
+
+    from django.db.models import loading
+    return loading.get_model(*label.split('.'))
+
+
+def track_deletions(models, discriminator=None):
+    """
+    Records deletions of instances of the passed models in the log table.
+    If ``discriminator`` is the name of an attribute (e.g. ``'client_id'``),
+    its value is recorded as well, which allows reporting deletions only to
+    the tenant the deleted object belonged to. Does nothing if
+    ``TOWEL_API_TOMBSTONE_MODEL`` is not set.
+    """
+    for model in models:
+        _tracked[_concrete(model)] = discriminator
+
+
+def is_tracked(model):
+    """
+    Returns whether deletions of ``model`` instances are recorded, that is,
+    whether the model has a change feed
+    """
+    return _concrete(model) in _tracked
+
+
+def latest_tombstone():
+    """
+    Returns the primary key of the newest log entry or ``0``
+    """
+    model = tombstone_model()
+    if model is None:
+        return 0
+
+    latest = model._default_manager.order_by(
+        '-pk').values_list('pk', flat=True)[:1]
+    return latest[0] if latest else 0
+
+
+def tombstones(model, after, limit, discriminator=None):
+    """
+    Returns a list of ``(log entry pk, object pk)`` tuples for deletions of
+    ``model`` instances recorded after the log entry ``after``. Only
+    deletions recorded with the passed ``discriminator`` are returned if it
+    is not ``None``.
+    """
+    if tombstone_model() is None:
+        return []
+
+    entries = tombstone_model()._default_manager.filter(
+        model=model_label(model),
+        pk__gt=after,
+    )
+    if discriminator is not None:
+        entries = entries.filter(discriminator=force_text(discriminator))
+    return list(entries.order_by('pk').values_list('pk', 'object_pk')[:limit])
+
+
+def _record_deletion(sender, instance, **kwargs):
+    model = _concrete(sender)
+    if model not in _tracked or tombstone_model() is None:
+        return
+
+    data = {}
+    if _tracked[model]:
+        data['discriminator'] = force_text(getattr(instance, _tracked[model]))
+    tombstone_model()._default_manager.create(
+        model=model_label(sender),
+        object_pk=instance.pk,
+        **data)
+
+
+post_delete.connect(
+    _record_deletion, dispatch_uid='towel.api.changes.post_delete')
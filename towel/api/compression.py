@@ -0,0 +1,160 @@
+"""
+Response compression
+====================
+
+Responses generated by :py:class:`~towel.api.Serializer` can be compressed
+without buffering streamed responses (in contrast to Django's
+``GZipMiddleware``). Compression is disabled by default; the following
+settings are available:
+
+- ``TOWEL_API_COMPRESSION``: Content codings to use, in order of
+  preference, e.g. ``('br', 'gzip')``. ``br`` requires the ``brotli``
+  module and is ignored if it is not installed. Defaults to ``()``.
+- ``TOWEL_API_COMPRESSION_MIN_LENGTH``: Responses shorter than this are
+  sent uncompressed. Defaults to ``1024``. Streamed responses are always
+  compressed because their length is not known in advance.
+
+The coding is negotiated using the ``Accept-Encoding`` request header.
+Since compressing secrets together with data controlled by an attacker
+allows recovering the secret (BREACH), do not enable compression for APIs
+reflecting request data in responses containing confidential tokens.
+"""
+
+from __future__ import absolute_import, unicode_literals
+
+import zlib
+
+from django.conf import settings
+from django.utils.cache import patch_vary_headers
+from django.utils.encoding import force_bytes
+
+try:
+    from collections import OrderedDict
+except ImportError:  # Python 2.6
+    from django.utils.datastructures import SortedDict as OrderedDict
+
+
+class GzipCompressor(object):
+    def __init__(self):
+        # 16 + MAX_WBITS: Write a gzip header and trailer
+        self.compressor = zlib.compressobj(
+            6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, data):
+        return self.compressor.compress(data)
+
+    def flush(self):
+        return self.compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self.compressor.flush(zlib.Z_FINISH)
+
+
+#: Available content codings
+COMPRESSORS = OrderedDict([
+    ('gzip', GzipCompressor),
+])
+
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover
+    pass
+else:
+    class BrotliCompressor(object):
+        def __init__(self):
+            self.compressor = brotli.Compressor(quality=5)
+
+        def compress(self, data):
+            return self.compressor.process(data)
+
+        def flush(self):
+            return self.compressor.flush()
+
+        def finish(self):
+            return self.compressor.finish()
+
+    COMPRESSORS['br'] = BrotliCompressor
+
+
+def get_encoding(request):
+    """
+    Returns the name of the content coding to use for the response to
+    ``request`` or ``None``
+    """
+    enabled = [
+        encoding
+        for encoding in getattr(settings, 'TOWEL_API_COMPRESSION', ())
+        if encoding in COMPRESSORS]
+    header = request.META.get('HTTP_ACCEPT_ENCODING', '')
+    if not enabled or not header:
+        return None
+
+    accepted = {}
+    for part in header.split(','):
+        encoding, _sep, params = part.partition(';')
+        quality = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                continue
+        accepted[encoding.strip().lower()] = quality
+
+    default = accepted.get('*', 0)
+    candidates = [
+        (accepted.get(encoding, default), -idx, encoding)
+        for idx, encoding in enumerate(enabled)]
+    quality, _idx, encoding = max(candidates)
+    return encoding if quality > 0 else None
+
+
+def compress_iterator(iterator, compressor, charset='utf-8'):
+    for chunk in iterator:
+        data = compressor.compress(force_bytes(chunk, charset))
+        data += compressor.flush()
+        if data:
+            yield data
+    yield compressor.finish()
+
+
+def compress_response(request, response):
+    """
+    Compresses ``response`` if the client accepts a compressed response
+    and returns it. Streamed responses are compressed incrementally, every
+    chunk is flushed so that clients do not have to wait for the end of the
+    response.
+    """
+    if response.has_header('Content-Encoding'):
+        return response
+
+    if response.streaming:
+        eligible = True
+    else:
+        eligible = len(response.content) >= getattr(
+            settings, 'TOWEL_API_COMPRESSION_MIN_LENGTH', 1024)
+
+    if not eligible or not getattr(settings, 'TOWEL_API_COMPRESSION', ()):
+        return response
+
+    patch_vary_headers(response, ('Accept-Encoding',))
+    encoding = get_encoding(request)
+    if encoding is None:
+        return response
+
+    compressor = COMPRESSORS[encoding]()
+    if response.streaming:
+        # Encode the chunks here; Django does not encode text chunks anymore
+        # once the response has a Content-Encoding header.
+        response.streaming_content = compress_iterator(
+            response._iterator, compressor, response._charset)
+    else:
+        content = compressor.compress(response.content) + compressor.finish()
+        if len(content) >= len(response.content):
+            return response
+        response.content = content
+        response['Content-Length'] = str(len(content))
+
+    response['Content-Encoding'] = encoding
+    return response
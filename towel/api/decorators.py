@@ -1,12 +1,96 @@
+"""
+Authentication decorators
+=========================
+
+``http_basic_auth`` authenticates users sending a HTTP basic authorization
+header. Because verifying passwords is slow on purpose, successful
+verifications may be cached for a short time by setting
+``TOWEL_API_BASIC_AUTH_CACHE_TIMEOUT`` to a number of seconds (defaults to
+``0``, no caching). The cache key is a salted digest of the header, and
+entries are only used as long as the user's password has not changed.
+
+``token_auth`` authenticates users sending an API key instead, either as
+``Authorization: Token <key>`` or as ``Authorization: Bearer <key>``. The
+token model is configured using the ``TOWEL_API_TOKEN_MODEL`` setting
+(e.g. ``'accounts.Token'``) and must have the following fields:
+
+* ``key``: A unique character field containing the API key.
+* ``user``: Foreign key to the user model.
+
+The primary keys of the users tokens belong to are cached for
+``TOWEL_API_TOKEN_CACHE_TIMEOUT`` seconds (defaults to 300); the user itself
+is loaded for every request. Saving or deleting a token through the ORM
+removes it from the cache immediately. Other changes to tokens (e.g.
+``QuerySet.update``, raw SQL or a changed key) become effective at the
+latest when the cache entry expires.
+"""
+
 from __future__ import absolute_import, unicode_literals
 
+import base64
 from functools import wraps
 
+from django.conf import settings
 from django.contrib.auth import authenticate
+from django.core.cache import cache
+from django.db.models.signals import post_delete, post_save
 from django.http import HttpResponse
+from django.utils.crypto import salted_hmac
+from django.utils.encoding import force_bytes
 from django.utils.six.moves import http_client
 from django.views.decorators.vary import vary_on_headers
 
+from towel.utils import app_model_label
+
+
+def _user_model():
+    try:
+        from django.contrib.auth import get_user_model
+    except ImportError:  # Django < 1.5
+        from django.contrib.auth.models import User
+        return User
+    return get_user_model()
+
+
+def _cache_key(prefix, value):
+    return '%s:%s' % (
+        prefix,
+        salted_hmac('towel.api.decorators.%s' % prefix, value).hexdigest())
+
+
+def _password_digest(user):
+    # Do not put password hashes into the cache
+    return salted_hmac(
+        'towel.api.decorators.password', user.password).hexdigest()
+
+
+def _basic_auth_user(auth):
+    timeout = getattr(settings, 'TOWEL_API_BASIC_AUTH_CACHE_TIMEOUT', 0)
+    key = _cache_key('basic-auth', auth)
+
+    if timeout:
+        cached = cache.get(key)
+        if cached:
+            pk, backend, password = cached
+            try:
+                user = _user_model()._default_manager.get(pk=pk)
+            except _user_model().DoesNotExist:
+                user = None
+
+            # The password hash changes when the password is changed.
+            if (user and user.is_active
+                    and _password_digest(user) == password):
+                user.backend = backend
+                return user
+            cache.delete(key)
+
+    username, sep, password = auth.partition(':')
+    user = authenticate(username=username, password=password)
+    if user and timeout:
+        cache.set(
+            key, (user.pk, user.backend, _password_digest(user)), timeout)
+    return user
+
 
 def http_basic_auth(func):
     @wraps(func)
@@ -16,14 +100,77 @@ def http_basic_auth(func):
             meth, _, auth = request.META['HTTP_AUTHORIZATION'].partition(' ')
             if meth.lower() == 'basic':
                 try:
-                    auth = auth.strip().decode('base64')
+                    auth = base64.b64decode(
+                        force_bytes(auth.strip())).decode('utf-8')
                 except Exception:  # binascii.Error, really.
                     return HttpResponse(
                         'Invalid authorization header',
                         status=http_client.BAD_REQUEST)
 
-                username, sep, password = auth.partition(':')
-                user = authenticate(username=username, password=password)
+                user = _basic_auth_user(auth)
+                if user:
+                    request.user = user
+
+        return func(request, *args, **kwargs)
+    return _decorator
+
+
+def token_model():
+    """
+    Returns the model configured using ``TOWEL_API_TOKEN_MODEL``
+    """
+    from django.db.models import loading
+    return loading.get_model(*settings.TOWEL_API_TOKEN_MODEL.split('.'))
+
+
+def _invalidate_token(sender, instance, **kwargs):
+    label = getattr(settings, 'TOWEL_API_TOKEN_MODEL', '')
+    if '%s.%s' % app_model_label(sender) == label.lower():
+        cache.delete(_cache_key('token', instance.key))
+
+
+# Connected for all senders; the token model may not be loaded yet
+post_save.connect(
+    _invalidate_token, dispatch_uid='towel.api.decorators.token_save')
+post_delete.connect(
+    _invalidate_token, dispatch_uid='towel.api.decorators.token_delete')
+
+
+def _token_user(key):
+    cache_key = _cache_key('token', key)
+    pk = cache.get(cache_key)
+    if pk is None:
+        try:
+            token = token_model()._default_manager.select_related(
+                'user').get(key=key)
+        except token_model().DoesNotExist:
+            return None
+
+        # Only cache the primary key, the user contains the password hash
+        user = token.user
+        cache.set(
+            cache_key,
+            user.pk,
+            getattr(settings, 'TOWEL_API_TOKEN_CACHE_TIMEOUT', 300))
+    else:
+        try:
+            user = _user_model()._default_manager.get(pk=pk)
+        except _user_model().DoesNotExist:
+            cache.delete(cache_key)
+            return None
+
+    return user if user.is_active else None
+
+
+def token_auth(func):
+    @wraps(func)
+    @vary_on_headers('Authorization')
+    def _decorator(request, *args, **kwargs):
+        if 'HTTP_AUTHORIZATION' in request.META:
+            meth, _, key = request.META['HTTP_AUTHORIZATION'].partition(' ')
+            key = key.strip()
+            if meth.lower() in ('token', 'bearer') and key:
+                user = _token_user(key)
                 if user:
                     request.user = user
 
@@ -0,0 +1,187 @@
+"""
+Formats
+=======
+
+The formats understood by :py:class:`~towel.api.Serializer` and
+:py:class:`~towel.api.RequestParser` are kept in a registry. The following
+formats are registered by default:
+
+- ``json``: ``application/json``
+- ``msgpack``: ``application/msgpack``, only if ``msgpack`` is installed.
+- ``cbor``: ``application/cbor``, only if ``cbor2`` is installed.
+
+Additional formats can be registered by third party code::
+
+    from towel.api.formats import register_format
+
+    register_format(
+        'yaml',
+        'application/x-yaml',
+        dumps=lambda data: yaml.safe_dump(data),
+        loads=yaml.safe_load,
+        aliases=('text/yaml',),
+    )
+
+``dumps`` receives the data and returns the response body, ``loads``
+receives the request body (bytes) and returns the parsed data. Formats
+without ``loads`` are only supported for output.
+"""
+
+from __future__ import absolute_import, unicode_literals
+
+from collections import namedtuple
+from datetime import datetime
+
+from django.utils import six, timezone
+
+try:
+    from collections import OrderedDict
+except ImportError:  # Python 2.6
+    from django.utils.datastructures import SortedDict as OrderedDict
+
+from .json_backends import _default, get_json_backend
+
+
+#: A registered format
+Format = namedtuple('Format', 'name content_type dumps loads aliases')
+
+#: Registered formats by name, in order of preference
+formats = OrderedDict()
+
+#: Lookup table for format names, content types and aliases
+_lookup = {}
+
+#: Tuple of all content types and aliases, see ``content_types``
+_content_types = ()
+
+
+def register_format(name, content_type, dumps, loads=None, aliases=()):
+    """
+    Registers a format for serializing responses and parsing requests.
+    Registering a format with an existing name replaces the earlier
+    registration.
+    """
+    if name in formats:
+        unregister_format(name)
+
+    fmt = Format(name, content_type, dumps, loads, tuple(aliases))
+    formats[name] = fmt
+    for key in (name, content_type) + fmt.aliases:
+        _lookup[key] = fmt
+    _update_content_types()
+    return fmt
+
+
+def unregister_format(name):
+    """
+    Removes the format ``name`` from the registry
+    """
+    fmt = formats.pop(name)
+    for key in (fmt.name, fmt.content_type) + fmt.aliases:
+        if _lookup.get(key) is fmt:
+            del _lookup[key]
+    _update_content_types()
+
+
+def get_format(identifier):
+    """
+    Returns the format for a name, content type or alias, or ``None``
+    """
+    if not identifier:
+        return None
+    return _lookup.get(identifier.split(';')[0].strip())
+
+
+def content_types():
+    """
+    Returns the content types and aliases of all registered formats, in
+    order of preference
+    """
+    return _content_types
+
+
+def _update_content_types():
+    # Computed once per registry change, not once per response
+    global _content_types
+    _content_types = tuple(
+        content_type
+        for fmt in formats.values()
+        for content_type in (fmt.content_type,) + fmt.aliases)
+
+
+register_format(
+    'json',
+    'application/json',
+    dumps=lambda data: get_json_backend().dumps(data),
+    loads=lambda content: get_json_backend().loads(content.decode('utf-8')),
+)
+
+
+if six.PY2:
+    def _text(value):
+        # Field names and isoformat() results are byte strings on Python 2,
+        # binary formats would encode them as binary data.
+        if isinstance(value, bytes):
+            return value.decode('utf-8')
+        elif isinstance(value, dict):
+            return OrderedDict(
+                (_text(key), _text(item)) for key, item in value.items())
+        elif isinstance(value, (list, tuple)):
+            return [_text(item) for item in value]
+        return value
+else:
+    def _text(value):
+        return value
+
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover
+    pass
+else:
+    register_format(
+        'msgpack',
+        'application/msgpack',
+        dumps=lambda data: msgpack.packb(
+            _text(data),
+            default=lambda value: _text(_default(value)),
+            use_bin_type=True),
+        loads=lambda content: msgpack.unpackb(content, raw=False),
+        aliases=('application/x-msgpack', 'application/vnd.msgpack'),
+    )
+
+
+try:
+    import cbor2
+except ImportError:  # pragma: no cover
+    pass
+else:
+    def _make_aware(value, tz):
+        # cbor2's timezone argument replaces tzinfo, which yields wrong
+        # offsets with pytz time zones; localize naive datetimes instead.
+        if isinstance(value, datetime):
+            if timezone.is_naive(value):
+                return timezone.make_aware(value, tz)
+        elif isinstance(value, dict):
+            return OrderedDict(
+                (key, _make_aware(item, tz)) for key, item in value.items())
+        elif isinstance(value, (list, tuple)):
+            return [_make_aware(item, tz) for item in value]
+        return value
+
+    def _cbor_dumps(data):
+        # Datetimes and decimals use CBOR's own tags, naive datetimes are
+        # in the default time zone. Everything else not supported by CBOR
+        # is encoded as with JSON.
+        return cbor2.dumps(
+            _make_aware(_text(data), timezone.get_default_timezone()),
+            default=lambda encoder, value: encoder.encode(
+                _text(_default(value))),
+        )
+
+    register_format(
+        'cbor',
+        'application/cbor',
+        dumps=_cbor_dumps,
+        loads=cbor2.loads,
+    )
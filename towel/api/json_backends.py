@@ -0,0 +1,180 @@
+"""
+JSON encoding and decoding backends
+===================================
+
+All JSON produced and consumed by ``towel.api`` goes through a backend. The
+backend is determined by the ``TOWEL_API_JSON_BACKEND`` setting or by the
+``json_backend`` argument of :py:class:`~towel.api.API`. The following
+backends are available:
+
+- ``'json'``: The standard library's :py:mod:`json` module.
+- ``'simplejson'``: ``simplejson``, only fast with its C speedups. The output
+  is identical to ``'json'``.
+- ``'orjson'``: ``orjson``. The output contains no optional whitespace and
+  non-ASCII characters are not escaped, but values are encoded the same way
+  as with the other backends. Only used if configured explicitly.
+- ``'auto'`` (the default): ``'simplejson'`` if it is installed with its
+  speedups, ``'json'`` otherwise. The output does not depend on the
+  installed libraries.
+
+Dates, times, decimals and lazy translation strings are encoded using
+:py:class:`JSONEncoder` by all backends.
+"""
+
+from __future__ import absolute_import, unicode_literals
+
+import json
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import six
+from django.utils.encoding import force_text
+from django.utils.functional import Promise
+
+
+class JSONEncoder(DjangoJSONEncoder):
+    """
+    ``DjangoJSONEncoder`` which handles lazy translation strings as well
+    """
+    def default(self, o):
+        if isinstance(o, Promise):
+            return force_text(o)
+        return super(JSONEncoder, self).default(o)
+
+
+_default = JSONEncoder().default
+
+
+class JSONBackend(object):
+    """
+    The standard library's ``json`` module
+    """
+    name = 'json'
+
+    def dumps(self, data):
+        """
+        Returns the JSON representation of ``data`` as text
+        """
+        return json.dumps(data, cls=JSONEncoder)
+
+    def loads(self, content):
+        """
+        Decodes the JSON document ``content`` (text)
+        """
+        return json.loads(content)
+
+
+class SimpleJSONBackend(JSONBackend):
+    name = 'simplejson'
+
+    def __init__(self):
+        import simplejson
+        self.simplejson = simplejson
+
+    def dumps(self, data):
+        return self.simplejson.dumps(
+            data,
+            default=_default,
+            use_decimal=False,
+            namedtuple_as_object=False,
+        )
+
+    def loads(self, content):
+        return self.simplejson.loads(content)
+
+
+class ORJSONBackend(JSONBackend):
+    name = 'orjson'
+
+    def __init__(self):
+        import orjson
+        self.orjson = orjson
+        self.option = (
+            orjson.OPT_PASSTHROUGH_DATETIME
+            | orjson.OPT_PASSTHROUGH_SUBCLASS
+            | orjson.OPT_NON_STR_KEYS)
+
+    def default(self, o):
+        # Subclasses of builtin types are passed through so that they are
+        # treated the same way as by the standard library (QueryDict.items()
+        # only returns the last value for each key, SafeText, etc.)
+        if isinstance(o, dict):
+            return dict(o.items())
+        elif isinstance(o, six.text_type):
+            return six.text_type(o)
+        elif isinstance(o, (list, tuple)):
+            return list(o)
+        elif isinstance(o, six.integer_types):
+            return int(o)
+        return _default(o)
+
+    def dumps(self, data):
+        return self.orjson.dumps(
+            data, default=self.default, option=self.option).decode('utf-8')
+
+    def loads(self, content):
+        return self.orjson.loads(content)
+
+
+#: Available backends
+BACKENDS = [
+    ('orjson', ORJSONBackend),
+    ('simplejson', SimpleJSONBackend),
+    ('json', JSONBackend),
+]
+
+#: Backends considered by ``'auto'``, in order of preference. Their output
+#: is byte-identical.
+AUTO_BACKENDS = ('simplejson', 'json')
+
+_backends = {}
+
+
+def _auto_backend():
+    for name in AUTO_BACKENDS:
+        try:
+            backend = dict(BACKENDS)[name]()
+        except ImportError:
+            continue
+
+        if name == 'simplejson':
+            # simplejson without speedups is slower than the stdlib
+            from simplejson.encoder import c_make_encoder
+            if c_make_encoder is None:
+                continue
+
+        return backend
+
+
+def get_json_backend(backend=None):
+    """
+    Returns the JSON backend instance for the passed name, the backend
+    configured by the ``TOWEL_API_JSON_BACKEND`` setting if ``backend`` is
+    ``None`` or the argument itself if it is already a backend instance.
+    """
+    if backend is None:
+        backend = getattr(settings, 'TOWEL_API_JSON_BACKEND', 'auto')
+
+    if not isinstance(backend, six.string_types):
+        return backend
+
+    try:
+        return _backends[backend]
+    except KeyError:
+        pass
+
+    if backend == 'auto':
+        instance = _auto_backend()
+    else:
+        try:
+            instance = dict(BACKENDS)[backend]()
+        except KeyError:
+            raise ImproperlyConfigured(
+                'Unknown JSON backend %r' % backend)
+        except ImportError as exc:
+            raise ImproperlyConfigured(
+                'JSON backend %r is not available: %s' % (backend, exc))
+
+    _backends[backend] = instance
+    return instance
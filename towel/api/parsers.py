@@ -1,10 +1,11 @@
 from __future__ import absolute_import, unicode_literals
 
-import json
 import re
 
 from django.utils.six.moves import http_client
 
+from .formats import get_format
+from .json_backends import get_json_backend
 from .serializers import Serializer
 
 
@@ -26,17 +27,26 @@ class RequestParser(object):
 
     - ``application/x-www-form-urlencoded`` (the default)
     - ``multipart/form-data``
-    - ``application/json``
+    - All formats from ``towel.api.formats`` with a ``loads`` function,
+      by default ``application/json``, ``application/msgpack`` and
+      ``application/cbor`` (the latter two only if the libraries are
+      installed)
 
     The two former content types are supported directly by Django, all
-    capabilities and restrictions are inherited directly. When using JSON,
-    file uploads are not supported.
+    capabilities and restrictions are inherited directly. When using JSON or
+    other formats, file uploads are not supported.
 
     The parsed data is available as ``request.POST`` and ``request.FILES``.
     ``request.POST`` is used instead of something else even for ``PUT`` and
     ``PATCH`` requests (among others), because most code written for Django
     expects data to be provided under that name.
+
+    ``json_backend`` is used for decoding JSON, see
+    :py:class:`~towel.api.Serializer`.
     """
+    def __init__(self, json_backend=None):
+        self.json_backend = get_json_backend(json_backend)
+
     def parse(self, request):
         """
         Decides whether the request body should be parsed, and if yes, decides
@@ -51,17 +61,19 @@ class RequestParser(object):
         content_type = request.META.get(
             'CONTENT_TYPE', 'application/x-www-form-urlencoded')
 
-        handlers = {
-            r'^application/x-www-form-urlencoded': self.parse_form,
-            r'^multipart/form-data': self.parse_form,
-            r'^application/json': self.parse_json,
-        }
+        if re.match(
+                r'^(application/x-www-form-urlencoded|multipart/form-data)',
+                content_type):
+            return self.parse_form(request)
 
-        for pattern, handler in handlers.items():
-            if re.match(pattern, content_type):
+        fmt = get_format(content_type)
+        if fmt is not None and fmt.loads is not None:
+            handler = getattr(self, 'parse_%s' % fmt.name, None)
+            if handler is not None:
                 return handler(request)
+            return self.parse_format(request, fmt)
 
-        return Serializer().serialize(
+        return Serializer(json_backend=self.json_backend).serialize(
             {
                 'error': '%r is not supported' % content_type,
             },
@@ -87,4 +99,11 @@ class RequestParser(object):
         Unserializes the JSON in the body of the request and saves the result
         as ``request.POST``.
         """
-        request.POST = json.loads(request.body.decode('utf-8'))
+        request.POST = self.json_backend.loads(request.body.decode('utf-8'))
+
+    def parse_format(self, request, fmt):
+        """
+        Parses the request body using the ``loads`` function of a registered
+        format and saves the result as ``request.POST``.
+        """
+        request.POST = fmt.loads(request.body)
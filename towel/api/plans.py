@@ -0,0 +1,399 @@
+from __future__ import absolute_import, unicode_literals
+
+import copy
+from functools import partial
+import operator
+
+from django.db import models
+from django.db.models.related import RelatedObject
+from django.utils import six
+from django.utils.encoding import force_text
+
+from towel.utils import app_model_label
+from .base import _NOT_REGISTERED, api_reverse, uri_template
+
+
+#: Cache of serialization plans, keyed by
+#: ``(api name, model, fields, exclude, inline)``
+_plans = {}
+
+_field_value_from_object = six.get_unbound_function(
+    models.Field.value_from_object)
+
+
+def split_field_paths(paths):
+    """
+    Splits field paths such as ``['name', 'person.family_name']`` into a set
+    of plain names (``{'name'}``) and a dictionary mapping names to the
+    remaining paths for inlined objects (``{'person': ['family_name']}``)
+    """
+    names, nested = set(), {}
+    for path in paths:
+        name, _sep, rest = path.partition('.')
+        if rest:
+            nested.setdefault(name, []).append(rest)
+        else:
+            names.add(name)
+    return names, nested
+
+
+def detail_uri_function(model, api_name):
+    """
+    Returns a function returning the canonical URI of the ``model`` instance
+    with the passed primary key, or ``None``. Integer primary keys are
+    substituted into the URI template directly.
+
+    The template depends on the current URLconf and script prefix, the
+    function should therefore not be kept around longer than a request.
+    """
+    fallback = partial(
+        api_reverse, model, 'detail', api_name=api_name, fail_silently=True)
+    template = uri_template(
+        '_'.join((api_name,) + app_model_label(model) + ('detail',)),
+        ('pk',))
+
+    if template is _NOT_REGISTERED:
+        return lambda pk: None
+    elif template is None:
+        return lambda pk: fallback(pk=pk)
+
+    def uri(pk):
+        if isinstance(pk, six.integer_types) and not isinstance(pk, bool):
+            return template.format(pk=pk)
+        return fallback(pk=pk)
+    return uri
+
+
+def instance_model(instance):
+    """
+    Returns the model of ``instance``, which is not the instance's class if
+    some fields have been deferred using ``only()`` or ``defer()``
+    """
+    if getattr(instance, '_deferred', False):
+        return instance._meta.proxy_for_model
+    return instance.__class__
+
+
+def field_accessor(field):
+    """
+    Returns a callable returning the value of ``field`` for a passed model
+    instance. This is the same as ``field.value_from_object``, but uses a
+    faster ``operator.attrgetter`` if the field does not customize value
+    retrieval.
+    """
+    method = six.get_unbound_function(type(field).value_from_object)
+    if method is _field_value_from_object:
+        return operator.attrgetter(field.attname)
+    return field.value_from_object
+
+
+class SerializationPlan(object):
+    """
+    Everything ``serialize_model_instance`` has to know about a model, which
+    means field lookups, ``isinstance`` checks and choices are only processed
+    once per model and not once per serialized instance.
+
+    The plan consists of the following lists:
+
+    - ``values``: ``(name, accessor, choices)`` tuples for plain fields.
+      ``choices`` is a dictionary mapping values to their prettified
+      representation or ``None`` if the field has no choices.
+    - ``files``: ``(name, accessor)`` tuples for file fields.
+    - ``foreign_keys``: ``(name, accessor, uri, model)`` tuples; ``uri``
+      returns the canonical URI of the related object given its primary key.
+    - ``relations``: ``(name, multiple, model)`` tuples for many to many
+      fields and reverse relations. Only filled if ``inline`` is true,
+      because those relations are not serialized otherwise.
+
+    Plans for sparse fieldsets requested by clients are derived from the
+    full plan using ``restrict``.
+    """
+
+    #: Maximum count of restricted plans cached per plan
+    max_restricted = 100
+
+    def __init__(self, model, api_name, fields=(), exclude=(), inline=False):
+        self.model = model
+        self.api_name = api_name
+        self.uri = partial(
+            api_reverse, model, 'detail', api_name=api_name,
+            fail_silently=True)
+
+        self.values = []
+        self.files = []
+        self.foreign_keys = []
+        self.relations = []
+
+        # Sparse fieldsets for inlined objects, see restrict()
+        self.nested_fields = {}
+        self.nested_exclude = {}
+        self._restricted = {}
+
+        opts = model._meta
+        seen = set()
+        for f_name in opts.get_all_field_names():
+            f, model_, direct, m2m = opts.get_field_by_name(f_name)
+
+            # Foreign keys are returned twice, once as ``name`` and once
+            # as ``name_id``.
+            if f in seen:
+                continue
+            seen.add(f)
+
+            if fields and f.name not in fields:
+                continue
+
+            if f.name in exclude:
+                continue
+
+            if isinstance(f, (models.ManyToManyField, RelatedObject)):
+                if not inline:
+                    continue
+
+                if isinstance(f, RelatedObject):
+                    self.relations.append((
+                        f.get_accessor_name(),
+                        f.field.rel.multiple,
+                        f.model,
+                    ))
+                else:
+                    self.relations.append((f.name, True, f.rel.to))
+
+            elif f.rel:
+                self.foreign_keys.append((
+                    f.name,
+                    field_accessor(f),
+                    partial(
+                        api_reverse, f.rel.to, 'detail', api_name=api_name,
+                        fail_silently=True),
+                    f.rel.to,
+                ))
+
+            elif isinstance(f, models.FileField):
+                self.files.append((f.name, field_accessor(f)))
+
+            else:
+                self.values.append((
+                    f.name,
+                    field_accessor(f),
+                    dict(f.flatchoices) if f.flatchoices else None,
+                ))
+
+    def restrict(self, fields=(), exclude=()):
+        """
+        Returns a plan which only serializes the entries named in ``fields``
+        (if any) and none named in ``exclude``. Dotted paths such as
+        ``person.family_name`` are applied to inlined objects.
+        """
+        key = (tuple(sorted(fields)), tuple(sorted(exclude)))
+        try:
+            return self._restricted[key]
+        except KeyError:
+            pass
+
+        names, nested_fields = split_field_paths(fields)
+        names.update(nested_fields)
+        excluded, nested_exclude = split_field_paths(exclude)
+
+        def keep(entry):
+            return (
+                (not fields or entry[0] in names)
+                and entry[0] not in excluded)
+
+        plan = copy.copy(self)
+        plan.values = list(filter(keep, self.values))
+        plan.files = list(filter(keep, self.files))
+        plan.foreign_keys = list(filter(keep, self.foreign_keys))
+        plan.relations = list(filter(keep, self.relations))
+        plan.nested_fields = nested_fields
+        plan.nested_exclude = nested_exclude
+        plan._restricted = {}
+
+        if len(self._restricted) >= self.max_restricted:
+            # The keys are controlled by clients, do not grow without bounds
+            self._restricted.clear()
+        self._restricted[key] = plan
+        return plan
+
+    def nested_kwargs(self, name):
+        """
+        Returns the sparse fieldset arguments for objects inlined as
+        ``name``
+        """
+        kwargs = {}
+        if name in self.nested_fields:
+            kwargs['sparse_fields'] = self.nested_fields[name]
+        if name in self.nested_exclude:
+            kwargs['sparse_exclude'] = self.nested_exclude[name]
+        return kwargs
+
+    def supports_rows(self):
+        """
+        Returns whether rows fetched using ``values_list()`` can be
+        serialized, which is the case if the plan neither contains files nor
+        relations and no field customizes ``value_from_object``
+        """
+        return not self.files and not self.relations and all(
+            isinstance(entry[1], operator.attrgetter)
+            for entry in self.values + self.foreign_keys)
+
+    def row_serializer(self, str_function=None, str_fields=(),
+                       only_registered=True):
+        """
+        Returns a tuple of column names for ``values_list()`` and a function
+        serializing those rows the same way as ``serialize`` serializes
+        instances, without instantiating models. Only valid if
+        ``supports_rows`` returns ``True``.
+
+        ``__str__`` cannot be determined without instances. It is set to
+        the return value of ``str_function`` which receives a dictionary
+        containing the values of all columns, including ``str_fields``,
+        or left out if ``str_function`` is ``None``.
+        """
+        columns = ['pk']
+        columns.extend(entry[0] for entry in self.values)
+        columns.extend(entry[0] for entry in self.foreign_keys)
+        columns.extend(str_fields)
+
+        values = [
+            (idx, name, choices)
+            for idx, (name, accessor, choices) in enumerate(self.values, 1)]
+        foreign_keys = [
+            (idx, name, detail_uri_function(model, self.api_name))
+            for idx, (name, accessor, uri, model) in enumerate(
+                self.foreign_keys, 1 + len(self.values))]
+        detail_uri = detail_uri_function(self.model, self.api_name)
+
+        def serialize(row, build_absolute_uri=lambda uri: uri):
+            uri = detail_uri(row[0])
+            if uri is None and only_registered:
+                return None
+
+            pretty = {}
+            data = {
+                '__uri__': build_absolute_uri(uri),
+                '__pretty__': pretty,
+                '__pk__': row[0],
+            }
+            if str_function is not None:
+                data['__str__'] = force_text(
+                    str_function(dict(zip(columns, row))))
+
+            for idx, name, choices in values:
+                value = data[name] = row[idx]
+                if choices is not None:
+                    pretty[name] = force_text(choices.get(value, '-'))
+
+            for idx, name, related_uri in foreign_keys:
+                value = row[idx]
+                if value is None:
+                    data[name] = None
+                    continue
+
+                uri = related_uri(value)
+                if uri is not None:
+                    data[name] = build_absolute_uri(uri)
+
+            return data
+
+        return columns, serialize
+
+    def serialize(self, instance, api, inline_depth=0, only_registered=True,
+                  build_absolute_uri=lambda uri: uri):
+        """
+        Applies the plan to a single model instance. The arguments have the
+        same meaning as those of ``serialize_model_instance``.
+        """
+        uri = self.uri(pk=instance.pk)
+        if uri is None and only_registered:
+            return None
+
+        pretty = {}
+        data = {
+            '__uri__': build_absolute_uri(uri),
+            '__str__': force_text(instance),
+            '__pretty__': pretty,
+            '__pk__': instance.pk,
+        }
+
+        for name, accessor, choices in self.values:
+            value = data[name] = accessor(instance)
+            if choices is not None:
+                pretty[name] = force_text(choices.get(value, '-'))
+
+        for name, accessor in self.files:
+            try:
+                data[name] = build_absolute_uri(accessor(instance).url)
+            except ValueError:
+                data[name] = ''
+
+        for name, accessor, related_uri, model in self.foreign_keys:
+            value = accessor(instance)
+            if value is None:
+                data[name] = None
+                continue
+
+            uri = related_uri(pk=value)
+            if uri is not None:
+                data[name] = build_absolute_uri(uri)
+            elif only_registered:
+                continue
+
+            if inline_depth > 0:
+                related = getattr(instance, name)
+
+                if related:
+                    # XXX What about only_registered, kwargs? Should they be
+                    # passed to other calls as well, or should we assume that
+                    # customization can only happen using functools.partial
+                    # upon registration time?
+                    data[name] = api.serialize_instance(
+                        related,
+                        inline_depth=inline_depth - 1,
+                        build_absolute_uri=build_absolute_uri,
+                        only_registered=only_registered,
+                        **self.nested_kwargs(name)
+                    )
+
+        if inline_depth > 0:
+            for name, multiple, model in self.relations:
+                if not multiple:
+                    try:
+                        obj = getattr(instance, name)
+                    except models.ObjectDoesNotExist:
+                        obj = None
+
+                    data[name] = api.serialize_instance(
+                        obj,
+                        inline_depth=inline_depth - 1,
+                        build_absolute_uri=build_absolute_uri,
+                        only_registered=only_registered,
+                        **self.nested_kwargs(name)
+                    ) if obj else None
+                else:
+                    kwargs = self.nested_kwargs(name)
+                    related = [api.serialize_instance(
+                        obj,
+                        inline_depth=inline_depth - 1,
+                        build_absolute_uri=build_absolute_uri,
+                        only_registered=only_registered,
+                        **kwargs
+                    ) for obj in getattr(instance, name).all()]
+                    if any(related):
+                        data[name] = related
+
+        return data
+
+
+def serialization_plan(model, api_name, fields=(), exclude=(), inline=False):
+    """
+    Returns the cached ``SerializationPlan`` for the given arguments, building
+    it first if necessary.
+    """
+    key = (api_name, model, tuple(fields), tuple(exclude), bool(inline))
+    try:
+        return _plans[key]
+    except KeyError:
+        plan = _plans[key] = SerializationPlan(
+            model, api_name, fields=fields, exclude=exclude, inline=inline)
+        return plan
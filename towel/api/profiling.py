@@ -0,0 +1,194 @@
+"""
+Profiling
+=========
+
+Requests handled by :py:class:`~towel.api.Resource` can be profiled. The
+timings are added to the response as a ``Server-Timing`` header, which is
+shown by the network panel of browser developer tools::
+
+    Server-Timing: parse;dur=0.1, serialize;dur=5.1, handler;dur=25.3,
+        encode;dur=4.2, db;dur=18.7;desc="3 queries", total;dur=30.2
+
+- ``parse``: Parsing the request body (``unserialize_request``)
+- ``serialize``: Serializing model instances or rows using the API
+  (``API.serialize_instance`` and ``API.row_serializer``). The objects of
+  streamed responses are serialized later and are not included.
+- ``handler``: The handler method, e.g. ``get_list``, including the queries
+  and the serialization of model instances
+- ``encode``: Encoding the response (``serialize_response``). The contents
+  of streamed responses are encoded later and are not included.
+- ``db``: Count and duration of all database queries
+- ``total``: The whole ``dispatch`` method
+
+Profiling is enabled for all requests by the ``TOWEL_API_PROFILING``
+setting. Single requests can be profiled by adding ``?profile=<token>``,
+where the token is generated by :py:func:`profiling_token` and is valid for
+``TOWEL_API_PROFILING_MAX_AGE`` seconds (defaults to one hour)::
+
+    >>> from towel.api.profiling import profiling_token
+    >>> profiling_token()
+    'InByb2ZpbGUi:1Uv6HV:...'
+
+After every profiled request, the :py:data:`request_profiled` signal is
+sent with the arguments ``request``, ``response``, ``timings`` (a dictionary
+of durations in seconds) and ``queries`` (the count of queries), which can
+be used to send the numbers to a metrics backend.
+
+If profiling is not enabled, no measurements are made at all.
+"""
+
+from __future__ import absolute_import, unicode_literals
+
+import time
+
+from functools import partial
+
+from django.conf import settings
+from django.core import signing
+from django.db import connections
+from django.dispatch import Signal
+
+try:
+    from collections import OrderedDict
+except ImportError:  # Python 2.6
+    from django.utils.datastructures import SortedDict as OrderedDict
+
+
+#: Sent after every profiled request
+request_profiled = Signal(
+    providing_args=['request', 'response', 'timings', 'queries'])
+
+SALT = 'towel.api.profiling'
+
+
+def profiling_token():
+    """
+    Returns a token for the ``?profile=`` query parameter
+    """
+    return signing.dumps('profile', salt=SALT)
+
+
+class Profile(object):
+    """
+    Collects the timings of a single request
+    """
+    def __init__(self):
+        self.started = time.time()
+        self.timings = OrderedDict()
+        self.queries = 0
+        self.finished = False
+
+        # Record queries even if DEBUG is False
+        self._connections = []
+        for connection in connections.all():
+            self._connections.append((
+                connection,
+                len(connection.queries),
+                connection.use_debug_cursor))
+            connection.use_debug_cursor = True
+
+    def timed(self, name, func, *args, **kwargs):
+        """
+        Calls ``func`` with the passed arguments, adds the time spent to the
+        timing ``name`` and returns the return value of ``func``
+        """
+        started = time.time()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self.timings[name] = self.timings.get(name, 0) + (
+                time.time() - started)
+
+    def finish(self):
+        """
+        Stops recording queries and determines the ``db`` and ``total``
+        timings. Does nothing if called again.
+        """
+        if self.finished:
+            return
+        self.finished = True
+
+        duration = 0
+        for connection, offset, use_debug_cursor in self._connections:
+            queries = connection.queries[offset:]
+            self.queries += len(queries)
+            duration += sum(float(query['time']) for query in queries)
+            connection.use_debug_cursor = use_debug_cursor
+
+        self.timings['db'] = duration
+        self.timings['total'] = time.time() - self.started
+
+    def header(self):
+        """
+        Returns the value of the ``Server-Timing`` header
+        """
+        return ', '.join(
+            '%s;dur=%.1f%s' % (
+                name,
+                duration * 1000,
+                ';desc="%s queries"' % self.queries if name == 'db' else '')
+            for name, duration in self.timings.items())
+
+
+class ProfiledAPI(object):
+    """
+    Wraps an :py:class:`~towel.api.API`, adding the time spent serializing
+    instances and rows to the ``serialize`` timing of ``profile``. Used by
+    profiled resources instead of the API itself.
+    """
+    def __init__(self, api, profile):
+        self._api = api
+        self._profile = profile
+
+    def __getattr__(self, name):
+        return getattr(self._api, name)
+
+    def serialize_instance(self, instance, **kwargs):
+        return self._profile.timed(
+            'serialize', self._api.serialize_instance, instance, **kwargs)
+
+    def row_serializer(self, model, **kwargs):
+        row_serializer = self._api.row_serializer(model, **kwargs)
+        if row_serializer is None:
+            return None
+        columns, serialize = row_serializer
+        return columns, partial(self._profile.timed, 'serialize', serialize)
+
+
+def start_profile(request):
+    """
+    Returns a :py:class:`Profile` if the request should be profiled,
+    ``None`` otherwise
+    """
+    if getattr(settings, 'TOWEL_API_PROFILING', False):
+        return Profile()
+
+    token = request.GET.get('profile')
+    if token:
+        try:
+            signing.loads(
+                token,
+                salt=SALT,
+                max_age=getattr(
+                    settings, 'TOWEL_API_PROFILING_MAX_AGE', 3600))
+        except signing.BadSignature:
+            return None
+        return Profile()
+
+    return None
+
+
+def finish_profile(profile, request, response, sender):
+    """
+    Adds the ``Server-Timing`` header to ``response`` and sends
+    :py:data:`request_profiled`
+    """
+    profile.finish()
+    response['Server-Timing'] = profile.header()
+    request_profiled.send(
+        sender=sender,
+        request=request,
+        response=response,
+        timings=dict(profile.timings),
+        queries=profile.queries)
+    return response
@@ -1,24 +1,58 @@
 from __future__ import absolute_import, unicode_literals
 
+from calendar import timegm
 from collections import namedtuple
+from datetime import date, datetime
+from functools import partial
+import hashlib
+import json
 import logging
 
-from django.http import Http404, HttpResponse
+from django import forms
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.db import connections, models, transaction
+from django.db.models.sql.datastructures import EmptyResultSet
+from django.forms.models import model_to_dict, modelform_factory
+from django.http import (
+    Http404, HttpResponse, HttpResponseNotModified, StreamingHttpResponse)
+from django.http.response import HttpResponseBase
 from django.shortcuts import get_object_or_404
+from django.utils import six, timezone
+from django.utils.cache import patch_vary_headers
+from django.utils.encoding import force_bytes, force_text
+from django.utils.http import (
+    http_date, parse_etags, parse_http_date_safe, quote_etag)
 from django.utils.six.moves import http_client
 from django.views import generic
 
+from . import changes
 from .base import APIException, api_reverse
+from .caching import bump_generation, get_generations, track_models
+from .compression import compress_response, get_encoding
+from .json_backends import get_json_backend
 from .parsers import RequestParser
+from .profiling import ProfiledAPI, finish_profile, start_profile
 from .serializers import Serializer
-from .utils import querystring
+from .utils import (
+    clean_cursor, decode_cursor, encode_cursor, keyset_filter, querystring)
 
 
 #: The ``page`` object from ``Resource.objects``
 Page = namedtuple('Page', 'queryset offset limit full_queryset')
 
+#: The ``page`` object for cursor based pagination; ``next`` and
+#: ``previous`` are cursors or ``None``
+CursorPage = namedtuple(
+    'CursorPage', 'queryset limit full_queryset next previous')
+
 logger = logging.getLogger('towel.api')
 
+try:
+    atomic = transaction.atomic
+except AttributeError:  # Django < 1.6
+    atomic = transaction.commit_on_success
+
 
 class Resource(generic.View):
     """
@@ -40,11 +74,120 @@ class Resource(generic.View):
     #: Higher values than this will not be accepted for ``limit``
     max_limit_per_page = 1000
 
+    #: Ordering used for cursor based pagination (``?after=<cursor>``)
+    #: instead of ``OFFSET``, for example ``('-created', 'pk')``. The fields
+    #: should be indexed and not nullable, and the last field has to be
+    #: unique. Requests containing ``offset`` are still paginated the old way.
+    cursor_ordering = None
+    #: Whether cursor based list pages include ``meta.total``, which costs a
+    #: ``COUNT`` query
+    cursor_total = False
+
+    #: How ``meta.total`` is determined for list resources:
+    #:
+    #: - ``'exact'``: Runs a ``COUNT`` query for every request.
+    #: - ``'cached'``: Caches exact counts for ``total_cache_timeout``
+    #:   seconds using Django's cache framework.
+    #: - ``'estimate'``: Uses the row estimate of the query planner on
+    #:   PostgreSQL, exact counts with other databases.
+    #: - ``'none'``: Does not determine the total count at all.
+    #:
+    #: All policies except ``'exact'`` determine whether there is a next
+    #: page by fetching one object more than requested.
+    total_policy = 'exact'
+    #: Timeout in seconds for the ``'cached'`` total policy
+    total_cache_timeout = 60
+
+    #: Whether list responses are streamed; objects are fetched and
+    #: serialized while the response is being sent instead of all at once
+    streaming = False
+    #: Whether ``meta`` is written before or after the objects in streamed
+    #: responses. Writing it afterwards avoids an additional query for
+    #: determining ``meta.next`` if ``total_policy`` is not ``'exact'``.
+    stream_meta_first = True
+    #: Count of objects fetched at once when streaming querysets using
+    #: ``prefetch_related``, which does not work with ``iterator()``
+    stream_chunk_size = 100
+
+    #: Field whose value changes whenever an object changes, f.e. an
+    #: ``updated`` timestamp or a revision number. If set, ``GET`` requests
+    #: are answered with ``ETag`` and ``Last-Modified`` headers (the latter
+    #: only for date and datetime fields), and conditional requests are
+    #: answered with ``304 Not Modified`` before anything is serialized.
+    #: Overwrite ``get_version`` for other version sources.
+    version_field = None
+
+    #: Model fields used by the model's ``__str__`` method. If set (an empty
+    #: tuple is fine too), requests with ``?fields=`` or ``?exclude=`` only
+    #: load the requested fields from the database using ``only()`` and
+    #: ``defer()``. Without this, deferring fields could cause an additional
+    #: query for every object when determining ``__str__``.
+    str_fields = None
+
+    #: Whether list resources are serialized from ``values_list()`` rows
+    #: instead of model instances. Only used if the serializer allows it
+    #: (see ``API.row_serializer``), for offset based pagination and if
+    #: nothing is inlined. ``__str__`` is determined by ``row_str``.
+    values_fast_path = False
+    #: Format string for ``__str__`` on the ``values_list()`` fast path,
+    #: filled with the row's values, f.e. ``'{given_name} {family_name}'``.
+    #: Fields which are not serialized have to be listed in ``str_fields``.
+    #: ``__str__`` is left out if ``None``.
+    values_str = None
+
+    #: Seconds for which serialized ``GET`` responses are stored in Django's
+    #: cache. Entries are invalidated when instances of the model or of
+    #: inlined models are saved or deleted, see ``towel.api.caching``.
+    #: ``None`` disables the response cache.
+    cache_timeout = None
+
+    #: Maximum count of primary keys in a single ``IN`` query for set
+    #: resources, larger sets are fetched using several queries
+    set_chunk_size = 500
+
+    #: Whether set resources return the primary keys of objects which do not
+    #: exist as ``missing`` instead of answering with ``404 Not Found``
+    set_report_missing = False
+
+    #: Count of objects fetched per query by the export endpoint
+    export_chunk_size = 1000
+
+    #: Field increasing whenever an object is saved, f.e. an ``updated``
+    #: timestamp or a sequence number. Required by the change feed added by
+    #: ``API.register(..., changes=True)``, see ``get_changes``.
+    changes_field = None
+
+    #: Maximum count of changed and of deleted objects returned by one
+    #: change feed request
+    changes_limit = 1000
+
+    #: Name of an attribute of deleted objects recorded with the deletion,
+    #: e.g. ``'client_id'``. The change feed only reports deletions whose
+    #: discriminator equals ``get_changes_discriminator()``.
+    changes_discriminator = None
+
+    #: The ``towel.api.profiling.Profile`` of the current request or ``None``
+    profile = None
+
     #: Almost the same as ``django.views.generic.View.http_method_names`` but
     #: not quite, we allow ``patch`` as well.
     http_method_names = [
         'get', 'post', 'put', 'delete', 'head', 'patch', 'options', 'trace']
 
+    #: URL pattern added by ``API.register(..., export=True)``
+    export_urls = [
+        (r'^export/$', 'export', {
+            'request_type': 'export',
+        }),
+    ]
+
+    #: URL pattern added by ``API.register(..., changes=True)``
+    changes_urls = [
+        (r'^changes/$', 'changes', {
+            'request_type': 'changes',
+        }),
+    ]
+
     #: A list of URL patterns which will be used by ``API.register`` to build
     #: the URLconf entries. The format is a list of tuples containing
     #: (regular expression, URL name suffix).
@@ -77,15 +220,34 @@ class Resource(generic.View):
           client. The processing methods should return data (a ``dict``
           instance most of the time) which is then serialized into the
           requested format or some different supported format.
+        - Requests are profiled if enabled, see ``towel.api.profiling``.
         """
+        self.profile = start_profile(request)
+        if self.profile is None:
+            return self._dispatch(request, *args, **kwargs)
+
+        api = self.api
+        self.api = ProfiledAPI(api, self.profile)
+        try:
+            response = self._dispatch(request, *args, **kwargs)
+        finally:
+            self.api = api
+            # Stop recording queries even if an exception is raised
+            self.profile.finish()
+        return finish_profile(
+            self.profile, request, response, sender=self.__class__)
 
+    def _dispatch(self, request, *args, **kwargs):
         # The following three lines can be removed when we move to
         # Django 1.5 only
         self.request = request
         self.args = args
         self.kwargs = kwargs
 
-        response = self.unserialize_request()
+        if self.profile is None:
+            response = self.unserialize_request()
+        else:
+            response = self.profile.timed('parse', self.unserialize_request)
         if response:
             return response
 
@@ -106,8 +268,45 @@ class Resource(generic.View):
                 handler = getattr(self, method)
 
         try:
-            return self.serialize_response(
-                handler(self.request, *self.args, **self.kwargs))
+            validators = None
+            if method == 'get' and handler != self.http_method_not_allowed:
+                validators = self.get_validators()
+                if validators is not None:
+                    response = self.not_modified_response(*validators)
+                    if response is not None:
+                        return response
+
+            cache_key = None
+            if (self.cache_timeout and method == 'get'
+                    and handler != self.http_method_not_allowed):
+                cache_key = self.get_cache_key()
+                response = cache.get(cache_key)
+            else:
+                response = None
+
+            if response is None:
+                if self.profile is None:
+                    response = self.serialize_response(
+                        handler(self.request, *self.args, **self.kwargs))
+                else:
+                    response = self.profile.timed(
+                        'encode',
+                        self.serialize_response,
+                        self.profile.timed(
+                            'handler',
+                            handler, self.request, *self.args, **self.kwargs))
+
+                if (cache_key and response.status_code == 200
+                        and not response.streaming):
+                    cache.set(cache_key, response, self.cache_timeout)
+
+            if validators is not None and response.status_code == 200:
+                etag, last_modified = validators
+                response['ETag'] = etag
+                if last_modified is not None:
+                    response['Last-Modified'] = http_date(last_modified)
+            return response
+
         except Http404 as exc:
             return self.serialize_response(
                 {'error': exc.args[0]},
@@ -136,30 +335,178 @@ class Resource(generic.View):
         If this method returns anything, it is treated as a response and
         short-circuits the resource processing.
         """
-        return RequestParser().parse(self.request)
+        return RequestParser(
+            json_backend=self.api.json_backend).parse(self.request)
 
     def serialize_response(self, response, status=http_client.OK,
                            headers=None):
         """
         Serializes the response into an appropriate format for the wire such
-        as JSON. ``HttpResponse`` instances are returned directly.
+        as JSON. ``HttpResponse`` (and ``StreamingHttpResponse``) instances
+        are returned directly.
         """
-        if isinstance(response, HttpResponse):
+        if isinstance(response, HttpResponseBase):
             return response
 
-        return Serializer().serialize(
+        return Serializer(json_backend=self.api.json_backend).serialize(
             response,
             request=self.request,
             status=status,
             output_format=self.request.GET.get('format'),
             headers=headers)
 
+    def get_version(self):
+        """
+        Returns a value which changes whenever the response to the current
+        ``GET`` request changes, or ``None`` if conditional requests are not
+        supported. Uses ``version_field``: For detail resources the version
+        is the field's value, for set and list resources it is a tuple of
+        the maximum value and the count of objects. Counting catches deleted
+        objects; changes to inlined related objects are not recognized.
+        """
+        if not self.version_field:
+            return None
+
+        request_type = self.kwargs.get('request_type')
+        queryset = self.get_query_set()
+
+        if request_type == 'detail':
+            versions = list(queryset.filter(
+                pk=self.kwargs['pk'],
+            ).values_list(self.version_field, flat=True)[:1])
+            return (versions[0],) if versions else None
+
+        elif request_type == 'set':
+            versions, count = [], 0
+            for chunk in self.pk_chunks(queryset, self.set_pks()):
+                aggregate = queryset.filter(pk__in=chunk).order_by().aggregate(
+                    version=models.Max(self.version_field),
+                    count=models.Count('pk'))
+                if aggregate['version'] is not None:
+                    versions.append(aggregate['version'])
+                count += aggregate['count']
+            return (max(versions) if versions else None, count)
+
+        elif request_type == 'list':
+            queryset = self.apply_filters(queryset)
+
+        else:
+            return None
+
+        aggregate = queryset.order_by().aggregate(
+            version=models.Max(self.version_field),
+            count=models.Count('pk'))
+        return (aggregate['version'], aggregate['count'])
+
+    def get_validators(self):
+        """
+        Returns a ``(etag, last_modified)`` tuple for the current ``GET``
+        request or ``None`` if ``get_version`` returns ``None``.
+        ``last_modified`` is a timestamp or ``None``.
+
+        The ``ETag`` depends on the version, the full URL and the headers
+        influencing the response, that is ``Accept``, the negotiated content
+        coding and the value returned by ``get_cache_discriminator``.
+        """
+        version = self.get_version()
+        if version is None:
+            return None
+
+        etag = hashlib.md5(force_bytes('%s:%s:%s:%s:%s:%r' % (
+            self.api.name,
+            self.request.get_full_path(),
+            self.request.META.get('HTTP_ACCEPT', ''),
+            get_encoding(self.request),
+            self.get_cache_discriminator(),
+            version,
+        ))).hexdigest()
+
+        last_modified = version[0]
+        if isinstance(last_modified, datetime):
+            if timezone.is_naive(last_modified):
+                last_modified = timezone.make_aware(
+                    last_modified, timezone.get_default_timezone())
+            last_modified = timegm(last_modified.utctimetuple())
+        elif isinstance(last_modified, date):
+            last_modified = timegm(last_modified.timetuple())
+        else:
+            last_modified = None
+
+        return quote_etag(etag), last_modified
+
+    def not_modified_response(self, etag, last_modified):
+        """
+        Returns a ``304 Not Modified`` response if the client sent a
+        matching ``If-None-Match`` or ``If-Modified-Since`` header, ``None``
+        otherwise. ``If-None-Match`` takes precedence.
+        """
+        if_none_match = self.request.META.get('HTTP_IF_NONE_MATCH')
+        if if_none_match:
+            etags = parse_etags(if_none_match)
+            not_modified = '*' in etags or etag.strip('"') in etags
+        else:
+            if_modified_since = parse_http_date_safe(
+                self.request.META.get('HTTP_IF_MODIFIED_SINCE', ''))
+            not_modified = (
+                if_modified_since is not None
+                and last_modified is not None
+                and last_modified <= if_modified_since)
+
+        if not not_modified:
+            return None
+
+        response = HttpResponseNotModified()
+        response['ETag'] = etag
+        if last_modified is not None:
+            response['Last-Modified'] = http_date(last_modified)
+        patch_vary_headers(response, ('Accept',))
+        return response
+
+    def get_cache_discriminator(self):
+        """
+        Returns a value identifying everything besides the request URL and
+        the ``Accept`` header which influences responses, by default the
+        primary key of the authenticated user. Override this if responses
+        depend on the tenant or on other request attributes.
+        """
+        user = getattr(self.request, 'user', None)
+        return getattr(user, 'pk', None)
+
+    def get_cache_key(self):
+        """
+        Returns the key used for caching the response to the current
+        ``GET`` request. The key contains the generations of the model and
+        of all inlined models so that writes invalidate cached responses.
+        Requests to other hosts or using another scheme do not share keys.
+        """
+        model = self.model or self.queryset.model
+        dependencies = set([model]) | self.api.inlined_models(
+            model, self.get_inline_depth())
+        dependencies = sorted(dependencies, key=lambda m: m._meta.db_table)
+        track_models(dependencies)
+
+        return 'towel-api-response:%s' % hashlib.md5(force_bytes(
+            '%s:%s.%s:%s:%s?%s:%s:%s:%s:%r' % (
+                self.api.name,
+                self.__class__.__module__,
+                self.__class__.__name__,
+                self.kwargs.get('request_type'),
+                # Responses contain absolute URIs, which depend on the
+                # scheme and the host
+                self.request.build_absolute_uri(self.request.path),
+                querystring(self.request.GET),
+                self.request.META.get('HTTP_ACCEPT', ''),
+                get_encoding(self.request),
+                self.get_cache_discriminator(),
+                get_generations(dependencies),
+            ))).hexdigest()
+
     def get_query_set(self):
         """
         Returns the queryset used by this resource. If you need access or
         visibility control, add it here.
         """
-        if self.queryset:
+        if self.queryset is not None:
             return self.queryset._clone()
         elif self.model:
             return self.model._default_manager.all()
@@ -172,31 +519,203 @@ class Resource(generic.View):
         """
         return queryset
 
+    def get_inline_depth(self):
+        """
+        Returns the ``inline_depth`` requested by the client or ``None`` if
+        the serializer's default should be used. Currently, only detail
+        resources support inlining using ``?full=1``.
+        """
+        if (self.kwargs.get('request_type') == 'detail'
+                and self.request.GET.get('full')):
+            return 1
+        return None
+
+    def get_sparse_fieldset(self):
+        """
+        Returns the lists of field names requested using ``?fields=`` and
+        ``?exclude=``. Both parameters accept comma separated names and may
+        be repeated. Names of inlined objects' fields are prefixed with the
+        relation name and a dot, f.e. ``?fields=name,person.family_name``.
+        """
+        def names(key):
+            return [
+                name.strip()
+                for value in self.request.GET.getlist(key)
+                for name in value.split(',')
+                if name.strip()]
+
+        return names('fields'), names('exclude')
+
+    def get_serializer_kwargs(self):
+        """
+        Returns the keyword arguments passed to ``api.serialize_instance``
+        """
+        kwargs = {
+            'build_absolute_uri': self.request.build_absolute_uri,
+        }
+
+        inline_depth = self.get_inline_depth()
+        if inline_depth is not None:
+            kwargs['inline_depth'] = inline_depth
+
+        fields, exclude = self.get_sparse_fieldset()
+        if fields:
+            kwargs['sparse_fields'] = fields
+        if exclude:
+            kwargs['sparse_exclude'] = exclude
+        return kwargs
+
+    def get_row_serializer(self, model):
+        """
+        Returns the ``(columns, serialize)`` tuple of
+        ``API.row_serializer`` if ``values_fast_path`` is enabled and
+        possible for the current request, ``None`` otherwise.
+        """
+        if not self.values_fast_path or self.get_inline_depth():
+            return None
+
+        fields, exclude = self.get_sparse_fieldset()
+        return self.api.row_serializer(
+            model,
+            sparse_fields=fields,
+            sparse_exclude=exclude,
+            str_function=None if self.values_str is None else self.row_str,
+            str_fields=self.str_fields or (),
+        )
+
+    def row_str(self, row):
+        """
+        Returns ``__str__`` for a dictionary of values fetched on the
+        ``values_list()`` fast path
+        """
+        return self.values_str.format(**row)
+
+    def optimize_queryset(self, queryset):
+        """
+        Applies ``select_related`` and ``prefetch_related`` to the queryset
+        so that the number of queries needed for serializing inlined objects
+        does not grow with the number of objects. Relations left out by
+        ``?fields=`` or ``?exclude=`` are skipped, and the loaded columns
+        are restricted as well if ``str_fields`` is set.
+        """
+        select_related, prefetch_related = self.api.related_lookups(
+            queryset.model, self.get_inline_depth())
+
+        fields, exclude = self.get_sparse_fieldset()
+        if fields or exclude:
+            names = set(path.split('.')[0] for path in fields)
+            excluded = set(name for name in exclude if '.' not in name)
+
+            def keep(lookup):
+                name = lookup.split('__')[0]
+                return (not fields or name in names) and name not in excluded
+
+            select_related = list(filter(keep, select_related))
+            prefetch_related = list(filter(keep, prefetch_related))
+
+            if self.str_fields is not None:
+                local = set(f.name for f in queryset.model._meta.fields)
+                required = set(self.str_fields)
+                required.add(queryset.model._meta.pk.name)
+                required.update(
+                    lookup.split('__')[0] for lookup in select_related)
+                required.update(
+                    name.lstrip('-') for name in self.cursor_ordering or ())
+
+                if fields:
+                    queryset = queryset.only(
+                        *((names | required) & local))
+                elif excluded - required:
+                    queryset = queryset.defer(
+                        *((excluded - required) & local))
+
+        if select_related:
+            queryset = queryset.select_related(*select_related)
+        if prefetch_related:
+            queryset = queryset.prefetch_related(*prefetch_related)
+        return queryset
+
     def detail_object_or_404(self):
         """
         Returns the current object for detail resources such as
         ``/api/product/1/``.
         """
-        return get_object_or_404(self.get_query_set(), pk=self.kwargs['pk'])
+        return get_object_or_404(
+            self.optimize_queryset(self.get_query_set()),
+            pk=self.kwargs['pk'])
+
+    def set_pks(self):
+        """
+        Returns the primary keys of set resources such as
+        ``/api/product/1;3/`` in the requested order, without duplicates
+        """
+        to_python = self.get_query_set().model._meta.pk.to_python
+        pks, seen = [], set()
+        for pk in self.kwargs['pks'].split(';'):
+            if not pk:
+                continue
+            pk = to_python(pk)
+            if pk not in seen:
+                seen.add(pk)
+                pks.append(pk)
+        return pks
+
+    def pk_chunks(self, queryset, pks):
+        """
+        Splits ``pks`` into lists of at most ``set_chunk_size`` primary
+        keys (less if the database limits the length of ``IN`` lists)
+        """
+        size = self.set_chunk_size
+        max_size = connections[queryset.db].ops.max_in_list_size()
+        if max_size:
+            size = min(size, max_size)
+        return [pks[idx:idx + size] for idx in range(0, len(pks), size)]
+
+    def fetch_by_pks(self, queryset, pks):
+        """
+        Returns a dictionary mapping primary keys to instances from
+        ``queryset``, like ``in_bulk`` but using one query per chunk of
+        ``pk_chunks``
+        """
+        objects = {}
+        for chunk in self.pk_chunks(queryset, pks):
+            objects.update(
+                (instance.pk, instance)
+                for instance in queryset.filter(pk__in=chunk))
+        return objects
+
+    def set_objects(self):
+        """
+        Returns a tuple containing the list of objects for set resources in
+        the requested order and the list of primary keys of objects which
+        do not exist
+        """
+        pks = self.set_pks()
+        objects = self.fetch_by_pks(
+            self.optimize_queryset(self.get_query_set()), pks)
+        return (
+            [objects[pk] for pk in pks if pk in objects],
+            [pk for pk in pks if pk not in objects])
 
     def set_objects_or_404(self):
         """
         Returns the current set of objects for set resources such as
-        ``/api/product/1;3/``.
+        ``/api/product/1;3/`` in the requested order. Raises ``Http404`` if
+        any object does not exist.
         """
-        pks = set(pk for pk in self.kwargs['pks'].split(';') if pk)
-        set_ = self.get_query_set().in_bulk(pks).values()
-
-        if len(pks) != len(set_):
+        objects, missing = self.set_objects()
+        if missing:
             raise Http404('Some objects do not exist.')
-
-        return set_
+        return objects
 
     def page_objects_or_404(self):
         """
         Returns the current page for list resources such as
         ``/api/product/?limit=20&offset=40``. Applies filtering using
         ``apply_filters`` as well.
+
+        Returns a ``CursorPage`` instead if ``cursor_ordering`` is set and
+        the request does not contain an ``offset``.
         """
         queryset = self.apply_filters(self.get_query_set())
 
@@ -218,26 +737,162 @@ class Resource(generic.View):
         offset = max(offset, 0)
         limit = max(limit, 0)
 
-        return Page(queryset[offset:offset + limit], offset, limit, queryset)
+        if self.cursor_ordering and 'offset' not in self.request.GET:
+            return self.cursor_page_or_404(queryset, limit)
+
+        return Page(
+            self.optimize_queryset(queryset)[offset:offset + limit],
+            offset,
+            limit,
+            queryset)
+
+    def cursor_page_or_404(self, queryset, limit):
+        """
+        Returns the page of objects following the ``?after=<cursor>`` or
+        preceding the ``?before=<cursor>`` object when ordering by
+        ``cursor_ordering``, or the first page if neither is given.
+        """
+        opts = queryset.model._meta
+        ordering = [
+            (name.lstrip('-'), name.startswith('-'))
+            for name in self.cursor_ordering]
+        fields = [
+            opts.pk if name == 'pk' else opts.get_field(name)
+            for name, descending in ordering]
+
+        def cursor(instance):
+            return encode_cursor([
+                field.value_to_string(instance) for field in fields])
+
+        after = self.request.GET.get('after')
+        before = self.request.GET.get('before')
+        objects = queryset
+
+        if after or before:
+            try:
+                values = clean_cursor(decode_cursor(before or after), fields)
+            except ValueError:
+                raise APIException('Invalid cursor')
+
+            objects = objects.filter(
+                keyset_filter(ordering, values, reverse=bool(before)))
+
+        if before:
+            objects = objects.order_by(*[
+                '%s%s' % ('' if descending else '-', name)
+                for name, descending in ordering])
+        else:
+            objects = objects.order_by(*self.cursor_ordering)
+
+        objects = list(self.optimize_queryset(objects)[:limit + 1])
+        more, objects = len(objects) > limit, objects[:limit]
+
+        if before:
+            objects.reverse()
+            return CursorPage(
+                objects,
+                limit,
+                queryset,
+                cursor(objects[-1]) if objects else None,
+                cursor(objects[0]) if objects and more else None)
+
+        return CursorPage(
+            objects,
+            limit,
+            queryset,
+            cursor(objects[-1]) if objects and more else None,
+            cursor(objects[0]) if objects and after else None)
+
+    def get_total(self, queryset):
+        """
+        Returns the total count of objects in ``queryset`` according to
+        ``total_policy``, or ``None``.
+        """
+        if self.total_policy == 'none':
+            return None
+
+        elif self.total_policy == 'cached':
+            try:
+                sql = force_text(queryset.query)
+            except EmptyResultSet:
+                return 0
+
+            # The SQL contains all filters, including those added by
+            # get_query_set for restricting access.
+            key = 'towel-api-total:%s' % hashlib.md5(force_bytes('%s:%s' % (
+                self.api.name, sql))).hexdigest()
+            total = cache.get(key)
+            if total is None:
+                total = queryset.count()
+                cache.set(key, total, self.total_cache_timeout)
+            return total
+
+        elif self.total_policy == 'estimate':
+            connection = connections[queryset.db]
+            if connection.vendor == 'postgresql':
+                try:
+                    sql, params = queryset.query.sql_with_params()
+                except EmptyResultSet:
+                    return 0
+
+                cursor = connection.cursor()
+                try:
+                    cursor.execute('EXPLAIN (FORMAT JSON) %s' % sql, params)
+                    plan = cursor.fetchone()[0]
+                finally:
+                    cursor.close()
+
+                if isinstance(plan, six.string_types):
+                    plan = json.loads(plan)
+                return plan[0]['Plan']['Plan Rows']
+
+        return queryset.count()
+
+    def iterate_objects(self, objects):
+        """
+        Yields the objects of a (sliced) queryset without caching them in the
+        queryset, which keeps memory usage bounded when streaming responses.
+        """
+        if not isinstance(objects, models.query.QuerySet):
+            for instance in objects:
+                yield instance
+
+        elif objects._prefetch_related_lookups:
+            offset = 0
+            while True:
+                chunk = list(objects[offset:offset + self.stream_chunk_size])
+                for instance in chunk:
+                    yield instance
+                if len(chunk) < self.stream_chunk_size:
+                    break
+                offset += self.stream_chunk_size
+
+        else:
+            for instance in objects.iterator():
+                yield instance
 
     def get_detail(self, request, *args, **kwargs):
-        kw = {}
-        if request.GET.get('full'):
-            kw['inline_depth'] = 1
         return self.api.serialize_instance(
             self.detail_object_or_404(),
-            build_absolute_uri=request.build_absolute_uri,
-            **kw)
+            **self.get_serializer_kwargs())
 
     def get_set(self, request, *args, **kwargs):
-        return {
+        serializer_kwargs = self.get_serializer_kwargs()
+
+        if self.set_report_missing:
+            objects, missing = self.set_objects()
+        else:
+            objects, missing = self.set_objects_or_404(), None
+
+        response = {
             'objects': [
-                self.api.serialize_instance(
-                    instance,
-                    build_absolute_uri=request.build_absolute_uri,
-                ) for instance in self.set_objects_or_404()
+                self.api.serialize_instance(instance, **serializer_kwargs)
+                for instance in objects
             ],
         }
+        if missing is not None:
+            response['missing'] = missing
+        return response
 
     def get_list(self, request, *args, **kwargs):
         page = self.page_objects_or_404()
@@ -245,43 +900,251 @@ class Resource(generic.View):
         list_url = api_reverse(
             page.full_queryset.model, 'list', api_name=self.api.name)
 
-        meta = {
-            'offset': page.offset,
-            'limit': page.limit,
-            'total': page.full_queryset.count(),
-            'previous': None,
-            'next': None,
-        }
-
-        if page.offset > 0:
-            meta['previous'] = request.build_absolute_uri('%s?%s' % (
+        def page_url(**kwargs):
+            return request.build_absolute_uri('%s?%s' % (
                 list_url,
                 querystring(
                     self.request.GET,
-                    exclude=('offset', 'limit'),
-                    offset=max(0, page.offset - page.limit),
+                    exclude=('offset', 'limit', 'after', 'before'),
                     limit=page.limit,
-                ),
+                    **kwargs),
             ))
 
-        if page.offset + page.limit < meta['total']:
-            meta['next'] = request.build_absolute_uri('%s?%s' % (
-                list_url,
-                querystring(
-                    self.request.GET,
-                    exclude=('offset', 'limit'),
-                    offset=page.offset + page.limit,
-                    limit=page.limit,
-                ),
-            ))
+        objects = page.queryset
+        has_next = False
+
+        row_serializer = None
+        if not isinstance(page, CursorPage):
+            row_serializer = self.get_row_serializer(page.full_queryset.model)
+
+        def fetch(queryset):
+            if row_serializer is not None:
+                return queryset.values_list(*row_serializer[0])
+            return queryset
+
+        if isinstance(page, CursorPage):
+            meta = {
+                'limit': page.limit,
+                'total': (
+                    self.get_total(page.full_queryset) if self.cursor_total
+                    else None),
+                'previous': None,
+                'next': None,
+            }
+
+            if page.previous:
+                meta['previous'] = page_url(before=page.previous)
+            if page.next:
+                meta['next'] = page_url(after=page.next)
+
+        else:
+            meta = {
+                'offset': page.offset,
+                'limit': page.limit,
+                'total': self.get_total(page.full_queryset),
+                'previous': None,
+                'next': None,
+            }
+
+            objects = fetch(objects)
+            end = page.offset + page.limit
+            if self.total_policy == 'exact':
+                has_next = end < meta['total']
+            elif self.streaming and not self.stream_meta_first:
+                # Whether there is a next page is determined while streaming
+                objects = fetch(self.optimize_queryset(
+                    page.full_queryset)[page.offset:end + 1])
+            elif self.streaming:
+                has_next = page.full_queryset[end:end + 1].exists()
+            else:
+                objects = list(fetch(self.optimize_queryset(
+                    page.full_queryset)[page.offset:end + 1]))
+                has_next = len(objects) > page.limit
+                objects = objects[:page.limit]
+
+            if page.offset > 0:
+                meta['previous'] = page_url(
+                    offset=max(0, page.offset - page.limit))
+
+        if has_next:
+            meta['next'] = page_url(offset=page.offset + page.limit)
+
+        if row_serializer is not None:
+            serialize = partial(
+                row_serializer[1],
+                build_absolute_uri=request.build_absolute_uri)
+        else:
+            serialize = partial(
+                self.api.serialize_instance, **self.get_serializer_kwargs())
+
+        if not self.streaming:
+            return {
+                'objects': [serialize(instance) for instance in objects],
+                'meta': meta,
+            }
+
+        def stream():
+            for idx, instance in enumerate(self.iterate_objects(objects)):
+                if idx == page.limit:
+                    # The additional object fetched for determining whether
+                    # there is a next page.
+                    meta['next'] = page_url(offset=page.offset + page.limit)
+                    break
+
+                yield serialize(instance)
+
+        return {
+            'objects': stream(),
+            'meta': meta if self.stream_meta_first else (lambda: meta),
+        }
+
+    def iterate_export(self, queryset, columns=None):
+        """
+        Yields all objects in ``queryset`` ordered by primary key, fetching
+        ``export_chunk_size`` objects per query. Chunks are selected using
+        the primary key of the last object instead of ``OFFSET``, which
+        keeps every query fast regardless of the position in the table. If
+        ``columns`` is given, ``values_list()`` rows are yielded instead;
+        the first column has to be the primary key.
+        """
+        queryset = queryset.order_by('pk')
+        if columns is not None:
+            queryset = queryset.values_list(*columns)
+
+        last = None
+        while True:
+            chunk = queryset if last is None else queryset.filter(pk__gt=last)
+            chunk = list(chunk[:self.export_chunk_size])
+
+            for obj in chunk:
+                yield obj
+
+            if len(chunk) < self.export_chunk_size:
+                break
+            last = chunk[-1][0] if columns is not None else chunk[-1].pk
+
+    def get_export(self, request, *args, **kwargs):
+        """
+        Streams all objects of the filtered queryset as newline delimited
+        JSON, one serialized object per line
+        """
+        queryset = self.apply_filters(self.get_query_set())
+        row_serializer = self.get_row_serializer(queryset.model)
+        dumps = get_json_backend(self.api.json_backend).dumps
+
+        if row_serializer is not None:
+            objects = self.iterate_export(queryset, row_serializer[0])
+            serialize = partial(
+                row_serializer[1],
+                build_absolute_uri=request.build_absolute_uri)
+        else:
+            objects = self.iterate_export(self.optimize_queryset(queryset))
+            serialize = partial(
+                self.api.serialize_instance, **self.get_serializer_kwargs())
+
+        def lines():
+            for obj in objects:
+                yield dumps(serialize(obj)) + '\n'
+
+        return compress_response(request, StreamingHttpResponse(
+            lines(), content_type='application/x-ndjson; charset=utf-8'))
+
+    def get_changes_discriminator(self):
+        """
+        Returns the discriminator of the deletions reported by the change
+        feed, see ``changes_discriminator``. The default implementation
+        returns ``None``, which reports all deletions.
+        """
+        return None
+
+    def get_changes(self, request, *args, **kwargs):
+        """
+        Returns the objects of the filtered queryset whose ``changes_field``
+        changed after the position encoded in the opaque ``?since=<cursor>``
+        and the primary keys of objects deleted since then (requires
+        ``towel.api.changes``). Without a cursor, all objects are returned
+        but no deletions.
+
+        At most ``changes_limit`` (or ``?limit=``) changed and deleted
+        objects are returned. ``meta.more`` is true if there are more
+        changes; clients should request ``meta.next`` until it is false and
+        remember ``meta.cursor`` for the next synchronization.
+
+        Deletions are reported for all objects of the model regardless of
+        filters, unless ``get_changes_discriminator`` returns a value. Objects
+        changing such that they do not match the filters anymore are not
+        reported at all.
+        """
+        queryset = self.apply_filters(self.get_query_set())
+        model = queryset.model
+        fields = [model._meta.get_field(self.changes_field), model._meta.pk]
+        ordering = [(self.changes_field, False), ('pk', False)]
+
+        try:
+            limit = int(request.GET['limit'])
+        except (KeyError, ValueError):
+            limit = self.changes_limit
+        limit = max(1, min(limit, self.changes_limit))
+
+        since = request.GET.get('since')
+        if since:
+            try:
+                cursor = decode_cursor(since)
+            except ValueError:
+                raise APIException('Invalid cursor')
+            if (not isinstance(cursor, list) or len(cursor) not in (1, 3)
+                    or not isinstance(cursor[0], six.integer_types)):
+                raise APIException('Invalid cursor')
 
+            tombstone, position = cursor[0], cursor[1:]
+            if position:
+                try:
+                    values = clean_cursor(position, fields)
+                except ValueError:
+                    raise APIException('Invalid cursor')
+                queryset = queryset.filter(keyset_filter(ordering, values))
+            deleted = changes.tombstones(
+                model, tombstone, limit + 1,
+                discriminator=self.get_changes_discriminator())
+        else:
+            tombstone, position = changes.latest_tombstone(), []
+            deleted = []
+
+        objects = list(self.optimize_queryset(
+            queryset.order_by(self.changes_field, 'pk'))[:limit + 1])
+        more = len(objects) > limit or len(deleted) > limit
+        objects, deleted = objects[:limit], deleted[:limit]
+
+        if objects:
+            position = [field.value_to_string(objects[-1]) for field in fields]
+        if deleted:
+            tombstone = deleted[-1][0]
+        cursor = encode_cursor([tombstone] + position)
+
+        def deleted_uri(pk):
+            # Resources registered with canonical=False have no detail URI
+            uri = api_reverse(
+                model, 'detail', api_name=self.api.name, pk=pk,
+                fail_silently=True)
+            return None if uri is None else request.build_absolute_uri(uri)
+
+        kwargs = self.get_serializer_kwargs()
         return {
             'objects': [
-                self.api.serialize_instance(
-                    instance,
-                    build_absolute_uri=request.build_absolute_uri,
-                ) for instance in page.queryset],
-            'meta': meta,
+                self.api.serialize_instance(obj, **kwargs) for obj in objects],
+            'deleted': [{
+                '__pk__': object_pk,
+                '__uri__': deleted_uri(object_pk),
+            } for object_pk in (
+                model._meta.pk.to_python(pk) for _id, pk in deleted)],
+            'meta': {
+                'cursor': cursor,
+                'more': more,
+                'next': request.build_absolute_uri('%s?%s' % (
+                    request.path,
+                    querystring(request.GET, exclude=('since',), since=cursor),
+                )),
+            },
         }
 
     def options(self, request, *args, **kwargs):
@@ -299,3 +1162,241 @@ class Resource(generic.View):
         if 'GET' in methods:
             methods.add('HEAD')
         return sorted(methods)
+
+
+class BulkResource(Resource):
+    """
+    Resource which additionally supports writing many objects at once:
+
+    - ``POST`` a list of objects to the list URL to create them.
+    - ``PUT`` or ``PATCH`` a set URL such as ``/api/product/1;3/`` to update
+      the objects in the set. The body either maps primary keys to data for
+      the individual objects or contains the data for all objects.
+    - ``DELETE`` a set URL to delete all objects in the set.
+
+    Every request is processed inside a single transaction. Nothing is
+    saved if any object fails validation; the validation errors are
+    reported per object in the same order as in the request.
+    """
+
+    #: Base form class used for validating objects; ``get_form_class``
+    #: always uses ``modelform_factory`` with this form.
+    form_class = forms.ModelForm
+
+    #: Higher counts of objects in a single request are not accepted
+    max_bulk_objects = 1000
+
+    #: Create objects using ``bulk_create`` instead of saving them one by
+    #: one. ``save()`` is not called and no signals are sent. Since primary
+    #: keys are not known afterwards, the response only contains the count
+    #: of created objects. Forms with many to many fields always save objects
+    #: one by one.
+    use_bulk_create = False
+
+    #: Update all objects using one ``UPDATE`` query per chunk of
+    #: ``set_chunk_size`` objects if all objects receive the same data.
+    #: ``save()`` is not called and no signals are sent; ``auto_now`` fields
+    #: are updated nevertheless. See ``can_update_in_bulk``.
+    use_bulk_update = False
+
+    def get_form_class(self):
+        """
+        Returns the form class used for validating objects
+        """
+        return modelform_factory(
+            self.model, form=self.form_class, exclude=())
+
+    def validate(self, items, instances=None, partial=False):
+        """
+        Validates ``items``, a list of dictionaries, and returns a list of
+        valid forms. ``instances`` contains the objects being updated. If
+        ``partial`` is true, the objects' current values are used for fields
+        missing in the data.
+
+        Raises an ``APIException`` listing the errors of all invalid items
+        (``None`` for valid items) if any item is invalid.
+        """
+        form_class = self.get_form_class()
+        forms_, errors = [], []
+
+        for idx, item in enumerate(items):
+            instance = instances[idx] if instances else None
+
+            if not isinstance(item, dict):
+                forms_.append(None)
+                errors.append({'__all__': ['Expected an object.']})
+                continue
+
+            data = item
+            if partial:
+                data = model_to_dict(
+                    instance,
+                    fields=form_class._meta.fields,
+                    exclude=form_class._meta.exclude)
+                data.update(item)
+
+            form = form_class(data=data, instance=instance)
+            forms_.append(form)
+            errors.append(None if form.is_valid() else dict(form.errors))
+
+        if any(errors):
+            raise APIException('Validation failed', data={
+                'objects': errors,
+            })
+        return forms_
+
+    def get_bulk_data(self):
+        """
+        Returns the list of objects from the request body, and raises an
+        ``APIException`` if the body is not a list of acceptable length
+        """
+        data = self.request.POST
+        if not isinstance(data, list):
+            raise APIException('Expected a list of objects.')
+        self.check_bulk_count(len(data))
+        return data
+
+    def check_bulk_count(self, count):
+        """
+        Raises an ``APIException`` if ``count`` exceeds ``max_bulk_objects``
+        """
+        if count > self.max_bulk_objects:
+            raise APIException(
+                'Too many objects, at most %s are allowed.' % (
+                    self.max_bulk_objects),
+                status=http_client.REQUEST_ENTITY_TOO_LARGE)
+
+    def post_list(self, request, *args, **kwargs):
+        items = self.get_bulk_data()
+
+        with atomic():
+            forms_ = self.validate(items)
+
+            many_to_many = set(
+                f.name for f in self.model._meta.many_to_many)
+            if self.use_bulk_create and not many_to_many.intersection(
+                    self.get_form_class().base_fields):
+                objects = self.model._default_manager.bulk_create([
+                    form.save(commit=False) for form in forms_])
+                bump_generation(self.model)
+                return self.serialize_response(
+                    {'created': len(objects)},
+                    status=http_client.CREATED)
+
+            objects = [form.save() for form in forms_]
+
+        serializer_kwargs = self.get_serializer_kwargs()
+        return self.serialize_response(
+            {
+                'objects': [
+                    self.api.serialize_instance(instance, **serializer_kwargs)
+                    for instance in objects],
+            },
+            status=http_client.CREATED)
+
+    def update_set(self, partial):
+        """
+        Updates all objects in the current set, see ``put_set`` and
+        ``patch_set``
+        """
+        pks = self.set_pks()
+        self.check_bulk_count(len(pks))
+
+        data = self.request.POST
+        if not isinstance(data, dict):
+            raise APIException('Expected an object.')
+
+        to_python = self.model._meta.pk.to_python
+
+        def data_pk(key):
+            try:
+                return to_python(force_text(key))
+            except ValidationError:
+                return None
+
+        per_object = bool(data) and all(data_pk(key) in pks for key in data)
+        if per_object:
+            data = dict((data_pk(key), value) for key, value in data.items())
+            if len(data) != len(pks):
+                raise APIException('Data for some objects is missing.')
+            items = [data[pk] for pk in pks]
+        else:
+            items = [data] * len(pks)
+
+        def fetch(queryset):
+            objects = self.fetch_by_pks(queryset, pks)
+            if len(objects) != len(pks):
+                raise Http404('Some objects do not exist.')
+            return [objects[pk] for pk in pks]
+
+        with atomic():
+            queryset = self.get_query_set().select_for_update()
+            forms_ = self.validate(items, fetch(queryset), partial=partial)
+
+            if (self.use_bulk_update and not per_object
+                    and self.can_update_in_bulk(forms_[0], data)):
+                form = forms_[0]
+                values = dict(
+                    (name, form.cleaned_data[name]) for name in data)
+                for field in self.model._meta.fields:
+                    if getattr(field, 'auto_now', False):
+                        values[field.name] = field.pre_save(
+                            form.instance, False)
+                for chunk in self.pk_chunks(queryset, pks):
+                    queryset.filter(pk__in=chunk).update(**values)
+                bump_generation(self.model)
+                instances = fetch(self.optimize_queryset(queryset))
+            else:
+                instances = [form.save() for form in forms_]
+
+        serializer_kwargs = self.get_serializer_kwargs()
+        return {
+            'objects': [
+                self.api.serialize_instance(instance, **serializer_kwargs)
+                for instance in instances],
+        }
+
+    def can_update_in_bulk(self, form, data):
+        """
+        Returns whether ``data``, the data for all objects, may be written
+        using ``UPDATE`` queries. Only concrete fields of the validated
+        ``form`` can be written, and objects are always saved one by one if
+        changes have to be recorded by ``save()`` or signal handlers for
+        ``version_field`` or for change feeds.
+        """
+        fields = set(f.name for f in self.model._meta.fields)
+        if not data or not set(data) <= fields & set(form.cleaned_data):
+            return False
+
+        auto_now = set(
+            f.name for f in self.model._meta.fields
+            if getattr(f, 'auto_now', False))
+        if self.version_field and self.version_field not in auto_now:
+            return False
+        if self.changes_field and self.changes_field not in auto_now:
+            return False
+        return not changes.is_tracked(self.model)
+
+    def put_set(self, request, *args, **kwargs):
+        return self.update_set(partial=False)
+
+    def patch_set(self, request, *args, **kwargs):
+        return self.update_set(partial=True)
+
+    def delete_set(self, request, *args, **kwargs):
+        self.check_bulk_count(len(self.set_pks()))
+
+        with atomic():
+            queryset = self.get_query_set()
+            pks = [instance.pk for instance in self.set_objects_or_404()]
+            try:
+                for chunk in self.pk_chunks(queryset, pks):
+                    queryset.filter(pk__in=chunk).delete()
+            except models.ProtectedError as exc:
+                raise APIException(
+                    'Some objects are protected.',
+                    status=http_client.CONFLICT,
+                    data={'protected': [
+                        force_text(obj) for obj in exc.protected_objects]})
+
+        return HttpResponse(status=http_client.NO_CONTENT)
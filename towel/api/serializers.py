@@ -1,14 +1,46 @@
 from __future__ import absolute_import, unicode_literals
 
-import json
+try:
+    from collections.abc import Iterator
+except ImportError:  # Python 2
+    from collections import Iterator
 
-from django.core.serializers.json import DjangoJSONEncoder
-from django.http import HttpResponse
+from django.http import HttpResponse, StreamingHttpResponse
 from django.utils.cache import patch_vary_headers
 from django.utils.six.moves import http_client
 
+from towel.api.compression import compress_response
+from towel.api.formats import content_types, get_format
+from towel.api.json_backends import get_json_backend
 from towel.api.mimeparse import best_match
 
+#: Results of ``negotiate``, keyed by supported types and ``Accept`` header
+_negotiated = {}
+
+#: Count of results kept by ``negotiate``
+NEGOTIATE_CACHE_SIZE = 256
+
+
+def negotiate(supported_types, accept):
+    """
+    Returns the best match for the ``Accept`` header ``accept`` amongst the
+    tuple ``supported_types`` (in order of increasing preference).
+
+    Clients only send a handful of distinct ``Accept`` headers, results are
+    therefore cached.
+    """
+    key = (supported_types, accept)
+    try:
+        return _negotiated[key]
+    except KeyError:
+        pass
+
+    if len(_negotiated) >= NEGOTIATE_CACHE_SIZE:
+        # Headers are controlled by clients, do not grow without bounds
+        _negotiated.clear()
+    match = _negotiated[key] = best_match(supported_types, accept)
+    return match
+
 
 class Serializer(object):
     """
@@ -16,7 +48,15 @@ class Serializer(object):
 
     Handles content type negotiation using the HTTP Accept header if the
     format isn't overridden.
+
+    ``json_backend`` is the name of a JSON backend from
+    ``towel.api.json_backends`` or a backend instance, the backend configured
+    in the settings is used if unset.
     """
+    def __init__(self, json_backend=None):
+        self.json_backend = get_json_backend(json_backend)
+        self.supported_types = tuple(reversed(content_types()))
+
     def serialize(self, data, output_format=None, request=None,
                   status=http_client.OK, headers=None):
         """
@@ -28,10 +68,17 @@ class Serializer(object):
         different code yourself.
 
         Returns a ``406 Not acceptable`` response if the requested format is
-        unknown or unsupported. Currently, the following formats are
-        supported:
+        unknown or unsupported. Returns a ``StreamingHttpResponse`` if any
+        value of the ``data`` dictionary is an iterator, see ``iter_json``.
+        All formats from ``towel.api.formats`` are supported, by default:
 
         - ``json`` or ``application/json``
+        - ``msgpack`` or ``application/msgpack`` (if ``msgpack`` is
+          installed)
+        - ``cbor`` or ``application/cbor`` (if ``cbor2`` is installed)
+
+        The response is generated by the ``to_<format name>`` method if it
+        exists (e.g. ``to_json``), by ``render`` otherwise.
 
         Usage::
 
@@ -54,17 +101,20 @@ class Serializer(object):
         if output_format is None:
             # Thanks django-tastypie!
             try:
-                output_format = best_match(
-                    reversed([
-                        'application/json',
-                    ]),
+                output_format = negotiate(
+                    self.supported_types,
                     request.META.get('HTTP_ACCEPT', ''),
                 )
             except (IndexError, ValueError):
                 pass
 
-        if output_format in ('application/json', 'json'):
-            response = self.to_json(data)
+        fmt = get_format(output_format)
+        if fmt is not None:
+            renderer = getattr(self, 'to_%s' % fmt.name, None)
+            if renderer is not None:
+                response = renderer(data)
+            else:
+                response = self.render(fmt, data)
 
         else:
             # Cannot raise ClientError here because the APIException handler
@@ -78,10 +128,80 @@ class Serializer(object):
 
         patch_vary_headers(response, ('Accept',))
         response.status_code = status
+        if request is not None:
+            response = compress_response(request, response)
         return response
 
+    def render(self, fmt, data):
+        """
+        Returns a response containing ``data`` serialized by ``fmt.dumps``.
+        Iterators and callables (see ``iter_json``) are evaluated first.
+        """
+        if isinstance(data, dict):
+            data = dict(
+                (key, list(value) if isinstance(value, Iterator) else value)
+                for key, value in data.items())
+            data = dict(
+                (key, value() if callable(value) else value)
+                for key, value in data.items())
+
+        return HttpResponse(fmt.dumps(data), content_type=fmt.content_type)
+
+    #: Approximate size of chunks in streamed responses
+    stream_buffer_size = 16384
+
     def to_json(self, data):
+        if isinstance(data, dict) and any(
+                isinstance(value, Iterator)
+                for value in data.values()):
+            return StreamingHttpResponse(
+                self.iter_json(data),
+                content_type='application/json',
+            )
+
         return HttpResponse(
-            json.dumps(data, cls=DjangoJSONEncoder),
+            self.json_backend.dumps(data),
             content_type='application/json',
         )
+
+    def iter_json(self, data):
+        """
+        Encodes the ``data`` dictionary incrementally. Iterators are written
+        as JSON arrays, item by item, while they are consumed. Callables are
+        called only after all iterators are exhausted and their return value
+        is written last. All other values are written first.
+        """
+        encode = self.json_backend.dumps
+
+        def position(item):
+            if isinstance(item[1], Iterator):
+                return (1, item[0])
+            elif callable(item[1]):
+                return (2, item[0])
+            return (0, item[0])
+
+        items = sorted(data.items(), key=position)
+
+        buf, size = [], 0
+        for idx, (key, value) in enumerate(items):
+            buf.append('%s%s: ' % (', ' if idx else '{', encode(key)))
+
+            if isinstance(value, Iterator):
+                buf.append('[')
+                for count, item in enumerate(value):
+                    part = encode(item)
+                    buf.append(', %s' % part if count else part)
+                    size += len(part)
+                    if size >= self.stream_buffer_size:
+                        yield ''.join(buf)
+                        buf, size = [], 0
+                buf.append(']')
+
+            elif callable(value):
+                buf.append(encode(value()))
+
+            else:
+                buf.append(encode(value))
+
+        buf.append('}' if items else '{}')
+        yield ''.join(buf)
@@ -0,0 +1,157 @@
+"""
+Rate limiting
+=============
+
+``rate_limit`` returns a decorator limiting the request rate and the count
+of concurrently processed requests per client::
+
+    from towel.api.decorators import token_auth
+    from towel.api.throttling import rate_limit
+
+    api_v1 = API('v1', decorators=[
+        csrf_exempt,
+        token_auth,
+        rate_limit(requests=100, period=60, burst=20, concurrent=4),
+    ])
+
+The request rate is limited using a token bucket: Every client may send
+``burst`` requests at once, the bucket is refilled with ``requests`` tokens
+per ``period`` seconds. ``concurrent`` is the maximum count of requests of
+a single client being processed at the same time. Requests exceeding either
+limit are answered with ``429 Too Many Requests`` and a ``Retry-After``
+header. Pass the API's ``json_backend`` to ``rate_limit`` if it is set.
+
+Clients are identified by ``key``:
+
+- ``'user'`` (the default): The authenticated user, or the remote address
+  for anonymous requests. Because ``token_auth`` and ``http_basic_auth``
+  set ``request.user``, authentication decorators have to come before
+  ``rate_limit`` in the list of decorators.
+- ``'access'``: The tenant of ``request.access`` (see :py:mod:`towel.mt`),
+  all users of a tenant share the limits.
+- A callable receiving the request and returning a string or ``None``.
+  Requests whose key is ``None`` are not limited.
+
+The state is kept in Django's default cache, which has to be shared by all
+processes (e.g. memcached) for the limits to be enforced globally. The
+token bucket is updated without locking, concurrent requests may therefore
+occasionally slip through when a client is exactly at its limit.
+"""
+
+from __future__ import absolute_import, unicode_literals
+
+from functools import wraps
+import math
+import time
+
+from django.core.cache import cache
+
+from .serializers import Serializer
+
+
+def user_key(request):
+    user = getattr(request, 'user', None)
+    if user is not None and user.is_authenticated():
+        return 'user:%s' % user.pk
+    return 'addr:%s' % request.META.get('REMOTE_ADDR', '')
+
+
+def access_key(request):
+    access = getattr(request, 'access', None)
+    if access is None:
+        return user_key(request)
+
+    from towel.mt import client_model
+    client = getattr(access, client_model().__name__.lower())
+    return 'client:%s' % client.pk
+
+
+KEYS = {
+    'user': user_key,
+    'access': access_key,
+}
+
+
+def _too_many_requests(request, retry_after, json_backend=None):
+    return Serializer(json_backend=json_backend).serialize(
+        {'error': 'Too many requests'},
+        request=request,
+        status=429,
+        headers={'Retry-After': '%d' % max(1, math.ceil(retry_after))},
+        output_format=request.GET.get('format'))
+
+
+def take_token(key, requests, period, burst):
+    """
+    Removes a token from the bucket ``key`` and returns ``0``, or returns
+    the count of seconds until a token becomes available
+    """
+    now = time.time()
+    cache_key = 'towel-api-rate:%s' % key
+    tokens, updated = cache.get(cache_key, (burst, now))
+    tokens = min(burst, tokens + (now - updated) * requests / period)
+
+    if tokens >= 1:
+        tokens, retry_after = tokens - 1, 0
+    else:
+        retry_after = (1 - tokens) * period / requests
+
+    # The bucket is full again after this time anyway
+    cache.set(
+        cache_key,
+        (tokens, now),
+        int(math.ceil((burst - tokens) * period / requests)) + 1)
+    return retry_after
+
+
+def rate_limit(requests=None, period=60, burst=None, concurrent=None,
+               key='user', json_backend=None):
+    """
+    Returns a view decorator enforcing the limits, see the module docstring.
+    ``json_backend`` is used for ``429 Too Many Requests`` responses and
+    should be the same as the API's.
+    """
+    if burst is None:
+        burst = requests
+    key_function = KEYS.get(key, key)
+
+    def limit_rate(request, client, func, *args, **kwargs):
+        if requests:
+            retry_after = take_token(client, requests, period, burst)
+            if retry_after:
+                return _too_many_requests(request, retry_after, json_backend)
+        return func(request, *args, **kwargs)
+
+    def decorator(func):
+        @wraps(func)
+        def _decorator(request, *args, **kwargs):
+            client = key_function(request)
+            if client is None:
+                return func(request, *args, **kwargs)
+
+            if not concurrent:
+                return limit_rate(request, client, func, *args, **kwargs)
+
+            # The timeout only matters if decrementing the counter failed
+            # (e.g. because the process was killed)
+            cache_key = 'towel-api-in-flight:%s' % client
+            cache.add(cache_key, 0, 300)
+            try:
+                in_flight = cache.incr(cache_key)
+            except ValueError:  # Evicted in the meantime
+                in_flight = 1
+                cache.add(cache_key, 1, 300)
+
+            try:
+                # Rejected requests do not take a token from the bucket
+                if in_flight > concurrent:
+                    return _too_many_requests(request, 1, json_backend)
+                return limit_rate(request, client, func, *args, **kwargs)
+            finally:
+                try:
+                    cache.decr(cache_key)
+                except ValueError:
+                    pass
+
+        return _decorator
+    return decorator
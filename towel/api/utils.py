@@ -1,8 +1,13 @@
 from __future__ import absolute_import, unicode_literals
 
+import base64
+import binascii
 from functools import reduce
+import json
 import operator
 
+from django.core.exceptions import ValidationError
+from django.db.models import Q
 from django.utils.encoding import force_text
 from django.utils.http import urlencode
 
@@ -34,3 +39,64 @@ def querystring(data, exclude=(), **kwargs):
         items.append((key, force_text(value)))
 
     return urlencode(sorted(items))
+
+
+def encode_cursor(values):
+    """
+    Encodes a list of JSON-serializable values into an opaque, URL-safe
+    cursor string
+    """
+    return base64.urlsafe_b64encode(
+        json.dumps(values).encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    """
+    Reverses ``encode_cursor``. Raises a ``ValueError`` if ``cursor`` is
+    invalid.
+    """
+    try:
+        cursor = cursor.encode('ascii')
+        return json.loads(base64.urlsafe_b64decode(
+            cursor + b'=' * (-len(cursor) % 4)).decode('utf-8'))
+    except (binascii.Error, TypeError, UnicodeError):
+        raise ValueError('Invalid cursor %r' % cursor)
+
+
+def clean_cursor(values, fields):
+    """
+    Converts the values of a decoded cursor to the Python types of
+    ``fields``. Raises a ``ValueError`` if there are too few or too many
+    values or if a value is invalid.
+    """
+    if not isinstance(values, list) or len(values) != len(fields):
+        raise ValueError('Invalid cursor %r' % (values,))
+    try:
+        return [field.to_python(value) for field, value in zip(fields, values)]
+    except (ValidationError, TypeError, ValueError):
+        raise ValueError('Invalid cursor %r' % (values,))
+
+
+def keyset_filter(ordering, values, reverse=False):
+    """
+    Returns a ``Q`` object matching all rows following the row with the
+    passed ``values`` when ordering by ``ordering``, a list of
+    ``(field name, descending)`` tuples. Rows preceding the row are matched
+    if ``reverse`` is true.
+
+    Usage::
+
+        queryset.filter(keyset_filter(
+            [('created', True), ('pk', False)],
+            ['2013-07-01T12:00:00', 42],
+        )).order_by('-created', 'pk')
+    """
+    q = Q()
+    for idx, ((name, descending), value) in enumerate(zip(ordering, values)):
+        condition = Q(**{
+            '%s__%s' % (name, 'lt' if descending != reverse else 'gt'): value,
+        })
+        for (prev_name, _d), prev_value in zip(ordering, values[:idx]):
+            condition &= Q(**{prev_name: prev_value})
+        q |= condition
+    return q
@@ -10,11 +10,13 @@ from __future__ import absolute_import, unicode_literals
 
 from functools import wraps
 
+from django.core.exceptions import ImproperlyConfigured
 from django.http import HttpResponse
 from django.utils.six.moves import http_client
 
 from towel import api
-from towel.utils import safe_queryset_and
+from towel.mt import client_model
+from towel.utils import app_model_label, safe_queryset_and
 
 
 def api_access(minimal):
@@ -44,9 +46,23 @@ class Resource(api.Resource):
     """
     Resource subclass which automatically applies filtering by
     ``request.access`` to all querysets used.
+
+    Change feeds only report deletions recorded with the primary key of the
+    current tenant as discriminator; ``changes_discriminator`` has to be set
+    to the attribute containing it, e.g. ``'client_id'``.
     """
     def get_query_set(self):
         return safe_queryset_and(
             super(Resource, self).get_query_set(),
             self.model.objects.for_access(self.request.access),
         )
+
+    def get_changes_discriminator(self):
+        # Deletions recorded without discriminator would never be reported
+        if not self.changes_discriminator:
+            raise ImproperlyConfigured(
+                'Change feeds of multi-tenant resources require a'
+                ' changes_discriminator for %s.%s' % (
+                    app_model_label(self.model)))
+        return getattr(
+            self.request.access, '%s_id' % client_model().__name__.lower())